@@ -1,13 +1,30 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
+from collections import Counter, defaultdict, deque, OrderedDict
 import argparse
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
 import itertools
+import json
 import mimetypes
+import multiprocessing
+import multiprocessing.pool
 import os.path
 import re
+import resource
+import select
+import StringIO
+import sqlite3
+import struct
+import threading
 import sys
 import time
+import traceback
 import urllib
 import urlparse
 import uuid
@@ -15,6 +32,10 @@ import zipfile
 
 from lxml import etree
 import requests
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 
 ###### ThML to HTML conversion ######
@@ -30,6 +51,10 @@ DESCEND = object()
 FINISHED = object()
 HANDLED = [DESCEND, FINISHED]
 
+# Bump when a change to the converter changes its output, so that
+# --rebuild-library converts every book again.
+CONVERTER_VERSION = 8
+
 ### etree utilities ###
 
 def add_text(node, text):
@@ -49,9 +74,8 @@ def add_tail(node, tail):
         node.tail += tail
 
 def append_text(parent, text):
-    c = parent.getchildren()
-    if c:
-        add_tail(c[-1], text)
+    if len(parent):
+        add_tail(parent[-1], text)
     else:
         add_text(parent, text)
 
@@ -75,6 +99,404 @@ def html_escape(text):
     return (utf8(text).replace('&', '&amp;').replace('<', '&lt;')
             .replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;'))
 
+### Parsing ###
+
+DTD_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dtd')
+
+# Public identifiers and file names of DTDs and entity sets that ThML files
+# refer to, mapped to the files in DTD_DIRECTORY that stand in for them.
+LOCAL_DTD_CATALOG = {
+    '-//W3C//ENTITIES Latin 1 for XHTML//EN': 'xhtml-lat1.ent',
+    '-//W3C//ENTITIES Symbols for XHTML//EN': 'xhtml-symbol.ent',
+    '-//W3C//ENTITIES Special for XHTML//EN': 'xhtml-special.ent',
+    '-//W3C//DTD XHTML 1.1//EN': 'ThML.dtd',
+    '-//W3C//DTD XHTML 1.0 Strict//EN': 'ThML.dtd',
+    '-//W3C//DTD XHTML 1.0 Transitional//EN': 'ThML.dtd',
+    'xhtml-lat1.ent': 'xhtml-lat1.ent',
+    'xhtml-symbol.ent': 'xhtml-symbol.ent',
+    'xhtml-special.ent': 'xhtml-special.ent',
+    'xhtml11.dtd': 'ThML.dtd',
+    'xhtml1-strict.dtd': 'ThML.dtd',
+    'xhtml1-transitional.dtd': 'ThML.dtd',
+}
+
+THML_DTD_RE = re.compile(r'^thml[\d.]*\.dtd$', re.IGNORECASE)
+
+
+def find_local_dtd(url, pubid):
+    """
+    Returns the path of the bundled file to use for a DTD or entity set,
+    or None if we don't have one.
+    """
+    if pubid is not None:
+        if 'Theological Markup Language' in pubid:
+            return os.path.join(DTD_DIRECTORY, 'ThML.dtd')
+        if pubid in LOCAL_DTD_CATALOG:
+            return os.path.join(DTD_DIRECTORY, LOCAL_DTD_CATALOG[pubid])
+    if url is not None:
+        name = url.replace('\\', '/').split('/')[-1]
+        if THML_DTD_RE.match(name):
+            return os.path.join(DTD_DIRECTORY, 'ThML.dtd')
+        if name in LOCAL_DTD_CATALOG:
+            return os.path.join(DTD_DIRECTORY, LOCAL_DTD_CATALOG[name])
+    return None
+
+
+class LocalDtdResolver(etree.Resolver):
+    def resolve(self, url, pubid, context):
+        path = find_local_dtd(url, pubid)
+        if path is None:
+            # Anything else, such as a SYSTEM entity naming a local file, is
+            # read as empty rather than left to libxml2.
+            return self.resolve_string('', context)
+        return self.resolve_filename(path, context)
+
+
+# Options shared by the parser and iterparse. Network access is never
+# attempted - DTDs and entity sets come from LOCAL_DTD_CATALOG - and external
+# general entities are never expanded.
+PARSER_OPTIONS = dict(load_dtd=True,
+                      resolve_entities='internal',
+                      no_network=True,
+                      huge_tree=True)
+
+_parsers = {}
+
+def get_parser(huge_tree=True):
+    """
+    Returns the XMLParser used for ThML input, created once per process.
+
+    With huge_tree=False, libxml2's own limits on entity expansion and text
+    size are kept, which is better for untrusted input.
+    """
+    if huge_tree not in _parsers:
+        parser = etree.XMLParser(**dplus(PARSER_OPTIONS, {'huge_tree': huge_tree}))
+        parser.resolvers.add(LocalDtdResolver())
+        _parsers[huge_tree] = parser
+    return _parsers[huge_tree]
+
+
+# Files are opened here rather than by libxml2, as LocalDtdResolver would
+# otherwise be asked for the document itself.
+
+def parse_thml_file(filename, huge_tree=True):
+    with file(filename, 'rb') as f:
+        return etree.parse(f, get_parser(huge_tree=huge_tree), base_url=filename).getroot()
+
+
+def iterparse_thml(source, **kwargs):
+    """
+    etree.iterparse, configured like get_parser()
+    """
+    if isinstance(source, basestring):
+        source = file(source, 'rb')
+    it = etree.iterparse(source, **dplus(PARSER_OPTIONS, kwargs))
+    it.resolvers.add(LocalDtdResolver())
+    return it
+
+
+def parse_thml_preview(filename, max_chapters=None, max_bytes=None, huge_tree=True):
+    """
+    Parses the start of a ThML file, stopping at the end of the top level
+    element of ThML.body with which max_chapters div1s have been read, or
+    max_bytes of the file. Returns (root of the partial tree, number of
+    div1s, bytes read, whether the whole file was read).
+    """
+    chapters = 0
+    with file(filename, 'rb') as f:
+        it = iterparse_thml(f, events=('end',), huge_tree=huge_tree)
+        for event, node in it:
+            parent = node.getparent()
+            if parent is None or parent.tag != 'ThML.body':
+                continue
+            if node.tag == 'div1':
+                chapters += 1
+            if ((max_chapters is not None and chapters >= max_chapters) or
+                (max_bytes is not None and f.tell() >= max_bytes)):
+                # The parser reads ahead, so there may be more of the tree
+                for sibling in list(node.itersiblings()):
+                    parent.remove(sibling)
+                return node.getroottree().getroot(), chapters, f.tell(), False
+        return it.root, chapters, f.tell(), True
+
+
+### Resource limits ###
+
+class LimitExceeded(Exception):
+    pass
+
+
+def current_memory():
+    """
+    Returns the resident memory of the process in bytes. Unlike ru_maxrss,
+    this goes down again when memory is released, so one large book doesn't
+    count against the next one in a long running process.
+    """
+    try:
+        with file('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (EnvironmentError, ValueError, IndexError):
+        # No /proc, use the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Limits(object):
+    """
+    Limits on the resources used to convert a book, for input that might be
+    broken or hostile. None means no limit.
+
+    max_elements, max_depth, max_input_bytes and timeout apply to each input
+    document, max_images and max_downloads to the whole book. timeout also
+    applies separately to fetching the images of a book. max_memory is the
+    ceiling for the memory the process is using, in bytes.
+    """
+    # How often (in elements) to check the clock and memory use
+    check_interval = 1000
+
+    def __init__(self, max_elements=None, max_depth=None, max_input_bytes=None,
+                 max_images=None, max_downloads=None, timeout=None, max_memory=None):
+        self.max_elements = max_elements
+        self.max_depth = max_depth
+        self.max_input_bytes = max_input_bytes
+        self.max_images = max_images
+        self.max_downloads = max_downloads
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.deadline = None
+
+    def is_active(self):
+        return any(v is not None for v in [self.max_elements, self.max_depth, self.max_input_bytes,
+                                           self.max_images, self.max_downloads, self.timeout,
+                                           self.max_memory])
+
+    def start_timer(self):
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def request_timeout(self, default):
+        """
+        Returns the timeout for a network request, which is default unless
+        the deadline is nearer.
+        """
+        remaining = self.remaining_time()
+        if remaining is None:
+            return default
+        if remaining <= 0:
+            raise LimitExceeded("Timed out after {0} seconds".format(self.timeout))
+        return min(remaining, default)
+
+    def check_input_bytes(self, size, name):
+        if self.max_input_bytes is not None and size > self.max_input_bytes:
+            raise LimitExceeded("{0} is {1} bytes, more than the limit of {2}".format(
+                name, size, self.max_input_bytes))
+
+    def check_element(self, node, count, depth):
+        if self.max_elements is not None and count > self.max_elements:
+            raise LimitExceeded("More than {0} elements, on line {1}".format(
+                self.max_elements, get_sourceline(node)))
+        if self.max_depth is not None and depth > self.max_depth:
+            raise LimitExceeded("Elements nested more than {0} deep, on line {1}".format(
+                self.max_depth, get_sourceline(node)))
+        if count % self.check_interval == 0:
+            self.check_time()
+            self.check_memory()
+
+    def check_images(self, count):
+        if self.max_images is not None and count > self.max_images:
+            raise LimitExceeded("More than {0} images".format(self.max_images))
+
+    def check_downloads(self, count):
+        if self.max_downloads is not None and count > self.max_downloads:
+            raise LimitExceeded("More than {0} image downloads".format(self.max_downloads))
+
+    def check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise LimitExceeded("Timed out after {0} seconds".format(self.timeout))
+
+    def check_memory(self):
+        if self.max_memory is not None:
+            used = current_memory()
+            if used > self.max_memory:
+                raise LimitExceeded("Memory use of {0} bytes is over the limit of {1}".format(
+                    used, self.max_memory))
+
+
+### Rate limiting ###
+
+class RateLimiter(object):
+    """
+    A token bucket for HTTP requests, kept in a file so that all the
+    converter processes on a machine that use the same file share one rate.
+    rate is in requests per second, and burst is how many requests can be
+    made at once after a quiet period.
+
+    The time spent waiting for the bucket is kept in waits, wait_time and
+    max_wait.
+    """
+    def __init__(self, path, rate, burst=1):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self):
+        """
+        Takes a token from the bucket, and returns how long to wait before it
+        can be used. The bucket can go into debt, so requests are served in
+        the order they were made.
+        """
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            now = time.time()
+            elapsed = max(now - state.get('time', now), 0)
+            tokens = min(state.get('tokens', self.burst) + elapsed * self.rate, self.burst) - 1
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps({'tokens': tokens, 'time': now}))
+        return -tokens / self.rate if tokens < 0 else 0
+
+    def acquire(self, sleep=time.sleep):
+        wait = self.reserve()
+        self.requests += 1
+        if wait > 0:
+            sleep(wait)
+            self.waits += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def __str__(self):
+        return "{0} requests, {1} waited for the rate limit, {2:.1f}s in total, {3:.1f}s at most".format(
+            self.requests, self.waits, self.wait_time, self.max_wait)
+
+
+### Progress and cancellation ###
+
+class Cancelled(Exception):
+    pass
+
+
+# How often to check for cancellation while waiting for other processes
+CANCELLATION_POLL_INTERVAL = 0.1
+
+
+class CancellationToken(object):
+    """
+    Lets another thread, or a progress callback, stop a conversion. The
+    conversion raises Cancelled the next time it checks the token.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled("Conversion cancelled")
+
+    def sleep(self, seconds):
+        # Like time.sleep, but wakes up when cancelled
+        self.event.wait(seconds)
+        self.check()
+
+
+class ProgressEvent(object):
+    __slots__ = ['phase', 'detail', 'count', 'total', 'title', 'elapsed', 'rate', 'eta']
+
+    def __init__(self, phase, detail, count, total, title, elapsed, rate, eta):
+        self.phase, self.detail, self.count, self.total = phase, detail, count, total
+        self.title, self.elapsed, self.rate, self.eta = title, elapsed, rate, eta
+
+    def __str__(self):
+        parts = [self.phase if self.detail is None else "{0} {1}".format(self.phase, self.detail)]
+        if self.count:
+            if self.total:
+                parts.append("{0}/{1} ({2}%)".format(self.count, self.total, self.count * 100 // self.total))
+            else:
+                parts.append(str(self.count))
+        if self.rate is not None:
+            parts.append("{0:.0f}/s".format(self.rate))
+        if self.eta is not None:
+            parts.append("ETA {0:.0f}s".format(self.eta))
+        if self.title:
+            parts.append(utf8(self.title))
+        return ', '.join(parts)
+
+
+class ProgressReporter(object):
+    """
+    Calls callback with a ProgressEvent at the start of each phase of a
+    conversion, and as it goes along, at most every interval seconds. Phases
+    are parse, descend (with counts of elements and the title of the current
+    div1), post_process (for each handler that has one), serialize, images
+    and write (with counts of files). Also checks the cancellation token.
+    """
+    # How often to report from descend, in elements
+    check_interval = 100
+
+    def __init__(self, callback=None, cancellation=None, interval=0.5):
+        self.callback = callback
+        self.cancellation = cancellation
+        self.interval = interval
+        self.phase = self.detail = self.title = None
+        self.count = 0
+        self.total = None
+        self.phase_start = self.last_report = time.time()
+
+    def is_active(self):
+        return self.callback is not None or self.cancellation is not None
+
+    def start_phase(self, phase, detail=None, total=None):
+        self.check_cancelled()
+        self.phase, self.detail, self.total = phase, detail, total
+        self.title = None
+        self.count = 0
+        self.phase_start = time.time()
+        self.report()
+
+    def update(self, count):
+        self.check_cancelled()
+        self.count = count
+        if self.callback is not None and time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        if self.callback is None:
+            return
+        self.last_report = now = time.time()
+        elapsed = now - self.phase_start
+        rate = self.count / elapsed if self.count and elapsed > 0 else None
+        eta = (self.total - self.count) / rate if rate and self.total else None
+        self.callback(ProgressEvent(self.phase, self.detail, self.count, self.total, self.title,
+                                    elapsed, rate, eta))
+
+    def check_cancelled(self):
+        if self.cancellation is not None:
+            self.cancellation.check()
+
+    def sleep(self, seconds):
+        if self.cancellation is None:
+            time.sleep(seconds)
+        else:
+            self.cancellation.sleep(seconds)
+
+
 ### Handler classes ###
 
 # Attribute default map:
@@ -89,6 +511,13 @@ ADEFS = {
 
 # Base class
 class Handler(object):
+    # True for handlers that only add text to the output parent, with
+    # ThmlToHtml.append_text. Other handlers see all the pending text added
+    # to the output first.
+    text_only = False
+    # False for handlers that never convert the children of a node, so that
+    # survey_file can skip them.
+    descends = True
     post_process_sort_order = 0
 
     def match_attributes(self, attribs):
@@ -98,6 +527,20 @@ class Handler(object):
         return (self.from_node_name == '*' or from_node.tag == self.from_node_name) and \
             self.match_attributes(from_node.attrib)
 
+    def start_document(self, converter):
+        # Called before each document is converted, to reset any state that
+        # is per document rather than per book.
+        pass
+
+    def end_document(self, converter):
+        # Called after each document is converted and serialized, to release
+        # any references to the input and output trees.
+        pass
+
+    def start_book(self, converter):
+        # Called by ThmlToHtml.reset, to reset any state that is per book.
+        pass
+
     def post_process(self, converter, output_dom):
         pass
 
@@ -129,33 +572,41 @@ def add_attrib_matcher(nodehandler, attrib_matcher):
     if attrib_matcher is not None:
         nodehandler.match_attributes = lambda self, attribs: attrib_matcher(attribs)
 
-def UNWRAP(node_name):
+def UNWRAP(node_name, attrib_matcher=None):
     """
     Returns a Handler that unwraps a node, yanking children up.
     """
     class nodehandler(Handler):
+        text_only = True
+
         def handle_node(self, converter, from_node, output_parent):
             # Care with text and tail
-            append_text(output_parent, from_node.text)
-            append_text(output_parent, from_node.tail)
+            converter.append_text(output_parent, from_node.text)
+            converter.append_text(output_parent, from_node.tail)
             return True, output_parent
 
     nodehandler.from_node_name = node_name
     nodehandler.__name__ = 'UNWRAP({0})'.format(node_name)
+    nodehandler.declarative = True
+    add_attrib_matcher(nodehandler, attrib_matcher)
     return nodehandler
 
 
-def READ(node_name):
+def READ(node_name, attrib_matcher=None):
     """
     Returns a Handler that does nothing with a node
     except read its children
     """
     class nodehandler(Handler):
+        text_only = True
+
         def handle_node(self, converter, from_node, output_parent):
             return True, output_parent
 
     nodehandler.from_node_name = node_name
     nodehandler.__name__ = "READ({0})".format(node_name)
+    nodehandler.declarative = True
+    add_attrib_matcher(nodehandler, attrib_matcher)
     return nodehandler
 
 
@@ -164,12 +615,16 @@ def DELETE(node_name, attrib_matcher=None):
     Returns a Handler that deletes a node (including children)
     """
     class nodehandler(Handler):
+        text_only = True
+        descends = False
+
         def handle_node(self, converter, from_node, output_parent):
             # We have preserve 'tail' text
-            append_text(output_parent, from_node.tail)
+            converter.append_text(output_parent, from_node.tail)
             return False, None
 
     nodehandler.__name__ = 'DELETE({0})'.format(node_name)
+    nodehandler.declarative = True
     nodehandler.from_node_name = node_name
     add_attrib_matcher(nodehandler, attrib_matcher)
     return nodehandler
@@ -212,6 +667,8 @@ def MAP(from_node_name, to_node_name, attribs, attrib_matcher=None):
                     replacement = self.attribs[k]
                     if replacement is COPY:
                         e.set(k, v)
+                        if k == 'id':
+                            converter.register_id(v)
                     elif replacement is REMOVE:
                         pass
                     else:
@@ -223,6 +680,7 @@ def MAP(from_node_name, to_node_name, attribs, attrib_matcher=None):
             return True, e
 
     nodehandler.__name__ = 'MAP({0}, {1})'.format(from_node_name, to_node_name)
+    nodehandler.declarative = True
     nodehandler.from_node_name = from_node_name
     nodehandler.to_node_name = to_node_name
     nodehandler.attribs = attribs
@@ -231,8 +689,8 @@ def MAP(from_node_name, to_node_name, attribs, attrib_matcher=None):
     return nodehandler
 
 
-def DIV(from_node_name, to_node_name, attribs):
-    cls = MAP(from_node_name, to_node_name, attribs)
+def DIV(from_node_name, to_node_name, attribs, attrib_matcher=None):
+    cls = MAP(from_node_name, to_node_name, attribs, attrib_matcher=attrib_matcher)
     class divhandler(cls):
         def handle_node(self, converter, from_node, output_parent):
             title = from_node.attrib.get('title', None)
@@ -242,9 +700,10 @@ def DIV(from_node_name, to_node_name, attribs):
             # divhandler classes and therefore multiple instances, so we have to
             # put shared state onto converter instead of self.
             if node is not None and title is not None:
-                converter.toc.count += 1
-                id = node.attrib.get('id', '_gentocid_{0}'.format(converter.toc.count))
+                generated_id = converter.next_generated_id('gentocid')
+                id = node.attrib.get('id', generated_id)
                 node.set('id', id)
+                converter.register_id(id)
                 item = TocItem(title, id, [])
 
                 # Now need to figure out which parent it belongs to.
@@ -264,6 +723,8 @@ def DIV(from_node_name, to_node_name, attribs):
 
             return descend, node
 
+    divhandler.__name__ = 'DIV({0}, {1})'.format(from_node_name, to_node_name)
+    divhandler.declarative = True
     return divhandler
 
 
@@ -278,14 +739,24 @@ class AnchorHandler(MAP('a', 'a', dplus(ADEFS, {'href': COPY, 'name': COPY}))):
                     # Strip query - only want fragment
                     href = '#' + p.fragment
                     node.attrib['href'] = href
+                    # The target may be in a different output file
+                    converter.links.add(p.fragment)
         return descend, node
 
 
+# Timeout in seconds for each HTTP request
+HTTP_TIMEOUT = 60
+# Where images are downloaded from
+CCEL_URL = 'http://www.ccel.org'
+
 class ImgHandler(MAP('img', 'img', dplus(ADEFS, {'src': COPY, 'alt': COPY, 'height': COPY, 'width': COPY}))):
     def __init__(self):
         super(ImgHandler, self).__init__()
         self.img_srcs = set()
 
+    def start_book(self, converter):
+        self.img_srcs = set()
+
     def handle_node(self, converter, from_node, output_parent):
         descend, node = super(ImgHandler, self).handle_node(converter, from_node, output_parent)
         if 'src' in node.attrib:
@@ -295,17 +766,21 @@ class ImgHandler(MAP('img', 'img', dplus(ADEFS, {'src': COPY, 'alt': COPY, 'heig
             filename = os.path.split(url.path)[-1]
             node.attrib['src'] = filename
             self.img_srcs.add((filename, src))
+            converter.limits.check_images(len(self.img_srcs))
         return descend, node
 
-    def post_process(self, converter, output_dom):
+    def fetch_images(self, converter):
         converter.img_files = []
         image_directory = converter.image_directory
+        limits = converter.limits
+        limits.start_timer()
+        downloads = 0
         ccel_book_url = None
         for n, d in converter.metadata.get('dc:identifier', []):
             if d.get('scheme', '') == 'URL':
                 ccel_book_url = n
 
-        ccel_url_base = 'http://www.ccel.org'
+        ccel_url_base = converter.image_base_url
         if ccel_book_url is not None:
             book_path = ccel_book_url.replace('.html', '')
             book_img_base = ccel_url_base + book_path + '/files/'
@@ -314,7 +789,10 @@ class ImgHandler(MAP('img', 'img', dplus(ADEFS, {'src': COPY, 'alt': COPY, 'heig
             book_img_base = None
 
         # Get all images
-        for filename, src in sorted(list(self.img_srcs)):
+        progress = converter.progress
+        progress.start_phase('images', total=len(self.img_srcs))
+        for i, (filename, src) in enumerate(sorted(list(self.img_srcs))):
+            progress.update(i)
             found = False
 
             # Look locally first:
@@ -322,11 +800,15 @@ class ImgHandler(MAP('img', 'img', dplus(ADEFS, {'src': COPY, 'alt': COPY, 'heig
                 path = os.path.join(image_directory, filename)
                 if os.path.exists(path):
                     sys.stderr.write("SUCCESS: {0} found at {1}\n".format(filename, path))
-                    converter.img_files.append({
+                    img_file = {
                         'file_name': filename,
-                        'media_type': mimetypes.guess_type(path),
-                        'content': file(path).read(),
-                        })
+                        'media_type': mimetypes.guess_type(path)[0],
+                    }
+                    if converter.image_cache is None:
+                        img_file['path'] = path  # read when written
+                    else:
+                        img_file['content'] = converter.read_image(path)
+                    converter.img_files.append(img_file)
                     found = True
 
             if found:
@@ -350,34 +832,50 @@ class ImgHandler(MAP('img', 'img', dplus(ADEFS, {'src': COPY, 'alt': COPY, 'heig
                     # Looks like it could be a page image.
                     # Attempt to get image from page scans.
                     pagenum = int(m.groups()[0])
-                    new_attempt = 'http://www.ccel.org{path}/{ext}/{pagenum:04d}={pagenum}.{ext}'.format(
-                        path=book_path, ext=ext, pagenum=pagenum)
+                    new_attempt = '{base}{path}/{ext}/{pagenum:04d}={pagenum}.{ext}'.format(
+                        base=ccel_url_base, path=book_path, ext=ext, pagenum=pagenum)
                     attempts.append(new_attempt)
 
             for url in attempts:
                 if found:
                     break
-                img_file_resp = requests.get(url)
+                progress.check_cancelled()
+                limits.check_time()
+                downloads += 1
+                limits.check_downloads(downloads)
+                if converter.rate_limiter is not None:
+                    converter.rate_limiter.acquire(sleep=progress.sleep)
+                try:
+                    img_file_resp = requests.get(url, timeout=limits.request_timeout(HTTP_TIMEOUT))
+                except requests.RequestException as e:
+                    sys.stderr.write("WARNING: Image download: {0} for {1}\n".format(e, url))
+                    if converter.rate_limiter is None:
+                        progress.sleep(converter.http_sleep_time)
+                    continue
                 if img_file_resp.status_code == 200:
                     if not img_file_resp.headers.get('content-type', '').startswith('image/'):
                         sys.stderr.write("WARNING: ignoring download for {0} which is not an image file.\n".format(url))
                     else:
                         sys.stderr.write("SUCCESS: {0} found at {1}\n".format(filename, url))
-                        converter.img_files.append({
+                        img_file = {
                             'file_name': filename,
-                            'media_type': img_file_resp.headers['content-type'],
-                            'content': img_file_resp.content,
-                        })
+                            'media_type': img_file_resp.headers['content-type'].split(';')[0].strip(),
+                        }
                         if image_directory:
                             path = os.path.join(image_directory, filename)
                             if not os.path.exists(image_directory):
                                 os.makedirs(image_directory)
                             with file(path, "w") as f:
                                 f.write(img_file_resp.content)
+                            img_file['path'] = path
+                        else:
+                            img_file['content'] = img_file_resp.content
+                        converter.img_files.append(img_file)
                         found = True
                 else:
                     sys.stderr.write("WARNING: Image download: {0} for {1}\n".format(img_file_resp.status_code, url))
-                time.sleep(converter.http_sleep_time)
+                if converter.rate_limiter is None:
+                    progress.sleep(converter.http_sleep_time)
 
 
 class CollectNodesMixin(object):
@@ -385,6 +883,14 @@ class CollectNodesMixin(object):
         super(CollectNodesMixin, self).__init__()
         self.collected_nodes = []
 
+    def start_document(self, converter):
+        super(CollectNodesMixin, self).start_document(converter)
+        self.collected_nodes = []
+
+    def end_document(self, converter):
+        super(CollectNodesMixin, self).end_document(converter)
+        self.collected_nodes = []
+
     def handle_node(self, converter, from_node, output_parent):
         descend, node = super(CollectNodesMixin, self).handle_node(converter, from_node, output_parent)
         if node is not None:
@@ -399,56 +905,296 @@ class LineHandler(CollectNodesMixin,
         for node in self.collected_nodes:
             node.append(etree.Element('br'))
 
+### Scripture references ###
+
+# (OSIS abbreviation, full name, other abbreviations) in canonical order.
+BIBLE_BOOKS = [
+    ('Gen', 'Genesis', ['Ge', 'Gn']),
+    ('Exod', 'Exodus', ['Ex', 'Exo']),
+    ('Lev', 'Leviticus', ['Le', 'Lv']),
+    ('Num', 'Numbers', ['Nu', 'Nm', 'Numb']),
+    ('Deut', 'Deuteronomy', ['De', 'Dt', 'Deu']),
+    ('Josh', 'Joshua', ['Jos', 'Jsh']),
+    ('Judg', 'Judges', ['Jdg', 'Jg', 'Jdgs']),
+    ('Ruth', 'Ruth', ['Rth', 'Ru']),
+    ('1Sam', '1 Samuel', ['1Sa', '1Sm']),
+    ('2Sam', '2 Samuel', ['2Sa', '2Sm']),
+    ('1Kgs', '1 Kings', ['1Ki', '1Kg', '1Kin']),
+    ('2Kgs', '2 Kings', ['2Ki', '2Kg', '2Kin']),
+    ('1Chr', '1 Chronicles', ['1Ch', '1Chron']),
+    ('2Chr', '2 Chronicles', ['2Ch', '2Chron']),
+    ('Ezra', 'Ezra', ['Ezr']),
+    ('Neh', 'Nehemiah', ['Ne']),
+    ('Esth', 'Esther', ['Es', 'Est']),
+    ('Job', 'Job', ['Jb']),
+    ('Ps', 'Psalms', ['Psa', 'Pss', 'Psalm', 'Pslm']),
+    ('Prov', 'Proverbs', ['Pr', 'Prv', 'Pro']),
+    ('Eccl', 'Ecclesiastes', ['Ec', 'Ecc', 'Eccles', 'Qoh']),
+    ('Song', 'Song of Solomon', ['So', 'SS', 'Cant', 'Canticles']),
+    ('Isa', 'Isaiah', ['Is']),
+    ('Jer', 'Jeremiah', ['Je', 'Jr']),
+    ('Lam', 'Lamentations', ['La']),
+    ('Ezek', 'Ezekiel', ['Eze', 'Ezk']),
+    ('Dan', 'Daniel', ['Da', 'Dn']),
+    ('Hos', 'Hosea', ['Ho']),
+    ('Joel', 'Joel', ['Jl']),
+    ('Amos', 'Amos', ['Am']),
+    ('Obad', 'Obadiah', ['Ob', 'Obd']),
+    ('Jonah', 'Jonah', ['Jon', 'Jnh']),
+    ('Mic', 'Micah', ['Mi']),
+    ('Nah', 'Nahum', ['Na']),
+    ('Hab', 'Habakkuk', ['Hb']),
+    ('Zeph', 'Zephaniah', ['Zep', 'Zp']),
+    ('Hag', 'Haggai', ['Hg']),
+    ('Zech', 'Zechariah', ['Zec', 'Zc']),
+    ('Mal', 'Malachi', ['Ml']),
+    ('Tob', 'Tobit', ['Tb']),
+    ('Jdt', 'Judith', ['Jth']),
+    ('AddEsth', 'Additions to Esther', []),
+    ('Wis', 'Wisdom', ['Wisd']),
+    ('Sir', 'Sirach', ['Ecclus']),
+    ('Bar', 'Baruch', []),
+    ('EpJer', 'Letter of Jeremiah', []),
+    ('PrAzar', 'Prayer of Azariah', []),
+    ('Sus', 'Susanna', []),
+    ('Bel', 'Bel and the Dragon', []),
+    ('1Macc', '1 Maccabees', ['1Mac', '1Ma']),
+    ('2Macc', '2 Maccabees', ['2Mac', '2Ma']),
+    ('PrMan', 'Prayer of Manasseh', []),
+    ('1Esd', '1 Esdras', []),
+    ('2Esd', '2 Esdras', []),
+    ('Matt', 'Matthew', ['Mt', 'Mat']),
+    ('Mark', 'Mark', ['Mk', 'Mr', 'Mar']),
+    ('Luke', 'Luke', ['Lk', 'Lu']),
+    ('John', 'John', ['Jn', 'Jno', 'Joh']),
+    ('Acts', 'Acts', ['Ac', 'Act']),
+    ('Rom', 'Romans', ['Ro', 'Rm']),
+    ('1Cor', '1 Corinthians', ['1Co']),
+    ('2Cor', '2 Corinthians', ['2Co']),
+    ('Gal', 'Galatians', ['Ga']),
+    ('Eph', 'Ephesians', ['Ephes']),
+    ('Phil', 'Philippians', ['Php', 'Pp']),
+    ('Col', 'Colossians', ['Co']),
+    ('1Thess', '1 Thessalonians', ['1Th', '1Thes']),
+    ('2Thess', '2 Thessalonians', ['2Th', '2Thes']),
+    ('1Tim', '1 Timothy', ['1Ti', '1Tm']),
+    ('2Tim', '2 Timothy', ['2Ti', '2Tm']),
+    ('Titus', 'Titus', ['Tit']),
+    ('Phlm', 'Philemon', ['Philem', 'Phm']),
+    ('Heb', 'Hebrews', ['He']),
+    ('Jas', 'James', ['Jam', 'Jm']),
+    ('1Pet', '1 Peter', ['1Pe', '1Pt']),
+    ('2Pet', '2 Peter', ['2Pe', '2Pt']),
+    ('1John', '1 John', ['1Jn', '1Jo', '1Jno']),
+    ('2John', '2 John', ['2Jn', '2Jo', '2Jno']),
+    ('3John', '3 John', ['3Jn', '3Jo', '3Jno']),
+    ('Jude', 'Jude', ['Jud']),
+    ('Rev', 'Revelation', ['Re', 'Rv', 'Apoc']),
+]
+
+ROMAN_BOOK_NUMBERS = {'i': '1', 'ii': '2', 'iii': '3'}
+
+def _book_key(name):
+    return name.replace(' ', '').lower()
+
+def _make_book_table():
+    table = {}
+    for osis, full_name, others in BIBLE_BOOKS:
+        for name in [osis, full_name] + others:
+            table[_book_key(name)] = full_name
+    return table
+
+# Lookup table from any known spelling (lower case, without spaces) to the full
+# book name.
+BOOK_NAMES = _make_book_table()
+
+# Leading book name in a human written passage e.g. 'Gen. 1:1', '1 Cor. 13',
+# 'II Kings 2:11', 'Song of Solomon 2:1'
+PASSAGE_BOOK_RE = re.compile(r'^\s*(?:([123])\s*|(iii|ii|i)(?:\s+|\.\s*))?([A-Za-z]+(?: of [A-Za-z]+)?)\.?\s*', re.IGNORECASE)
+
+# One endpoint of an osisRef e.g. 'Gen.1.1', 'John.3', '1Cor.13.4!a'
+OSIS_REF_RE = re.compile(r'^([1-3]?[A-Za-z]+)(?:\.(\d+))?(?:\.(\d+))?')
+
+
+def expand_book_name(book):
+    """
+    Returns the full name of a book given any abbreviation in BIBLE_BOOKS,
+    or None if it is not recognised.
+    """
+    return BOOK_NAMES.get(_book_key(book))
+
+
 def fix_passage_ref(ref):
-    # TODO handle osisRef or passage better - expand abbreviations
-    return utf8(ref).replace('.', ' ')
+    """
+    Normalizes a human written 'passage' attribute, expanding the book
+    abbreviation if we recognise it.
+    """
+    ref = utf8(ref)
+    m = PASSAGE_BOOK_RE.match(ref)
+    if m:
+        number, roman_number, book = m.groups()
+        if roman_number is not None:
+            number = ROMAN_BOOK_NUMBERS[roman_number.lower()]
+        if number is not None:
+            book = number + book
+        full_name = expand_book_name(book)
+        if full_name is not None:
+            ref = full_name + ' ' + ref[m.end():]
+    return ref.replace('.', ' ').strip()
+
+
+def fix_osis_ref(ref):
+    """
+    Normalizes an 'osisRef' attribute (e.g. 'Bible:Gen.1.1-Gen.1.3') into a
+    human readable passage (e.g. 'Genesis 1:1-3').
+    """
+    passages = []
+    for part in utf8(ref).split():
+        if ':' in part:
+            part = part.split(':', 1)[1]
+        endpoints = []
+        for endpoint in part.split('-'):
+            m = OSIS_REF_RE.match(endpoint)
+            if m is None:
+                endpoints.append((endpoint, None, None))
+                continue
+            book, chapter, verse = m.groups()
+            endpoints.append((expand_book_name(book) or book, chapter, verse))
+
+        book, chapter, verse = endpoints[0]
+        text = book
+        if chapter is not None:
+            text += ' ' + chapter
+            if verse is not None:
+                text += ':' + verse
+        for end_book, end_chapter, end_verse in endpoints[1:]:
+            if end_book != book:
+                text += '-' + end_book + (' ' + end_chapter if end_chapter else '') \
+                    + (':' + end_verse if end_verse else '')
+            elif end_chapter != chapter or end_verse is None:
+                text += '-' + (end_chapter or '') + (':' + end_verse if end_verse else '')
+            else:
+                text += '-' + end_verse
+        passages.append(text)
+    return '; '.join(passages)
+
+
+class ScripRefResolver(object):
+    """
+    Turns scripRef 'passage' and 'osisRef' values into links, caching the
+    results since the same passages are referenced over and over.
+    """
+    url_tpl = 'https://www.biblegateway.com/passage/?search={0}&version={1}'
+
+    def __init__(self, maxsize=10000, version='NIV'):
+        self.maxsize = maxsize
+        self.version = version
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, passage=None, osis_ref=None):
+        """
+        Returns (normalized passage, url), or None if neither value is given.
+        """
+        key = (passage, osis_ref)
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = self._resolve(passage, osis_ref)
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self.cache[key] = value # most recently used goes last
+        return value
+
+    def resolve_many(self, refs):
+        """
+        Resolves a list of (passage, osis_ref) pairs, returning a list of
+        results in the same order.
+        """
+        seen = {}
+        retval = []
+        for ref in refs:
+            if ref not in seen:
+                seen[ref] = self.resolve(*ref)
+            retval.append(seen[ref])
+        return retval
+
+    def _resolve(self, passage, osis_ref):
+        if passage is not None:
+            normalized = fix_passage_ref(passage)
+        elif osis_ref is not None:
+            normalized = fix_osis_ref(osis_ref)
+        else:
+            return None
+        return normalized.decode('utf-8'), self.url_tpl.format(urllib.quote(normalized), self.version)
+
 
 class ScripRefHandler(MAP('scripRef', 'a',
                           dplus(ADEFS, {'passage': REMOVE,
                                         'parsed': REMOVE,
                                         'version': REMOVE,
                                         'osisRef': REMOVE}))):
+    def __init__(self):
+        super(ScripRefHandler, self).__init__()
+        self.resolver = ScripRefResolver()
+
     def handle_node(self, converter, from_node, output_parent):
         descend, node = super(ScripRefHandler, self).handle_node(converter, from_node, output_parent)
-        if node is not None and 'passage' in from_node.attrib:
-            node.set('href',
-                     'https://www.biblegateway.com/passage/?search={0}&version=NIV'.format(
-                         urllib.quote(fix_passage_ref(from_node.attrib['passage']))))
+        resolved = self.resolver.resolve(from_node.attrib.get('passage', None),
+                                         from_node.attrib.get('osisRef', None))
+        if node is not None and resolved is not None:
+            node.set('href', resolved[1])
+            converter.index.pending.append((resolved[0], node))
         else:
             sys.stderr.write("WARNING: can't get 'passage' from scripRef attribs {0} on line {1}\n".format(from_node.attrib, get_sourceline(from_node)))
             node.set('href', '#')
         return descend, node
 
+    # Before NoteHandler moves the ids in notes out of the document
+    post_process_sort_order = -50
+
+    def post_process(self, converter, output_dom):
+        # References only get ids, and index entries, if there will be a
+        # scripture index to link to them.
+        index = converter.index
+        if converter.index_page or converter.book_scripture_index or \
+                any(t == 'scripRef' for t, node in index.placeholders):
+            for label, node in index.pending:
+                index.add('scripRef', label, converter.ensure_id(node, 'genrid'))
+        index.pending = []
+
 
 class NoteHandler(Handler):
     from_node_name = 'note'
     def __init__(self):
         self.notes = []
-        self.generated_id_num = 0
-        self.generated_anchor_id_num = 0
 
-    def next_id(self):
-        self.generated_id_num += 1
-        return "_genid_{0}".format(self.generated_id_num)
+    def start_document(self, converter):
+        self.notes = []
 
-    def next_anchor_id(self):
-        self.generated_anchor_id_num += 1
-        return "_genaid_{0}".format(self.generated_anchor_id_num)
+    def end_document(self, converter):
+        self.notes = []
 
     def handle_node(self, converter, from_node, output_parent):
         # Build note
         note_id = from_node.attrib.get('id', None)
         if note_id is None:
-            note_id = self.next_id()
+            note_id = converter.next_generated_id('genid')
         note = etree.Element("div", {'id': note_id,
                                      'class': 'note'})
         set_sourceline(note, get_sourceline(from_node))
+        converter.register_id(note_id)
 
         # Build anchor
         anchor = etree.Element("a",
                                {'href': '#' + note_id,
-                                'id': self.next_anchor_id(),
+                                'id': converter.next_generated_id('genaid'),
                             })
+        converter.register_id(anchor.attrib['id'])
         set_sourceline(anchor, get_sourceline(from_node))
         anchor.tail = from_node.tail
         sup = etree.Element("sup")
@@ -470,7 +1216,7 @@ class NoteHandler(Handler):
         return True, note # Need the children elements of <note> to be added
 
     def post_process(self, converter, output_dom):
-        note_containers = {}
+        note_containers = OrderedDict()
 
         for anchor, note in self.notes:
             div = find_outermost_div(anchor)
@@ -479,12 +1225,33 @@ class NoteHandler(Handler):
                 continue
             if div not in note_containers:
                 container = etree.Element('div', attrib={'class': 'notes'})
-                div.append(container)
+                if converter.separate_notes:
+                    toc_item = converter.toc.node_map.get(div)
+                    if toc_item is not None:
+                        etree.SubElement(container, 'h2').text = toc_item.title
+                else:
+                    div.append(container)
                 note_containers[div] = container
             else:
                 container = note_containers[div]
             container.append(note)
 
+        if converter.separate_notes and note_containers:
+            # The notes go in another file, see make_notes_page. Their ids
+            # move with them, and links in both directions are fixed up by
+            # resolve_cross_file_links.
+            ids, links, fragments = set(), set(), []
+            for container in note_containers.values():
+                for node in container.iter():
+                    if node.get('id') is not None:
+                        ids.add(node.get('id'))
+                    if node.get('href', '').startswith('#'):
+                        links.add(node.get('href')[1:])
+                fragments.append(etree.tostring(container, encoding='utf-8'))
+            converter.ids -= ids
+            converter.links |= ids
+            converter.notes = HtmlDoc(''.join(fragments), None, ids=ids, links=links)
+
 
 def find_outermost_div(node, last_div=None):
     if node is None:
@@ -494,35 +1261,200 @@ def find_outermost_div(node, last_div=None):
     return find_outermost_div(node.getparent(), last_div=last_div)
 
 
+class IndexHandler(MAP('index', 'a', dplus(ADEFS, {'type': REMOVE,
+                                                   'subject1': REMOVE,
+                                                   'subject2': REMOVE,
+                                                   'subject3': REMOVE,
+                                                   'level1': REMOVE,
+                                                   'level2': REMOVE,
+                                                   'level3': REMOVE,
+                                                   'level4': REMOVE}))):
+    # Marks a place to be listed in a subject (or other) index
+    def handle_node(self, converter, from_node, output_parent):
+        descend, node = super(IndexHandler, self).handle_node(converter, from_node, output_parent)
+        attrib = from_node.attrib
+        levels = [attrib[k] for k in ['subject1', 'subject2', 'subject3',
+                                      'level1', 'level2', 'level3', 'level4']
+                  if attrib.get(k, '').strip()]
+        if levels:
+            converter.index.add(attrib.get('type', 'subject'), ', '.join(levels),
+                                converter.ensure_id(node, 'genrid'))
+        else:
+            sys.stderr.write("WARNING: no subject for index on line {0}\n".format(get_sourceline(from_node)))
+        return descend, node
+
+
+class InsertIndexHandler(MAP('insertIndex', 'div', dplus(ADEFS, {'type': REMOVE,
+                                                                 ADD: [('class', 'index')]}))):
+    post_process_sort_order = 100
+
+    def handle_node(self, converter, from_node, output_parent):
+        descend, node = super(InsertIndexHandler, self).handle_node(converter, from_node, output_parent)
+        set_sourceline(node, get_sourceline(from_node))
+        converter.index.placeholders.append((from_node.attrib.get('type', 'subject'), node))
+        return descend, node
+
+    def post_process(self, converter, output_dom):
+        # The entries of this document. In a book of several documents, the
+        # placeholders are filled again with the entries of all of them, see
+        # fill_index_placeholders.
+        index = converter.index
+        for index_type, node in index.placeholders:
+            index.placeholder_ids.append((index_type, converter.ensure_id(node, 'genxid'),
+                                          get_sourceline(node)))
+            index.placed.add(index_type)
+            if index_type in index.entries:
+                add_index_entries(node, [(label, ['#' + id for id in ids])
+                                         for label, ids in index.sorted_entries(index_type)])
+
+
+def add_index_entries(parent, entries):
+    """
+    Adds index entries to an output node. entries is a list of
+    (label, [href]) pairs.
+    """
+    ns = etree.QName(parent).namespace
+    prefix = '{%s}' % ns if ns else ''
+    for label, hrefs in entries:
+        p = etree.SubElement(parent, prefix + 'p', {'class': 'indexentry'})
+        p.text = label + ': '
+        for i, href in enumerate(hrefs):
+            a = etree.SubElement(p, prefix + 'a', {'href': href})
+            a.text = str(i + 1)
+            if i < len(hrefs) - 1:
+                a.tail = ', '
+
+
+def scripture_sort_key(passage):
+    """
+    Sort key that puts normalized passages (see fix_passage_ref) in canonical
+    order.
+    """
+    for name, order in BOOK_ORDER:
+        if passage.startswith(name):
+            return (order, tuple(int(n) for n in re.findall(r'\d+', passage[len(name):])), passage)
+    return (len(BIBLE_BOOKS), (), passage)
+
+
+# (full name, canonical position), longest names first to find the best prefix
+BOOK_ORDER = sorted([(full_name, i) for i, (osis, full_name, others) in enumerate(BIBLE_BOOKS)],
+                    key=lambda (name, i): -len(name))
+
+INDEX_TITLES = {
+    'scripRef': 'Index of Scripture References',
+    'subject': 'Subject Index',
+}
+
+
+def add_dc_metadata(metadata, node):
+    """
+    Adds the metadata in a DC.* node into a metadata dictionary
+    (of name -> list of (value, attribs) pairs), skipping duplicates.
+    """
+    if node.text is not None:
+        item = (node.text, dict(node.attrib))
+        name = node.tag.lower().replace('.', ':')
+        lst = metadata.setdefault(name, [])
+        if item not in lst:
+            lst.append(item)
+
+
+def merge_metadata(metadata, other):
+    """
+    Merges the metadata dictionary other into metadata, with the same rules
+    for duplicates as add_dc_metadata.
+    """
+    for name, items in other.items():
+        lst = metadata.setdefault(name, [])
+        for item in items:
+            if item not in lst:
+                lst.append(item)
+    return metadata
+
+
+def read_metadata(filename):
+    """
+    Returns the DC metadata of a ThML file, in the same format as
+    ThmlToHtml.metadata, without converting the file. Parsing stops when
+    ThML.body is reached.
+    """
+    metadata = {}
+    for event, node in iterparse_thml(filename, events=('start', 'end')):
+        if event == 'start':
+            if node.tag == 'ThML.body':
+                break
+            continue
+        parent = node.getparent()
+        if parent is not None and parent.tag == 'DC':
+            add_dc_metadata(metadata, node)
+    return metadata
+
+
 class DCMetaDataCollector(Handler):
     post_process_sort_order = -100
+    descends = False
 
     def __init__(self):
         self.dc_metadata = defaultdict(list)
 
+    def start_book(self, converter):
+        self.dc_metadata = defaultdict(list)
+
     def match(self, from_node):
         parent = from_node.getparent()
         return parent is not None and parent.tag == "DC"
 
     def handle_node(self, converter, from_node, output_parent):
-        if from_node.text is not None:
-            item = (from_node.text, dict(from_node.attrib))
-            name = from_node.tag.lower().replace('.', ':')
-            if item not in self.dc_metadata[name]:
-                self.dc_metadata[name].append(item)
+        add_dc_metadata(self.dc_metadata, from_node)
         return False, None
 
     def post_process(self, converter, output_dom):
-        if 'dc:title' in self.dc_metadata:
-            # Insert a 'title' element into doc, it's required for HTML validity
-            head = output_dom.find('head')
-            if head is not None:
-                title = etree.Element('title')
-                title.text = self.dc_metadata['dc:title'][0][0]
-                head.append(title)
+        # A head with a title is required for HTML validity
+        if output_dom.tag == 'html' and (converter.full_xml or output_dom.find('head') is not None):
+            ensure_head(converter, output_dom)
         converter.metadata.update(self.dc_metadata)
 
 
+def ensure_head(converter, output_dom):
+    """
+    Returns the head of an output document, adding it if needed, with a
+    title: the book's, or else that of the first top level div.
+    """
+    head = output_dom.find('head')
+    if head is None:
+        head = etree.Element('head')
+        output_dom.insert(0, head)
+    if head.find('title') is None:
+        dc_metadata = converter.get_handler(DCMetaDataCollector).dc_metadata
+        if dc_metadata.get('dc:title'):
+            text = dc_metadata['dc:title'][0][0]
+        elif converter.toc.items:
+            text = converter.toc.items[0].title
+        else:
+            text = "Untitled"
+        etree.SubElement(head, 'title').text = text
+    return head
+
+
+class StyleHandler(MAP('style', 'style', {'type':COPY},
+                        attrib_matcher=lambda attrib: attrib.get('type', '')=='text/css')):
+    """
+    Copies CSS style blocks, or with shared_stylesheet collects them for the
+    book's stylesheet (see make_stylesheet) and links to that instead.
+    """
+    def handle_node(self, converter, from_node, output_parent):
+        if not converter.shared_stylesheet:
+            return super(StyleHandler, self).handle_node(converter, from_node, output_parent)
+        converter.css.append(from_node.text or '')
+        converter.append_text(output_parent, from_node.tail)
+        return False, None
+
+    def post_process(self, converter, output_dom):
+        if not converter.shared_stylesheet or output_dom.tag != 'html':
+            return
+        add_stylesheet_link(ensure_head(converter, output_dom))
+
+
 class Fallback(UNWRAP('*')):
     pass
 
@@ -585,14 +1517,15 @@ HANDLERS = [
     UNWRAP('unclear'),
     UNWRAP('added'),
     DELETE('deleted'),
-    DELETE('insertIndex'), # TODO - create an index where it is missing?
+    InsertIndexHandler,
+    IndexHandler,
 
     ## HTML elements
     # Header:
     MAP('title', 'title', {}),
     DELETE('link'),
     DELETE('script'),
-    MAP('style', 'style', {'type':COPY}, attrib_matcher=lambda attrib: attrib.get('type', '')=='text/css'),
+    StyleHandler,
     DELETE('style', attrib_matcher=lambda attrib: attrib.get('type', '')=='text/xcss'),
 
 
@@ -665,12 +1598,202 @@ HANDLERS = [
 ]
 
 
+### Handler specs ###
+
+class HandlerSpecError(Exception):
+    pass
+
+
+# Attribute maps that rules in a handler spec can start from
+SPEC_ATTRIBUTE_SETS = {
+    'ADEFS': ADEFS,
+    'DIVADEFS': DIVADEFS,
+    'TADEFS': TADEFS,
+    'none': {},
+}
+
+SPEC_ACTIONS = {
+    'map': lambda rule: MAP(rule['tag'], rule.get('to', rule['tag']), spec_attribs(rule),
+                            attrib_matcher=spec_attrib_matcher(rule)),
+    'div': lambda rule: DIV(rule['tag'], rule.get('to', 'div'), spec_attribs(rule),
+                            attrib_matcher=spec_attrib_matcher(rule)),
+    'unwrap': lambda rule: UNWRAP(rule['tag'], attrib_matcher=spec_attrib_matcher(rule)),
+    'read': lambda rule: READ(rule['tag'], attrib_matcher=spec_attrib_matcher(rule)),
+    'delete': lambda rule: DELETE(rule['tag'], attrib_matcher=spec_attrib_matcher(rule)),
+}
+
+
+# The type of each field of a rule, checked by check_spec_rule
+def is_string(value):
+    return isinstance(value, basestring)
+
+def is_string_list(value):
+    return isinstance(value, list) and all(is_string(v) for v in value)
+
+def is_string_dict(value, allow_null=False):
+    return isinstance(value, dict) and all(is_string(v) or (allow_null and v is None) for v in value.values())
+
+SPEC_FIELDS = {
+    'tag': ("a string", is_string),
+    'action': ("a string", is_string),
+    'to': ("a string", is_string),
+    'attributes': ("a string", is_string),
+    'copy': ("a list of strings", is_string_list),
+    'remove': ("a list of strings", is_string_list),
+    'add': ("an object with string values", is_string_dict),
+    'match': ("an object with string or null values", lambda v: is_string_dict(v, allow_null=True)),
+}
+
+# Fields that only make sense for actions that create an element
+SPEC_ELEMENT_FIELDS = set(['to', 'attributes', 'copy', 'remove', 'add'])
+
+
+def check_spec_rule(rule):
+    text = json.dumps(rule, sort_keys=True)
+    if not isinstance(rule, dict) or 'tag' not in rule:
+        raise HandlerSpecError("rule {0} has no tag".format(text))
+    for k, v in sorted(rule.items()):
+        if k not in SPEC_FIELDS:
+            raise HandlerSpecError("rule {0} has unknown field '{1}'".format(text, k))
+        description, check = SPEC_FIELDS[k]
+        if not check(v):
+            raise HandlerSpecError("'{0}' in rule {1} should be {2}".format(k, text, description))
+    if rule.get('action') not in SPEC_ACTIONS:
+        raise HandlerSpecError("rule {0} has unknown action, expected one of {1}".format(
+            text, ', '.join(sorted(SPEC_ACTIONS))))
+    for k in sorted(SPEC_ELEMENT_FIELDS & set(rule)):
+        if rule['action'] not in ['map', 'div']:
+            raise HandlerSpecError("'{0}' can't be used with action '{1}', in rule {2}".format(
+                k, rule['action'], text))
+    if rule.get('attributes', 'ADEFS') not in SPEC_ATTRIBUTE_SETS:
+        raise HandlerSpecError("unknown attributes '{0}' in rule {1}, expected one of {2}".format(
+            rule['attributes'], text, ', '.join(sorted(SPEC_ATTRIBUTE_SETS))))
+
+
+def spec_attribs(rule):
+    attribs = dplus(SPEC_ATTRIBUTE_SETS[rule.get('attributes', 'ADEFS')],
+                    dict([(k, COPY) for k in rule.get('copy', [])] +
+                         [(k, REMOVE) for k in rule.get('remove', [])]))
+    if rule.get('add'):
+        attribs[ADD] = attribs.get(ADD, []) + sorted(rule['add'].items())
+    return attribs
+
+
+def spec_attrib_matcher(rule):
+    """
+    'match' maps attribute names to the values they must have, or to null for
+    attributes that must be absent.
+    """
+    match = rule.get('match')
+    if not match:
+        return None
+    items = sorted(match.items())
+    return lambda attrib: all(attrib.get(k) == v for k, v in items)
+
+
+def compile_handler_spec(spec):
+    """
+    Turns a handler spec, a list of rules like
+    {"tag": "term", "action": "map", "to": "dfn", "copy": ["title"]}, into a
+    list of Handler classes.
+    """
+    if not isinstance(spec, list):
+        raise HandlerSpecError("a handler spec must be a list of rules")
+    handlers = []
+    for rule in spec:
+        check_spec_rule(rule)
+        handlers.append(SPEC_ACTIONS[rule['action']](rule))
+    return handlers
+
+
+def merge_handlers(default_handlers, spec_handlers):
+    """
+    Returns default_handlers with the handlers for each tag that spec_handlers
+    has rules for replaced by those rules, at the place of the first one.
+    Only handlers made by MAP, DIV, UNWRAP, READ and DELETE can be replaced.
+    """
+    spec_tags = OrderedDict()
+    for cls in spec_handlers:
+        spec_tags.setdefault(cls.from_node_name, []).append(cls)
+    handlers = []
+    for cls in default_handlers:
+        tag = getattr(cls, 'from_node_name', None)
+        if tag not in spec_tags:
+            handlers.append(cls)
+        elif not cls.__dict__.get('declarative', False):
+            raise HandlerSpecError("{0} is handled by {1}, which can't be replaced".format(tag, cls.__name__))
+        elif spec_tags[tag] is not None:
+            handlers.extend(spec_tags[tag])
+            spec_tags[tag] = None
+    for tag, classes in spec_tags.items():
+        if classes is not None:
+            handlers.extend(classes)
+    return handlers
+
+
+# sha1 of handler spec file -> Handler classes
+_handler_spec_cache = {}
+
+def load_handler_spec(path):
+    """
+    Returns the Handler classes for the built-in handlers as modified by the
+    JSON handler spec in path, or the built-in HANDLERS for None. Specs are
+    compiled once per process for each distinct content.
+    """
+    if path is None:
+        return HANDLERS
+    with file(path, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha1(content).hexdigest()
+    if key not in _handler_spec_cache:
+        try:
+            spec = json.loads(content)
+        except ValueError as e:
+            raise HandlerSpecError("{0}: {1}".format(path, e))
+        _handler_spec_cache[key] = merge_handlers(HANDLERS, compile_handler_spec(spec))
+    return _handler_spec_cache[key]
+
+
+class HandlerDispatch(object):
+    """
+    Finds the handlers to try for each tag, in the order they are listed.
+    Handlers for any tag ('*') or with their own match method, such as
+    DCMetaDataCollector, are tried for every tag.
+    """
+    def __init__(self, handlers):
+        by_tag = defaultdict(list)
+        generic = []
+        for i, handler in enumerate(handlers):
+            tag = getattr(handler, 'from_node_name', None)
+            if tag is None or tag == '*' or type(handler).match.im_func is not Handler.match.im_func:
+                generic.append((i, handler))
+            else:
+                by_tag[tag].append((i, handler))
+        self.generic = [h for i, h in generic]
+        self.by_tag = dict((tag, [h for i, h in sorted(lst + generic)]) for tag, lst in by_tag.items())
+
+    def get(self, tag):
+        return self.by_tag.get(tag, self.generic)
+
+
 class HtmlDoc(object):
-    def __init__(self, html, toc):
-        self.html, self.toc = html, toc
+    __slots__ = ['html', 'toc', 'index', 'ids', 'links', 'notes', 'css']
+
+    def __init__(self, html, toc, index=None, ids=None, links=None, notes=None, css=None):
+        self.html, self.toc, self.index = html, toc, index
+        # ids defined in the document, and fragments that it links to
+        self.ids = set() if ids is None else ids
+        self.links = set() if links is None else links
+        # Notes taken out of the document with separate_notes, as an HtmlDoc
+        # holding serialized 'notes' divs.
+        self.notes = notes
+        # CSS taken out of the document with shared_stylesheet
+        self.css = css
 
 
 class TocItem(object):
+    __slots__ = ['title', 'id', 'children']
+
     def __init__(self, title, id, children):
         self.title, self.id, self.children = title, id, children
 
@@ -685,50 +1808,261 @@ class TocItem(object):
                                                repr(self.children))
 
 class Toc(object):
+    __slots__ = ['items', 'node_map']
+
     def __init__(self):
         self.items = []
-        self.count = 0
         self.node_map = {}
 
 
+class Index(object):
+    """
+    Index entries for a document, collected while converting. entries maps
+    index type (e.g. 'scripRef', 'subject') to a dictionary from label to a
+    list of anchor ids.
+    """
+    __slots__ = ['entries', 'placeholders', 'placeholder_ids', 'placed', 'pending']
+
+    def __init__(self):
+        self.entries = {}
+        # insertIndex output nodes while converting, and (index type, id,
+        # line) for each of them after
+        self.placeholders = []
+        self.placeholder_ids = []
+        self.placed = set()
+        # (label, output node) for scripture references that are not indexed
+        # yet, see ScripRefHandler.post_process
+        self.pending = []
+
+    def add(self, index_type, label, id):
+        self.entries.setdefault(index_type, {}).setdefault(label, []).append(id)
+
+    def sorted_entries(self, index_type):
+        labels = self.entries[index_type]
+        key = scripture_sort_key if index_type == 'scripRef' else lambda label: label.lower()
+        return [(label, labels[label]) for label in sorted(labels, key=key)]
+
+    def unplaced_types(self):
+        return [t for t in sorted(self.entries) if t not in self.placed]
+
+
 DOCTYPE = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n"""
 
 class ThmlToHtml(object):
-    def __init__(self, download_images=False, http_sleep_time=1, image_directory="", ignore_downloaded_images=False):
+    def __init__(self, download_images=False, http_sleep_time=1, image_directory="", ignore_downloaded_images=False,
+                 limits=None, cache_images=False, progress=None, separate_notes=False,
+                 shared_stylesheet=False, rate_limit_file=None, image_base_url=CCEL_URL,
+                 handler_spec=None, index_page=True):
+        """
+        With rate_limit_file, image downloads are limited to one per
+        http_sleep_time seconds across all the converters using the same
+        file, see RateLimiter. image_base_url is where images are downloaded
+        from. handler_spec is the path of a JSON handler spec, see
+        load_handler_spec. With index_page=False, scripture references are
+        only indexed in books with an insertIndex for them, see
+        transform_files.
+        """
+        # Keep the options so that other processes can create an equivalent
+        # converter, see transform_files
+        self.options = dict(download_images=download_images,
+                            http_sleep_time=http_sleep_time,
+                            image_directory=image_directory,
+                            ignore_downloaded_images=ignore_downloaded_images,
+                            limits=limits,
+                            cache_images=cache_images,
+                            separate_notes=separate_notes,
+                            shared_stylesheet=shared_stylesheet,
+                            rate_limit_file=rate_limit_file,
+                            image_base_url=image_base_url,
+                            handler_spec=handler_spec,
+                            index_page=index_page)
         self.download_images = download_images
         self.http_sleep_time = http_sleep_time
         self.image_directory = image_directory
         self.ignore_downloaded_images = ignore_downloaded_images
-        self.handlers = [cls() for cls in HANDLERS]
+        self.limits = Limits() if limits is None else limits
+        self.separate_notes = separate_notes
+        self.shared_stylesheet = shared_stylesheet
+        self.index_page = index_page
+        # Whether a file of the book being converted has a scripture index
+        self.book_scripture_index = False
+        self.image_base_url = image_base_url
+        if rate_limit_file and http_sleep_time > 0:
+            self.rate_limiter = RateLimiter(rate_limit_file, 1.0 / http_sleep_time)
+        else:
+            self.rate_limiter = None
+        # Not passed on to other processes
+        self.progress = ProgressReporter() if progress is None else progress
+        self.handlers = [cls() for cls in load_handler_spec(handler_spec)]
+        self.dispatch = HandlerDispatch(self.handlers)
         self.metadata = {}
+        self.img_files = []
+        # Local images are normally read when the epub is written. With
+        # cache_images, they are read when found and kept in memory, for
+        # converters that are reused.
+        self.image_cache = {} if cache_images else None
         self.fallback = Fallback()
 
-    def transform(self, thml, full_xml=False):
+    def reset(self):
+        """
+        Forgets the book converted so far, so that the converter can be
+        reused for another book, or the same book again. Caches are kept.
+        """
+        self.metadata = {}
+        self.img_files = []
+        self.book_scripture_index = False
+        for handler in self.handlers:
+            handler.start_book(self)
+
+    def read_image(self, path):
+        """
+        Returns the content of a local image file, cached while the file is
+        unchanged.
+        """
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+        cached = self.image_cache.get(path)
+        if cached is None or cached[0] != key:
+            with file(path, 'rb') as f:
+                cached = (key, f.read())
+            self.image_cache[path] = cached
+        return cached[1]
+
+    def transform(self, thml, full_xml=False, doc_num=1, images=True):
+        """
+        Converts a document given as a string. Unless images is False, the
+        images of the documents converted so far are then found or downloaded
+        into img_files (see fetch_images).
+        """
+        self.limits.start_timer()
+        self.limits.check_input_bytes(len(utf8(thml)), "Input")
+        self.progress.start_phase('parse')
+        input_root = etree.fromstring(thml, get_parser(huge_tree=not self.limits.is_active()))
+        retval = self.transform_root(input_root, full_xml=full_xml, doc_num=doc_num)
+        if images:
+            self.fetch_images()
+        return retval
+
+    def transform_file(self, filename, full_xml=False, doc_num=1, images=True):
+        """
+        Converts a document from a file, as transform.
+        """
+        self.limits.start_timer()
+        self.limits.check_input_bytes(os.path.getsize(filename), filename)
+        self.progress.start_phase('parse', filename)
+        input_root = parse_thml_file(filename, huge_tree=not self.limits.is_active())
+        retval = self.transform_root(input_root, full_xml=full_xml, doc_num=doc_num)
+        if images:
+            self.fetch_images()
+        return retval
+
+    def transform_root(self, input_root, full_xml=False, doc_num=1):
+        """
+        Converts a document. doc_num is the position of the document in
+        the book, and is used to keep generated ids unique across the files of
+        a book. Apart from the book metadata and the images, the output does
+        not depend on any documents converted before.
+        """
         self.toc = Toc() # reset for each document
-        input_root = etree.fromstring(thml)
+        self.index = Index()
+        self.ids = set()
+        self.links = set()
+        self.doc_num = doc_num
+        self.full_xml = full_xml
+        self.generated_id_counts = defaultdict(int)
+        self.element_count = 0
+        self.pending_text_parent = None
+        self.pending_text = []
+        self.notes = None
+        self.css = []
+        for handler in self.handlers:
+            handler.start_document(self)
         output_root = etree.Element('root') # Temporary container that we will strip again
+        self.progress.start_phase('descend', total=sum(1 for n in input_root.iter())
+                                  if self.progress.callback is not None else None)
         self.descend(input_root, output_root)
-        children = output_root.getchildren()
-        assert len(children) == 1
-        output_dom = children[0]
+        self.flush_text()
+        assert len(output_root) == 1
+        output_dom = output_root[0]
         self.post_process(output_dom)
         if full_xml:
             output_dom.set('xmlns', "http://www.w3.org/1999/xhtml")
+        self.progress.start_phase('serialize')
         html = etree.tostring(output_dom,
                               encoding='utf-8',
                               doctype=DOCTYPE if full_xml else None,
                               xml_declaration=True if full_xml else None,
                               pretty_print=True)
-        retval = HtmlDoc(html, self.toc)
+        retval = HtmlDoc(html, self.toc, self.index, ids=self.ids, links=self.links, notes=self.notes,
+                         css=self.css if self.shared_stylesheet else None)
+        self.notes = None
+        self.css = None
+        self.toc.node_map = {}
         self.toc = None
+        self.index.placeholders = []
+        self.index.pending = []
+        self.index = None
+        self.ids = self.links = None
+        for handler in self.handlers:
+            handler.end_document(self)
         return retval
 
-    def descend(self, input_node, output_parent_node):
-        retvals = []
-        matched = False
-        for handler in self.handlers:
+    def next_generated_id(self, kind):
+        self.generated_id_counts[kind] += 1
+        if self.doc_num == 1:
+            return '_{0}_{1}'.format(kind, self.generated_id_counts[kind])
+        else:
+            return '_{0}_{1}_{2}'.format(kind, self.doc_num, self.generated_id_counts[kind])
+
+    def register_id(self, id):
+        """
+        Records an id that is present in the current output document.
+        """
+        self.ids.add(id)
+
+    def ensure_id(self, node, kind):
+        """
+        Returns the id of an output node, giving it a generated one if needed.
+        """
+        id = node.get('id', None)
+        if id is None:
+            id = self.next_generated_id(kind)
+            node.set('id', id)
+            self.register_id(id)
+        return id
+
+    def append_text(self, parent, text):
+        """
+        Adds text to the end of the content of an output node. Runs of text
+        added to the same node are joined and added in one go by flush_text.
+        """
+        if text is None:
+            return
+        if parent is not self.pending_text_parent:
+            self.flush_text()
+            self.pending_text_parent = parent
+        self.pending_text.append(text)
+
+    def flush_text(self):
+        if self.pending_text:
+            append_text(self.pending_text_parent, ''.join(self.pending_text))
+            self.pending_text = []
+        self.pending_text_parent = None
+
+    def descend(self, input_node, output_parent_node, depth=0):
+        self.element_count += 1
+        self.limits.check_element(input_node, self.element_count, depth)
+        if input_node.tag == 'div1':
+            self.progress.title = input_node.get('title')
+        if self.element_count % self.progress.check_interval == 0:
+            self.progress.update(self.element_count)
+        retvals = []
+        matched = False
+        for handler in self.dispatch.get(input_node.tag):
             if handler.match(input_node):
                 matched = True
+                if not handler.text_only:
+                    self.flush_text()
                 retvals.append(handler.handle_node(self, input_node, output_parent_node))
         if not matched:
             sys.stderr.write("WARNING: Element {0} on line {1} not properly handled\n".format(input_node.tag, get_sourceline(input_node)))
@@ -745,22 +2079,411 @@ class ThmlToHtml(object):
             raise Exception("No new parent defined for node {0} on line {1}".format(input_node.tag, get_sourceline(input_node)))
         new_parent = new_parents[0]
 
-        for node in input_node.getchildren():
-            self.descend(node, new_parent)
+        for node in input_node:
+            self.descend(node, new_parent, depth + 1)
 
     def post_process(self, output_dom):
         for handler in sorted(self.handlers, key=lambda h: h.post_process_sort_order):
+            if type(handler).post_process.im_func is not Handler.post_process.im_func:
+                self.progress.start_phase('post_process', handler.__class__.__name__)
             handler.post_process(self, output_dom)
 
+    def get_handler(self, cls):
+        for handler in self.handlers:
+            if isinstance(handler, cls):
+                return handler
+
+    def fetch_images(self):
+        """
+        Finds or downloads the images used by all the documents converted so
+        far, and puts them in self.img_files.
+        """
+        self.get_handler(ImgHandler).fetch_images(self)
+
+    def get_book_state(self):
+        """
+        Returns the state that is collected across the documents of a book
+        """
+        return {'metadata': dict(self.get_handler(DCMetaDataCollector).dc_metadata),
+                'img_srcs': self.get_handler(ImgHandler).img_srcs}
+
+    def merge_book_state(self, state):
+        """
+        Merges in state returned by get_book_state on another converter.
+        """
+        dc_metadata = self.get_handler(DCMetaDataCollector).dc_metadata
+        merge_metadata(dc_metadata, state['metadata'])
+        self.metadata.update(dc_metadata)
+        self.get_handler(ImgHandler).img_srcs |= state['img_srcs']
+
+    def transform_files(self, filenames, full_xml=False, jobs=1, pool=None):
+        """
+        Converts the files of a book, returning a list of (filename, HtmlDoc)
+        pairs. With jobs > 1, the files are converted in a pool of processes,
+        with the same output as converting them one after the other. An
+        existing multiprocessing pool to use can be passed in instead, with
+        jobs giving how many files to convert in it at once. The images are
+        not fetched, call fetch_images once the book is converted.
+
+        The cancellation token is checked while waiting for the pool. When
+        cancelled, a pool created here is terminated at once. In a pool that
+        was passed in, the files already being converted are finished, but no
+        more are started.
+        """
+        # An index in any file can list the references in all of them
+        if not self.index_page:
+            self.book_scripture_index = any(has_scripture_index(fn) for fn in filenames)
+        if pool is None and (jobs <= 1 or len(filenames) < 2):
+            return [(fn, self.transform_file(fn, full_xml=full_xml, doc_num=i + 1, images=False))
+                    for i, fn in enumerate(filenames)]
+
+        # Each document sees the metadata of the documents before it, as it
+        # would when converted in sequence.
+        tasks = []
+        metadata = merge_metadata({}, self.get_handler(DCMetaDataCollector).dc_metadata)
+        for i, fn in enumerate(filenames):
+            tasks.append((self.options, fn, full_xml, i + 1, copy.deepcopy(metadata), self.book_scripture_index))
+            merge_metadata(metadata, read_metadata(fn))
+
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(min(jobs, len(filenames)))
+        try:
+            self.progress.start_phase('transform', total=len(filenames))
+            results = []
+            # Only jobs tasks are queued at once, so that nothing more is
+            # started after a cancellation.
+            tasks = iter(tasks)
+            pending = deque(pool.apply_async(_transform_file_task, (task,))
+                            for task in itertools.islice(tasks, max(jobs, 1)))
+            while pending:
+                async_result = pending.popleft()
+                while not async_result.ready():
+                    self.progress.check_cancelled()
+                    async_result.wait(CANCELLATION_POLL_INTERVAL)
+                results.append(async_result.get())
+                pending.extend(pool.apply_async(_transform_file_task, (task,))
+                               for task in itertools.islice(tasks, 1))
+                self.progress.update(len(results))
+        except Cancelled:
+            if own_pool:
+                pool.terminate()
+            raise
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+        retval = []
+        for fn, (html_doc, state) in zip(filenames, results):
+            self.merge_book_state(state)
+            retval.append((fn, html_doc))
+        return retval
+
+    def transform_preview(self, filenames, max_chapters=None, max_bytes=None, full_xml=False):
+        """
+        Converts the start of a book, up to max_chapters div1s or about
+        max_bytes of input (see parse_thml_preview), for a sample. The files
+        after that are only read for their metadata. Links to parts of the
+        book that were left out are removed. At least the first top level
+        element of the first file is always converted.
+        """
+        if not self.index_page:
+            self.book_scripture_index = any(has_scripture_index(fn) for fn in filenames)
+        retval = []
+        for i, fn in enumerate(filenames):
+            if retval and ((max_chapters is not None and max_chapters <= 0) or
+                           (max_bytes is not None and max_bytes <= 0)):
+                metadata = self.get_handler(DCMetaDataCollector).dc_metadata
+                merge_metadata(metadata, read_metadata(fn))
+                self.metadata.update(metadata)
+                continue
+            self.limits.start_timer()
+            size = os.path.getsize(fn)
+            self.limits.check_input_bytes(size if max_bytes is None else min(size, max_bytes), fn)
+            self.progress.start_phase('parse', fn)
+            input_root, chapters, bytes_read, complete = parse_thml_preview(
+                fn, max_chapters=max_chapters, max_bytes=max_bytes, huge_tree=not self.limits.is_active())
+            retval.append((fn, self.transform_root(input_root, full_xml=full_xml, doc_num=i + 1)))
+            if max_chapters is not None:
+                max_chapters -= chapters
+            if max_bytes is not None:
+                max_bytes -= bytes_read
+            if not complete:
+                max_chapters = max_bytes = 0
+
+        ids = set()
+        for fn, html_doc in retval:
+            ids |= html_doc.ids
+            if html_doc.notes is not None:
+                ids |= html_doc.notes.ids
+        for fn, html_doc in retval:
+            drop_links(html_doc, html_doc.links - ids)
+        return retval
+
+
+SCRIPTURE_INDEX_RE = re.compile(r'<insertIndex\s[^>]*\btype\s*=\s*["\']scripRef["\']')
+
+def has_scripture_index(filename):
+    """
+    Returns whether a ThML file has an insertIndex for scripture references,
+    by searching its text rather than parsing it.
+    """
+    tail = ''
+    with file(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            text = tail + chunk
+            if SCRIPTURE_INDEX_RE.search(text):
+                return True
+            tail = text[-1024:]
+    return False
+
+
+def _transform_file_task(args):
+    options, filename, full_xml, doc_num, metadata, book_scripture_index = args
+    converter = ThmlToHtml(**options)
+    converter.book_scripture_index = book_scripture_index
+    merge_metadata(converter.get_handler(DCMetaDataCollector).dc_metadata, metadata)
+    html_doc = converter.transform_file(filename, full_xml=full_xml, doc_num=doc_num, images=False)
+    return html_doc, converter.get_book_state()
+
 
 # Simple interface:
 def thml_to_html(input_thml):
     return ThmlToHtml().transform(input_thml, full_xml=False).html
 
 
+### Image optimization ###
+
+# Bump to invalidate cached results when optimize_image changes
+IMAGE_OPTIMIZATION_VERSION = 1
+
+# Image formats that all epub readers support, by Pillow format name
+EPUB_IMAGE_FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'PNG': ('.png', 'image/png'),
+    'GIF': ('.gif', 'image/gif'),
+}
+
+IMG_SRC_RE = re.compile(r'(<img\b[^>]*?\ssrc=")([^"]*)(")')
+
+
+def image_content(img_file):
+    if img_file.get('content') is not None:
+        return img_file['content']
+    with file(img_file['path'], 'rb') as f:
+        return f.read()
+
+
+def encode_image(image, format, **options):
+    out = StringIO.StringIO()
+    image.save(out, format, **options)
+    return out.getvalue()
+
+
+def optimize_image(content, max_dimension, quality):
+    """
+    Returns (content, extension, media type) for a smaller version of an
+    image, downscaled to fit in max_dimension pixels and recompressed, or None
+    if it can't be made smaller.
+    """
+    try:
+        image = Image.open(StringIO.StringIO(content))
+        image.load()
+    except Exception:
+        return None
+    if getattr(image, 'n_frames', 1) > 1:
+        return None  # animated
+    keep_original = image.format in EPUB_IMAGE_FORMATS
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.ANTIALIAS)
+        keep_original = False
+
+    candidates = []
+    try:
+        if image.mode not in ('1', 'L', 'P', 'RGB', 'RGBA', 'LA'):
+            image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        candidates.append((encode_image(image, 'PNG', optimize=True), 'PNG'))
+        transparent = 'A' in image.mode or 'transparency' in image.info
+        if not transparent:
+            rgb = image if image.mode in ('L', 'RGB') else image.convert('RGB')
+            candidates.append((encode_image(rgb, 'JPEG', quality=quality, optimize=True), 'JPEG'))
+    except (IOError, ValueError):
+        return None
+    best, format = min(candidates, key=lambda (c, f): len(c))
+    if keep_original and len(content) <= len(best):
+        return None
+    extension, media_type = EPUB_IMAGE_FORMATS[format]
+    return best, extension, media_type
+
+
+def _optimize_image_task(args):
+    content, max_dimension, quality = args
+    return optimize_image(content, max_dimension, quality)
+
+
+class ImageCache(object):
+    """
+    Results of optimize_image, stored in a directory. A file is stored as
+    <key><extension>, or as <key>.unchanged if it couldn't be improved.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """
+        Returns None for a miss, False if the image couldn't be improved, or
+        (path, extension, media type)
+        """
+        if os.path.exists(os.path.join(self.directory, key + '.unchanged')):
+            return False
+        for extension, media_type in EPUB_IMAGE_FORMATS.values():
+            path = os.path.join(self.directory, key + extension)
+            if os.path.exists(path):
+                return path, extension, media_type
+        return None
+
+    def put(self, key, result):
+        if result is None:
+            path = os.path.join(self.directory, key + '.unchanged')
+            content = ''
+        else:
+            content, extension, media_type = result
+            path = os.path.join(self.directory, key + extension)
+        tmp_path = path + '.tmp'
+        with file(tmp_path, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+        return path
+
+
+def optimize_images(img_files, html_docs, max_dimension=1200, quality=80, cache_directory=None, jobs=1):
+    """
+    Deduplicates, downscales and recompresses images, returning a new list of
+    image files. The img src attributes in the html of html_docs, and of
+    their separated notes, are updated for images that are renamed.
+    """
+    # Identical images are stored once, under the name of the first
+    images = OrderedDict()
+    contents = {}
+    total_size = 0
+    for img_file in img_files:
+        content = image_content(img_file)
+        total_size += len(content)
+        content_hash = hashlib.sha1(content).hexdigest()
+        images.setdefault(content_hash, []).append(img_file)
+        contents.setdefault(content_hash, content)
+
+    settings_hash = hashlib.sha1(json.dumps([IMAGE_OPTIMIZATION_VERSION, max_dimension, quality])).hexdigest()
+    def cache_key(content_hash):
+        return content_hash + settings_hash[:16]
+    cache = None if not cache_directory else ImageCache(cache_directory)
+    results = {}
+    todo = []
+    for content_hash in images:
+        cached = None if cache is None else cache.get(cache_key(content_hash))
+        if cached is None:
+            todo.append(content_hash)
+        elif cached is False:
+            results[content_hash] = None
+        else:
+            results[content_hash] = cached
+    tasks = [(contents[content_hash], max_dimension, quality) for content_hash in todo]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            optimized = pool.map(_optimize_image_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        optimized = map(_optimize_image_task, tasks)
+    del tasks
+    for content_hash, result in zip(todo, optimized):
+        if cache is None:
+            results[content_hash] = result
+        else:
+            path = cache.put(cache_key(content_hash), result)
+            results[content_hash] = None if result is None else (path,) + result[1:]
+
+    new_img_files = []
+    renames = {}
+    used_names = set()
+    new_size = 0
+    for content_hash, files in images.items():
+        result = results[content_hash]
+        if result is None:
+            new_img_file = dict(files[0])
+            new_size += len(contents[content_hash])
+        else:
+            data, extension, media_type = result
+            new_img_file = {'file_name': os.path.splitext(files[0]['file_name'])[0] + extension,
+                            'media_type': media_type}
+            # data is the content, or the path of the cached file
+            if cache is None:
+                new_img_file['content'] = data
+                new_size += len(data)
+            else:
+                new_img_file['path'] = data
+                new_size += os.path.getsize(data)
+        if new_img_file['file_name'] in used_names:
+            stem, extension = os.path.splitext(new_img_file['file_name'])
+            new_img_file['file_name'] = '{0}-{1}{2}'.format(stem, content_hash[:8], extension)
+        used_names.add(new_img_file['file_name'])
+        for img_file in files:
+            if img_file['file_name'] != new_img_file['file_name']:
+                renames[html_escape(img_file['file_name'])] = html_escape(new_img_file['file_name'])
+        new_img_files.append(new_img_file)
+
+    if renames:
+        def rename(m):
+            return m.group(1) + renames.get(m.group(2), m.group(2)) + m.group(3)
+        for html_doc in html_docs:
+            html_doc.html = IMG_SRC_RE.sub(rename, html_doc.html)
+            if html_doc.notes is not None:
+                html_doc.notes.html = IMG_SRC_RE.sub(rename, html_doc.notes.html)
+
+    sys.stderr.write("Images: {0} files, {1} unique, {2} bytes reduced to {3} bytes\n".format(
+        len(img_files), len(images), total_size, new_size))
+    return new_img_files
+
+
 ### HTML to epub ###
 
+STYLESHEET_FILE_NAME = "style.css"
+
+# Styles for the classes the converter adds, which come before any CSS from
+# the ThML files in the shared stylesheet.
+BASE_CSS = """\
+span.line { display: block; }
+div.verse { margin: 1em 0 1em 2em; }
+div.scripCom { font-size: smaller; font-style: italic; }
+div.notes { margin-top: 2em; border-top: 1px solid; font-size: smaller; }
+div.note { margin: 0.5em 0; }
+div.index p.indexentry { margin: 0 0 0 2em; text-indent: -2em; }
+"""
+
+
+def make_stylesheet(html_docs):
+    """
+    Returns the shared stylesheet for a book, with each distinct CSS block
+    from the documents once, or None if the documents don't use it.
+    """
+    if all(html_doc.css is None for html_doc in html_docs):
+        return None
+    blocks = OrderedDict()
+    for html_doc in html_docs:
+        for css in html_doc.css or []:
+            css = css.strip()
+            if css:
+                blocks[css] = None
+    return '\n'.join([BASE_CSS] + [css + '\n' for css in blocks])
+
+
 class EpubFile(object):
+    __slots__ = ['file_name', 'base_name', 'content']
+
     def __init__(self, file_name, content):
         self.file_name = file_name
         self.base_name = os.path.basename(file_name)
@@ -771,20 +2494,38 @@ class EpubFile(object):
 
 
 class OpfFile(EpubFile):
-    pass
+    __slots__ = []
 
 
 class NcxFile(EpubFile):
-    pass
+    __slots__ = []
 
 
 class ContentFile(EpubFile):
-    def __init__(self, file_name, content, media_type, toc, file_id):
+    """
+    A file of the book. If content is None, it is read from path each time
+    it is needed, rather than kept in memory.
+    """
+    __slots__ = ['media_type', 'toc', 'file_id', 'path', '_content']
+
+    def __init__(self, file_name, content, media_type, toc, file_id, path=None):
+        self.path = path
         super(ContentFile, self).__init__(file_name, content)
         self.media_type = media_type
         self.toc = toc
         self.file_id = file_id
 
+    @property
+    def content(self):
+        if self._content is None and self.path is not None:
+            with file(self.path, 'rb') as f:
+                return f.read()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
 
 class ContentFileCollection(object):
     def __init__(self):
@@ -793,8 +2534,8 @@ class ContentFileCollection(object):
     def __iter__(self):
         return iter(self.files)
 
-    def append(self, file_name, content, media_type, toc):
-        f = ContentFile(file_name, content, media_type, toc, "file_{0}".format(len(self.files) + 1))
+    def append(self, file_name, content, media_type, toc, path=None):
+        f = ContentFile(file_name, content, media_type, toc, "file_{0}".format(len(self.files) + 1), path=path)
         self.files.append(f)
         return f
 
@@ -845,27 +2586,374 @@ def map_creator_role(thml_creator_sub):
         return "oth"
     return CREATOR_ROLES[thml_creator_sub]
 
-def create_epub(input_html_pairs, metadata, img_files, outputfilename):
+class EpubPackage(object):
+    """
+    All the files that go into an epub, as built by build_epub.
+    """
+    __slots__ = ['mimetype_file', 'container_file', 'opf_file', 'ncx_file', 'content_files', 'deterministic']
+
+    def __init__(self, mimetype_file, container_file, opf_file, ncx_file, content_files, deterministic=False):
+        self.mimetype_file = mimetype_file
+        self.container_file = container_file
+        self.opf_file = opf_file
+        self.ncx_file = ncx_file
+        self.content_files = content_files
+        self.deterministic = deterministic
+
+    @property
+    def files(self):
+        return [self.mimetype_file, self.container_file, self.opf_file, self.ncx_file] + self.content_files.files
+
+
+def create_epub(input_html_pairs, metadata, img_files, output, index_page=True, deterministic=False,
+                progress=None):
+    """
+    Writes the epub to output, which is a filename or a writable file-like
+    object (which need not be seekable).
+
+    With deterministic=True, the same input always gives the same bytes.
+    """
+    check_index_placeholders(input_html_pairs)
+    package = build_epub(input_html_pairs, metadata, img_files, index_page=index_page,
+                         deterministic=deterministic)
+    write_epub(package, output, progress=progress)
+    return package
+
+
+def build_epub(input_html_pairs, metadata, img_files, index_page=True, deterministic=False, notes='file'):
+    """
+    notes says where notes separated from their documents go: 'file' for a
+    notes page after each document, or 'book' for one at the end of the book.
+    """
     content_files = ContentFileCollection()
-    for i, (src_name, html_doc) in enumerate(input_html_pairs):
-        content_files.append("OEBPS/{0}.html".format(i + 1), html_doc.html, "application/xhtml+xml", html_doc.toc)
+    stylesheet = make_stylesheet([html_doc for src_name, html_doc in input_html_pairs])
+    # The notes page of each document, which its notes' ids moved to
+    notes_files = [None if html_doc.notes is None else
+                   "{0}-notes.html".format(i + 1) if notes == 'file' else "notes.html"
+                   for i, (src_name, html_doc) in enumerate(input_html_pairs)]
+    htmls = fill_index_placeholders(input_html_pairs, notes_files=notes_files)
+    named_docs = []
+    for i, ((src_name, html_doc), html) in enumerate(zip(input_html_pairs, htmls)):
+        named_docs.append(("OEBPS/{0}.html".format(i + 1),
+                           HtmlDoc(html, html_doc.toc, html_doc.index, ids=html_doc.ids, links=html_doc.links)))
+        if html_doc.notes is not None and notes == 'file':
+            named_docs.append(("OEBPS/" + notes_files[i],
+                               make_notes_page([html_doc.notes], "_notes_{0}".format(i + 1),
+                                               stylesheet=stylesheet is not None)))
+    book_notes = [html_doc.notes for src_name, html_doc in input_html_pairs if html_doc.notes is not None]
+    if book_notes and notes == 'book':
+        named_docs.append(("OEBPS/notes.html", make_notes_page(book_notes, "_notes",
+                                                               stylesheet=stylesheet is not None)))
+    preferred = {}
+    for i, notes_file in enumerate(notes_files):
+        if notes_file is not None:
+            preferred["{0}.html".format(i + 1)] = notes_file
+            if notes == 'file':
+                preferred[notes_file] = "{0}.html".format(i + 1)
+    htmls = resolve_cross_file_links([(os.path.basename(fn), html_doc) for fn, html_doc in named_docs],
+                                     preferred=preferred)
+    for (file_name, html_doc), html in zip(named_docs, htmls):
+        content_files.append(file_name, html, "application/xhtml+xml", html_doc.toc)
+
+    if index_page:
+        index_file = make_index_file(input_html_pairs, stylesheet=stylesheet is not None,
+                                     notes_files=notes_files)
+        if index_file is not None:
+            content_files.append(*index_file)
+
+    if stylesheet is not None:
+        content_files.append("OEBPS/" + STYLESHEET_FILE_NAME, stylesheet, "text/css", None)
 
     for img_file in img_files:
-        content_files.append("OEBPS/" + img_file['file_name'], img_file['content'], img_file['media_type'], None)
+        content_files.append("OEBPS/" + img_file['file_name'], img_file.get('content'), img_file['media_type'], None,
+                             path=img_file.get('path'))
 
     #### mimetype
     mimetype_file = EpubFile("mimetype", "application/epub+zip")
-    opf_file, identifier_id, identifier_val, title = make_opf_file(content_files, metadata)
+    opf_file, identifier_id, identifier_val, title = make_opf_file(content_files, metadata,
+                                                                   deterministic=deterministic)
     container_file = make_container_file(opf_file)
     ncx_file = make_ncx_file(content_files, identifier_id, identifier_val, title)
-    # Write epub
+    return EpubPackage(mimetype_file, container_file, opf_file, ncx_file, content_files,
+                       deterministic=deterministic)
+
 
-    epub = zipfile.ZipFile(outputfilename, "w", zipfile.ZIP_DEFLATED)
-    for file in [mimetype_file, container_file, opf_file, ncx_file] + content_files.files:
-        epub.writestr(file.file_name, file.content,
-                      zipfile.ZIP_STORED if file.file_name == 'mimetype' else zipfile.ZIP_DEFLATED)
+# The earliest time a zip file can hold, used for all files in deterministic mode
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def content_identifier(content_files, metadata):
+    """
+    Returns a UUID URN derived from the content and metadata of a book.
+    """
+    h = hashlib.sha1()
+    for f in content_files:
+        h.update(utf8(f.file_name) + '\0' + utf8(f.content) + '\0')
+    h.update(json.dumps(sorted(metadata.items()), sort_keys=True))
+    return uuid.uuid5(uuid.NAMESPACE_URL, 'urn:sha1:' + h.hexdigest()).get_urn()
+
+
+class PositionTrackingStream(object):
+    """
+    Wraps a write-only stream, such as a pipe, for zipfile, which needs tell().
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.stream.flush()
+
+
+def write_epub(package, output, progress=None):
+    if not isinstance(output, basestring):
+        try:
+            output.tell()
+        except (IOError, AttributeError):
+            output = PositionTrackingStream(output)
+    # writestr knows the size and CRC of each file before writing its header,
+    # so nothing needs to be patched up afterwards by seeking. mimetype must be
+    # the first file, and stored.
+    epub = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+    files = package.files
+    if progress is not None:
+        progress.start_phase('write', total=len(files))
+    for i, file in enumerate(files):
+        if progress is not None:
+            progress.update(i)
+        compress_type = zipfile.ZIP_STORED if file.file_name == 'mimetype' else zipfile.ZIP_DEFLATED
+        if package.deterministic:
+            info = zipfile.ZipInfo(file.file_name, date_time=ZIP_DATE_TIME)
+            info.compress_type = compress_type
+            info.create_system = 3  # Unix
+            info.external_attr = 0644 << 16
+            epub.writestr(info, file.content)
+        else:
+            epub.writestr(file.file_name, file.content, compress_type)
 
     epub.close()
+    if not isinstance(output, basestring):
+        output.flush()
+
+
+@contextlib.contextmanager
+def open_output(output):
+    """
+    Opens output, a filename or an already open file-like object, for writing.
+    """
+    if isinstance(output, basestring):
+        with file(output, 'wb') as f:
+            yield f
+    else:
+        yield output
+        output.flush()
+
+
+GENERATED_ID_RE = re.compile(r'^_gen[a-z]*id_')
+
+FRAGMENT_HREF_RE = re.compile(r'href="#([^"]*)"')
+DROPPED_HREF_RE = re.compile(' ' + FRAGMENT_HREF_RE.pattern)
+
+def drop_links(html_doc, fragments):
+    """
+    Removes the links to fragments from an HtmlDoc, leaving their text.
+    """
+    if not fragments:
+        return
+    escaped = set(html_escape(fragment).replace('&#39;', "'") for fragment in fragments)
+    html_doc.html = DROPPED_HREF_RE.sub(lambda m: '' if m.group(1) in escaped else m.group(0), html_doc.html)
+    html_doc.links -= fragments
+
+
+def resolve_cross_file_links(named_docs, preferred=None):
+    """
+    Given a list of (file name, HtmlDoc) pairs for the files of a book, returns
+    their html, with links to fragments defined in other files rewritten to
+    point to those files. preferred maps a file name to the file that its
+    links go to when that file defines the id, e.g. a document's notes page.
+    Otherwise an id defined in several files resolves to the nearest of them,
+    preferring later files.
+    """
+    preferred = {} if preferred is None else preferred
+    # Global id -> file name index
+    id_index = {}
+    positions = {}
+    for i, (file_name, html_doc) in enumerate(named_docs):
+        positions[file_name] = i
+        for id in html_doc.ids:
+            id_index.setdefault(id, []).append(file_name)
+
+    for id, file_names in sorted(id_index.items()):
+        if len(file_names) > 1 and GENERATED_ID_RE.match(id):
+            sys.stderr.write("WARNING: generated id {0} is used in more than one file: {1}\n".format(
+                id, ', '.join(file_names)))
+
+    htmls = []
+    for file_name, html_doc in named_docs:
+        rewrites = {}
+        for fragment in html_doc.links:
+            if fragment in html_doc.ids:
+                continue
+            targets = id_index.get(fragment, [])
+            if not targets:
+                sys.stderr.write("WARNING: link to #{0} in {1} can't be resolved\n".format(fragment, file_name))
+                continue
+            if preferred.get(file_name) in targets:
+                target = preferred[file_name]
+            else:
+                target = min(targets, key=lambda t: (abs(positions[t] - positions[file_name]),
+                                                     positions[t] < positions[file_name]))
+            if len(targets) > 1 and target != preferred.get(file_name):
+                sys.stderr.write("WARNING: link to #{0} in {1} is ambiguous, using {2}\n".format(
+                    fragment, file_name, target))
+            rewrites[html_escape(fragment).replace('&#39;', "'")] = target
+        html = html_doc.html
+        if rewrites:
+            def repl(m):
+                fragment = m.group(1)
+                if fragment in rewrites:
+                    return 'href="{0}#{1}"'.format(rewrites[fragment], fragment)
+                return m.group(0)
+            html = FRAGMENT_HREF_RE.sub(repl, html)
+        htmls.append(html)
+    return htmls
+
+
+def add_stylesheet_link(head):
+    link = etree.SubElement(head, 'link')
+    link.set('rel', 'stylesheet')
+    link.set('type', 'text/css')
+    link.set('href', STYLESHEET_FILE_NAME)
+
+
+def stylesheet_link():
+    return '<link rel="stylesheet" type="text/css" href="{0}"/>\n'.format(STYLESHEET_FILE_NAME)
+
+
+def make_notes_page(notes_docs, id, stylesheet=False):
+    """
+    Returns an HtmlDoc for a page of the notes in notes_docs (see
+    HtmlDoc.notes).
+    """
+    html = "".join(["<?xml version='1.0' encoding='utf-8'?>\n", DOCTYPE,
+                    '<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n<title>Notes</title>\n',
+                    stylesheet_link() if stylesheet else '',
+                    '</head>\n<body>\n',
+                    '<div class="endnotes" id="{0}">\n<h1>Notes</h1>\n'.format(id)] +
+                   [notes_doc.html for notes_doc in notes_docs] +
+                   ['\n</div>\n</body>\n</html>\n'])
+    toc = Toc()
+    toc.items.append(TocItem("Notes", id, []))
+    ids = set([id])
+    links = set()
+    for notes_doc in notes_docs:
+        ids |= notes_doc.ids
+        links |= notes_doc.links
+    return HtmlDoc(html, toc, ids=ids, links=links)
+
+
+def make_index_file(input_html_pairs, stylesheet=False, notes_files=None):
+    """
+    Builds an index page for the end of the book, for any index types that
+    were not placed by an insertIndex element. notes_files gives the notes
+    page of each document, for entries in separated notes. Returns arguments
+    for ContentFileCollection.append, or None if there is nothing to index.
+    """
+    placed = set()
+    for src_name, html_doc in input_html_pairs:
+        if html_doc.index is not None:
+            placed |= html_doc.index.placed
+    index_types = sorted(set(t for src_name, html_doc in input_html_pairs
+                             if html_doc.index is not None
+                             for t in html_doc.index.entries) - placed)
+    if not index_types:
+        return None
+
+    html = etree.Element('html', {'xmlns': "http://www.w3.org/1999/xhtml"})
+    head = etree.SubElement(html, 'head')
+    etree.SubElement(head, 'title').text = 'Index'
+    if stylesheet:
+        add_stylesheet_link(head)
+    body = etree.SubElement(html, 'body')
+    toc = Toc()
+    for index_type in index_types:
+        title = INDEX_TITLES.get(index_type, '{0} Index'.format(index_type.capitalize()))
+        div = etree.SubElement(body, 'div', {'class': 'index', 'id': 'index-' + index_type})
+        etree.SubElement(div, 'h1').text = title
+        toc.items.append(TocItem(title, div.get('id'), []))
+
+        add_index_entries(div, merge_index(input_html_pairs, index_type, notes_files).sorted_entries(index_type))
+
+    content = etree.tostring(html, encoding='utf-8', doctype=DOCTYPE, xml_declaration=True, pretty_print=True)
+    return "OEBPS/index.html", content, "application/xhtml+xml", toc
+
+
+def merge_index(input_html_pairs, index_type, notes_files=None):
+    """
+    Returns an Index of the entries of index_type in all the documents of a
+    book, with hrefs to the files of the epub in place of ids. notes_files
+    gives the notes page of each document, for entries in separated notes.
+    """
+    merged = Index()
+    for i, (src_name, html_doc) in enumerate(input_html_pairs):
+        if html_doc.index is None or index_type not in html_doc.index.entries:
+            continue
+        notes_file = notes_files[i] if notes_files is not None else None
+        for label, ids in html_doc.index.entries[index_type].items():
+            for id in ids:
+                in_notes = notes_file is not None and id in html_doc.notes.ids
+                merged.add(index_type, label, '{0}#{1}'.format(
+                    notes_file if in_notes else '{0}.html'.format(i + 1), id))
+    return merged
+
+
+def fill_index_placeholders(input_html_pairs, notes_files=None):
+    """
+    Returns the html of the documents of a book. With several documents, the
+    insertIndex placeholders in them are filled with the entries of all the
+    documents, in place of those of their own document.
+    """
+    htmls = [html_doc.html for src_name, html_doc in input_html_pairs]
+    if len(input_html_pairs) < 2:
+        return htmls
+    merged = {}
+    for i, (src_name, html_doc) in enumerate(input_html_pairs):
+        if html_doc.index is None or not html_doc.index.placeholder_ids:
+            continue
+        root = etree.fromstring(html_doc.html)
+        for index_type, id, line in html_doc.index.placeholder_ids:
+            if index_type not in merged:
+                merged[index_type] = merge_index(input_html_pairs, index_type, notes_files)
+            node = root.xpath('//*[@id=$id]', id=id)[0]
+            del node[:]
+            if index_type in merged[index_type].entries:
+                add_index_entries(node, merged[index_type].sorted_entries(index_type))
+        htmls[i] = etree.tostring(root.getroottree(), encoding='utf-8',
+                                  xml_declaration=html_doc.html.startswith('<?xml'), pretty_print=True)
+    return htmls
+
+
+def check_index_placeholders(input_html_pairs):
+    """
+    Warns about insertIndex placeholders for index types that no document of
+    a book has entries for.
+    """
+    index_types = set(t for src_name, html_doc in input_html_pairs if html_doc.index is not None
+                      for t in html_doc.index.entries)
+    for src_name, html_doc in input_html_pairs:
+        if html_doc.index is None:
+            continue
+        for index_type, id, line in html_doc.index.placeholder_ids:
+            if index_type not in index_types:
+                sys.stderr.write("WARNING: no entries for insertIndex type '{0}' on line {1} of {2}\n".format(
+                    index_type, line, src_name))
 
 
 def make_container_file(opf_file):
@@ -879,7 +2967,7 @@ def make_container_file(opf_file):
     return container_file
 
 
-def make_opf_file(content_files, metadata):
+def make_opf_file(content_files, metadata, deterministic=False):
     opf_file = OpfFile("OEBPS/content.opf", "")
 
     index_tpl = '''<?xml version='1.0' encoding='utf-8'?>
@@ -912,7 +3000,7 @@ def make_opf_file(content_files, metadata):
     identifier_val = None
     identifier_id = None
     title = "Untitled"
-    for name, lst in metadata.items():
+    for name, lst in sorted(metadata.items()):
         for i, (value, attribs) in enumerate(lst):
             if name == 'dc:creator':
                 role = map_creator_role(attribs.get('sub', ''))
@@ -933,13 +3021,16 @@ def make_opf_file(content_files, metadata):
     ## identifier
     if identifier_val is None:
         identifier_id = 'bookuuid'
-        identifier_val =  uuid.uuid4().get_urn()
+        if deterministic:
+            identifier_val = content_identifier(content_files, metadata)
+        else:
+            identifier_val = uuid.uuid4().get_urn()
     if 'dc:identifier' not in metadata:
         metadata['dc:identifier'] = [(identifier_val, {'id': identifier_id})]
 
     ## creator
     metadata['dc:creator'] = []
-    for role in dplus(creators, creators_file_as).keys():
+    for role in sorted(dplus(creators, creators_file_as).keys()):
         c = creators.get(role, None)
         c_file_as = creators_file_as.get(role, None)
         if c is None and c_file_as is not None:
@@ -951,13 +3042,13 @@ def make_opf_file(content_files, metadata):
                                            'opf:role': role}))
 
     m = []
-    for name, lst in metadata.items():
+    for name, lst in sorted(metadata.items()):
         for i, (value, attribs) in enumerate(lst):
             attribs = {k: v for k, v in attribs.items()
                        if k in ['id', 'opf:file-as', 'opf:role']}
             if attribs:
                 attribs_html = ' ' + ' '.join('{0}="{1}"'.format(utf8(k), html_escape(v))
-                                 for k, v in attribs.items())
+                                 for k, v in sorted(attribs.items()))
             else:
                 attribs_html = ''
             m.append('<{tag}{attribs_html}>{value}</{tag}>'.format(
@@ -968,9 +3059,10 @@ def make_opf_file(content_files, metadata):
 
 
     for f in content_files:
-        manifest += '<item id="{0}" href="{1}" media-type="application/xhtml+xml"/>'.format(
-            f.file_id, f.get_path_relative_to_file(opf_file))
-        spine += '<itemref idref="{0}" linear="yes" />'.format(f.file_id)
+        manifest += '<item id="{0}" href="{1}" media-type="{2}"/>'.format(
+            f.file_id, f.get_path_relative_to_file(opf_file), html_escape(f.media_type or 'application/octet-stream'))
+        if f.media_type in SPINE_MEDIA_TYPES:
+            spine += '<itemref idref="{0}" linear="yes" />'.format(f.file_id)
 
     opf_file.content = index_tpl.format(
         identifier_id=identifier_id,
@@ -1052,10 +3144,1214 @@ def make_nav_points_helper(ncx_file, content_file, toc_items, counter, depth):
     return depth + 1, points
 
 
+### Background conversion ###
+
+class ConversionHandle(object):
+    """
+    A conversion started by BackgroundConverter.submit.
+    """
+    def __init__(self, async_result, cancellation):
+        self.async_result = async_result
+        self.cancellation = cancellation
+
+    def ready(self):
+        return self.async_result.ready()
+
+    def wait(self, timeout=None):
+        self.async_result.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        Returns the EpubPackage written, or raises the exception the conversion
+        failed with (Cancelled if it was cancelled), or
+        multiprocessing.TimeoutError if it doesn't finish within timeout.
+        """
+        return self.async_result.get(timeout)
+
+    def cancel(self):
+        self.cancellation.cancel()
+
+
+def _convert_in_background(converter, input_files, output, processes, jobs, index_page, deterministic):
+    input_html_pairs = converter.transform_files(input_files, full_xml=True, jobs=jobs, pool=processes)
+    converter.fetch_images()
+    return create_epub(input_html_pairs, converter.metadata, converter.img_files, output,
+                       index_page=index_page, deterministic=deterministic, progress=converter.progress)
+
+
+class BackgroundConverter(object):
+    """
+    Converts books to epub without blocking the caller, e.g. from a server.
+    Each book is converted in one of a pool of threads, which also fetches
+    its images and writes the epub. If processes is given, the input files
+    are transformed in a pool of that many processes, shared by all books.
+    """
+    def __init__(self, threads=4, processes=None):
+        self.threads = multiprocessing.pool.ThreadPool(threads)
+        self.processes = None if not processes else multiprocessing.Pool(processes)
+        self.jobs = processes or 1
+
+    def submit(self, input_files, output, callback=None, progress_callback=None, index_page=True,
+               deterministic=False, **options):
+        """
+        Starts converting a book to output (a filename or file-like object),
+        using a ThmlToHtml created with options, and returns a
+        ConversionHandle. callback is called from a pool thread with the
+        EpubPackage when the conversion succeeds, and progress_callback with
+        ProgressEvents as it goes along.
+        """
+        cancellation = CancellationToken()
+        converter = ThmlToHtml(progress=ProgressReporter(progress_callback, cancellation=cancellation),
+                               index_page=index_page, **options)
+        async_result = self.threads.apply_async(_convert_in_background,
+                                                (converter, list(input_files), output, self.processes,
+                                                 self.jobs, index_page, deterministic),
+                                                callback=callback)
+        return ConversionHandle(async_result, cancellation)
+
+    def close(self):
+        """
+        Waits for the submitted conversions to finish, and stops the pools.
+        """
+        self.threads.close()
+        self.threads.join()
+        if self.processes is not None:
+            self.processes.close()
+            self.processes.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+### Output writers ###
+
+class Book(object):
+    """
+    A converted book, which any number of writers can write out.
+    """
+    def __init__(self, input_html_pairs, metadata, img_files, index_page=True, deterministic=False,
+                 progress=None, notes='file'):
+        self.input_html_pairs = input_html_pairs
+        self.metadata = metadata
+        self.img_files = img_files
+        self.index_page = index_page
+        self.deterministic = deterministic
+        self.progress = progress
+        self.notes = notes
+        self._package = None
+        check_index_placeholders(input_html_pairs)
+
+    @property
+    def package(self):
+        # Built once, on demand, for the writers that need epub structure
+        if self._package is None:
+            self._package = build_epub(self.input_html_pairs, self.metadata, self.img_files,
+                                       index_page=self.index_page, deterministic=self.deterministic,
+                                       notes=self.notes)
+        return self._package
+
+    @property
+    def title(self):
+        if 'dc:title' in self.metadata:
+            return self.metadata['dc:title'][0][0]
+        return "Untitled"
+
+
+class Writer(object):
+    # Template (see do_substitutions) for the default output path
+    default_output = None
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, book):
+        raise NotImplementedError()
+
+
+class EpubWriter(Writer):
+    default_output = "%d/%f.rough.epub"
+
+    def write(self, book):
+        write_epub(book.package, self.output, progress=book.progress)
+
+
+class EpubDirectoryWriter(Writer):
+    """
+    Writes the files of the epub into a directory, unzipped.
+    """
+    default_output = "%d/%f.rough.epub.d"
+
+    def write(self, book):
+        for f in book.package.files:
+            path = os.path.join(self.output, f.file_name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with file(path, 'wb') as out:
+                out.write(utf8(f.content))
+
+
+# Links between the files of an epub, which in a single file are links within
+# the file.
+FILE_FRAGMENT_HREF_RE = re.compile(r'href="\d+\.html#')
+
+class XhtmlWriter(Writer):
+    """
+    Writes the whole book as a single XHTML file. Images are referred to by
+    file name, as in the epub, but are not written.
+    """
+    default_output = "%d/%f.rough.xhtml"
+
+    def write(self, book):
+        with open_output(self.output) as out:
+            out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            out.write(DOCTYPE)
+            out.write('<html xmlns="http://www.w3.org/1999/xhtml">\n<head>\n')
+            out.write('<title>{0}</title>\n'.format(html_escape(book.title)))
+            stylesheet = make_stylesheet([html_doc for src_name, html_doc in book.input_html_pairs])
+            if stylesheet is not None:
+                out.write('<style type="text/css">\n{0}</style>\n'.format(html_escape(stylesheet)))
+            out.write('</head>\n<body>\n')
+            htmls = fill_index_placeholders(book.input_html_pairs)
+            notes_docs = [html_doc.notes for src_name, html_doc in book.input_html_pairs
+                          if html_doc.notes is not None]
+            if notes_docs:
+                htmls.append(make_notes_page(notes_docs, "_notes").html)
+            if book.index_page:
+                index_file = make_index_file(book.input_html_pairs)
+                if index_file is not None:
+                    htmls.append(index_file[1])
+            for html in htmls:
+                # One document at a time, so only one is parsed at once.
+                body = etree.fromstring(FILE_FRAGMENT_HREF_RE.sub('href="#', html)).find('{%s}body' % XHTML_NS)
+                if body is None:
+                    continue
+                if body.text:
+                    out.write(html_escape(body.text).replace('&#39;', "'").replace('&quot;', '"'))
+                for node in body:
+                    out.write(etree.tostring(node, encoding='utf-8').replace(' xmlns="{0}"'.format(XHTML_NS), ''))
+            out.write('</body>\n</html>\n')
+
+
+# Elements that end a line in the text extract
+TEXT_BLOCK_ELEMENTS = set(['p', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'dt', 'dd', 'tr',
+                           'blockquote', 'pre', 'address', 'br', 'hr', 'table', 'ul', 'ol', 'title'])
+
+class TextWriter(Writer):
+    """
+    Writes a plain text extract of the book, e.g. for a search index. Each
+    block element becomes one line, with whitespace normalized.
+    """
+    default_output = "%d/%f.txt"
+
+    def write(self, book):
+        with open_output(self.output) as out:
+            for (src_name, html_doc), html in zip(book.input_html_pairs,
+                                                  fill_index_placeholders(book.input_html_pairs)):
+                self.write_text(html, out)
+                if html_doc.notes is not None:
+                    self.write_text(make_notes_page([html_doc.notes], "_notes").html, out)
+
+    def write_text(self, html, out):
+        root = etree.fromstring(html)
+        for node in root.xpath('//h:style|//h:script', namespaces={'h': XHTML_NS}):
+            node.text = None
+        pending = []
+        def flush():
+            line = ' '.join(''.join(pending).split())
+            if line:
+                out.write(utf8(line) + '\n')
+            del pending[:]
+        for event, node in etree.iterwalk(root, events=('start', 'end')):
+            tag = node.tag.split('}')[-1] if isinstance(node.tag, basestring) else None
+            if event == 'start':
+                if tag in TEXT_BLOCK_ELEMENTS:
+                    flush()
+                if node.text:
+                    pending.append(node.text)
+            else:
+                if tag in TEXT_BLOCK_ELEMENTS:
+                    flush()
+                if node.tail:
+                    pending.append(node.tail)
+        flush()
+
+
+WRITERS = {
+    'epub': EpubWriter,
+    'epub-dir': EpubDirectoryWriter,
+    'xhtml': XhtmlWriter,
+    'text': TextWriter,
+}
+
+
+### Validation ###
+
+XHTML_NS = 'http://www.w3.org/1999/xhtml'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+OPF_NS = 'http://www.idpf.org/2007/opf'
+NCX_NS = 'http://www.daisy.org/z3986/2005/ncx/'
+
+XHTML11_COMMON_ATTRIBUTES = set([
+    'id', 'class', 'title', 'style', 'dir', XML_LANG,
+    'onclick', 'ondblclick', 'onmousedown', 'onmouseup', 'onmouseover',
+    'onmousemove', 'onmouseout', 'onkeypress', 'onkeydown', 'onkeyup',
+])
+
+_CELL_HALIGN = 'align char charoff valign'
+
+# Elements allowed in XHTML 1.1, with the attributes they allow in addition to
+# XHTML11_COMMON_ATTRIBUTES.
+XHTML11_ELEMENTS = dict((name, set(attribs.split())) for name, attribs in [
+    # Structure, metainformation, scripting, style
+    ('html', 'version'), ('head', 'profile'), ('title', ''), ('body', 'onload onunload'),
+    ('base', 'href'), ('meta', 'http-equiv name content scheme'),
+    ('link', 'charset href hreflang type rel rev media'),
+    ('style', 'type media ' + XML_SPACE), ('script', 'charset type src defer ' + XML_SPACE),
+    ('noscript', ''),
+    # Text
+    ('abbr', ''), ('acronym', ''), ('address', ''), ('blockquote', 'cite'), ('br', ''),
+    ('cite', ''), ('code', ''), ('dfn', ''), ('div', ''), ('em', ''),
+    ('h1', ''), ('h2', ''), ('h3', ''), ('h4', ''), ('h5', ''), ('h6', ''),
+    ('kbd', ''), ('p', ''), ('pre', XML_SPACE), ('q', 'cite'), ('samp', ''),
+    ('span', ''), ('strong', ''), ('var', ''),
+    # Hypertext, lists, presentation, edit, bidi
+    ('a', 'accesskey charset href hreflang rel rev tabindex type coords shape'),
+    ('dl', ''), ('dt', ''), ('dd', ''), ('ol', ''), ('ul', ''), ('li', ''),
+    ('b', ''), ('big', ''), ('hr', ''), ('i', ''), ('small', ''), ('sub', ''),
+    ('sup', ''), ('tt', ''), ('del', 'cite datetime'), ('ins', 'cite datetime'), ('bdo', ''),
+    # Tables
+    ('caption', ''), ('table', 'border cellpadding cellspacing frame rules summary width'),
+    ('col', 'span width ' + _CELL_HALIGN), ('colgroup', 'span width ' + _CELL_HALIGN),
+    ('thead', _CELL_HALIGN), ('tfoot', _CELL_HALIGN), ('tbody', _CELL_HALIGN), ('tr', _CELL_HALIGN),
+    ('td', 'abbr axis colspan headers rowspan scope ' + _CELL_HALIGN),
+    ('th', 'abbr axis colspan headers rowspan scope ' + _CELL_HALIGN),
+    # Images, image maps, objects
+    ('img', 'alt height longdesc src width usemap ismap'), ('map', ''),
+    ('area', 'accesskey alt coords href nohref shape tabindex'),
+    ('object', 'archive classid codebase codetype data declare height name standby tabindex type width usemap'),
+    ('param', 'name type value valuetype'),
+    # Ruby
+    ('ruby', ''), ('rbc', ''), ('rtc', ''), ('rb', ''), ('rt', 'rbspan'), ('rp', ''),
+])
+
+XHTML11_REQUIRED_ATTRIBUTES = {
+    'img': ['src', 'alt'],
+    'style': ['type'],
+    'script': ['type'],
+    'meta': ['content'],
+    'bdo': ['dir'],
+    'area': ['alt'],
+}
+
+EXPECTED_MEDIA_TYPES = {
+    '.html': 'application/xhtml+xml',
+    '.xhtml': 'application/xhtml+xml',
+    '.ncx': 'application/x-dtbncx+xml',
+    '.css': 'text/css',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.svg': 'image/svg+xml',
+}
+
+SPINE_MEDIA_TYPES = ['application/xhtml+xml', 'application/x-dtbook+xml']
+
+ERROR = 'error'
+WARNING = 'warning'
+
+
+class ValidationMessage(object):
+    def __init__(self, severity, code, file_name, message, line=None):
+        self.severity, self.code, self.file_name, self.message, self.line = \
+            severity, code, file_name, message, line
+
+    def as_dict(self):
+        return {'severity': self.severity,
+                'code': self.code,
+                'file': self.file_name,
+                'line': self.line,
+                'message': self.message}
+
+    def __str__(self):
+        return "{0}: {1}{2}: {3}".format(self.severity.upper(), self.file_name,
+                                         '' if self.line is None else ':{0}'.format(self.line),
+                                         utf8(self.message))
+
+    def __repr__(self):
+        return "ValidationMessage({0!r}, {1!r}, {2!r}, {3!r})".format(
+            self.severity, self.code, self.file_name, self.message)
+
+
+def validate_epub(package):
+    """
+    Checks the structure of an EpubPackage, returning a list of
+    ValidationMessage objects.
+
+    This is a fast subset of what epubcheck does: XHTML 1.1 elements and
+    attributes, duplicate ids, links and navPoints to missing files or
+    fragments, and consistency of the manifest, spine and media types.
+    """
+    messages = []
+    def report(severity, code, file_name, message, line=None):
+        messages.append(ValidationMessage(severity, code, file_name, message, line))
+
+    files = dict((f.file_name, f) for f in package.files)
+    ids = {} # file name -> set of ids
+    links = [] # (file name, line, target file name, fragment)
+
+    ## OPF
+    opf_file = package.opf_file
+    opf_dir = os.path.dirname(opf_file.file_name)
+    try:
+        opf = etree.fromstring(utf8(opf_file.content))
+    except etree.XMLSyntaxError as e:
+        report(ERROR, 'opf-syntax', opf_file.file_name, str(e))
+        opf = None
+
+    if opf is not None:
+        manifest = {}
+        in_manifest = set()
+        for item in opf.iter('{%s}item' % OPF_NS):
+            item_id, href, media_type = item.get('id'), item.get('href'), item.get('media-type')
+            if item_id in manifest:
+                report(ERROR, 'manifest-duplicate-id', opf_file.file_name,
+                       "Duplicate manifest id '{0}'".format(item_id), item.sourceline)
+            manifest[item_id] = item
+            target = os.path.normpath(os.path.join(opf_dir, urllib.unquote(href or '')))
+            in_manifest.add(target)
+            if target not in files:
+                report(ERROR, 'manifest-missing-file', opf_file.file_name,
+                       "Manifest item '{0}' refers to missing file '{1}'".format(item_id, href), item.sourceline)
+            expected = EXPECTED_MEDIA_TYPES.get(os.path.splitext(target)[1].lower())
+            if expected is not None and media_type != expected:
+                report(ERROR, 'manifest-media-type', opf_file.file_name,
+                       "Manifest item '{0}' has media-type '{1}', expected '{2}'".format(item_id, media_type, expected),
+                       item.sourceline)
+            content_file = files.get(target)
+            if isinstance(content_file, ContentFile) and content_file.media_type != media_type:
+                report(WARNING, 'manifest-media-type', opf_file.file_name,
+                       "Manifest item '{0}' has media-type '{1}' but file was added as {2!r}".format(
+                           item_id, media_type, content_file.media_type), item.sourceline)
+
+        for f in package.content_files:
+            if f.file_name not in in_manifest:
+                report(ERROR, 'manifest-unlisted-file', f.file_name, "File is not listed in the manifest")
+
+        spine = opf.find('{%s}spine' % OPF_NS)
+        if spine is None:
+            report(ERROR, 'spine-missing', opf_file.file_name, "No spine")
+        else:
+            toc_id = spine.get('toc')
+            if toc_id not in manifest:
+                report(ERROR, 'spine-toc', opf_file.file_name, "Spine toc '{0}' is not in the manifest".format(toc_id))
+            itemrefs = spine.findall('{%s}itemref' % OPF_NS)
+            if not itemrefs:
+                report(ERROR, 'spine-empty', opf_file.file_name, "Spine has no items")
+            for itemref in itemrefs:
+                idref = itemref.get('idref')
+                if idref not in manifest:
+                    report(ERROR, 'spine-unknown-idref', opf_file.file_name,
+                           "Spine itemref '{0}' is not in the manifest".format(idref), itemref.sourceline)
+                elif manifest[idref].get('media-type') not in SPINE_MEDIA_TYPES:
+                    report(ERROR, 'spine-media-type', opf_file.file_name,
+                           "Spine item '{0}' has media-type '{1}', which can't be in the spine".format(
+                               idref, manifest[idref].get('media-type')), itemref.sourceline)
+
+    ## XHTML content
+    for f in package.content_files:
+        if os.path.splitext(f.file_name)[1].lower() not in ['.html', '.xhtml']:
+            continue
+        file_ids = ids[f.file_name] = set()
+        try:
+            root = etree.fromstring(f.content)
+        except etree.XMLSyntaxError as e:
+            report(ERROR, 'xhtml-syntax', f.file_name, str(e))
+            continue
+        head = root.find('{%s}head' % XHTML_NS)
+        if head is None:
+            report(ERROR, 'xhtml-head', f.file_name, "Document has no head", root.sourceline)
+        elif head.find('{%s}title' % XHTML_NS) is None:
+            report(ERROR, 'xhtml-title', f.file_name, "Document has no title", head.sourceline)
+        for node in root.iter(tag=etree.Element):
+            if not node.tag.startswith('{%s}' % XHTML_NS):
+                report(ERROR, 'xhtml-namespace', f.file_name,
+                       "Element '{0}' is not in the XHTML namespace".format(node.tag), node.sourceline)
+                continue
+            tag = node.tag[len(XHTML_NS) + 2:]
+            if tag not in XHTML11_ELEMENTS:
+                report(ERROR, 'xhtml-element', f.file_name,
+                       "Element '{0}' is not allowed in XHTML 1.1".format(tag), node.sourceline)
+            else:
+                allowed = XHTML11_ELEMENTS[tag]
+                for k in node.attrib.keys():
+                    if k not in allowed and k not in XHTML11_COMMON_ATTRIBUTES:
+                        report(ERROR, 'xhtml-attribute', f.file_name,
+                               "Attribute '{0}' is not allowed on '{1}' in XHTML 1.1".format(k, tag), node.sourceline)
+                for k in XHTML11_REQUIRED_ATTRIBUTES.get(tag, []):
+                    if k not in node.attrib:
+                        report(ERROR, 'xhtml-required-attribute', f.file_name,
+                               "Element '{0}' is missing required attribute '{1}'".format(tag, k), node.sourceline)
+            id = node.get('id')
+            if id is not None:
+                if id in file_ids:
+                    report(ERROR, 'duplicate-id', f.file_name, "Duplicate id '{0}'".format(id), node.sourceline)
+                file_ids.add(id)
+            for attr in ['href', 'src']:
+                url = node.get(attr)
+                if url is None or (attr == 'href' and tag not in ['a', 'area', 'link']):
+                    continue
+                link = resolve_package_link(f.file_name, url)
+                if link is not None:
+                    links.append((f.file_name, node.sourceline) + link)
+
+    ## NCX
+    ncx_file = package.ncx_file
+    try:
+        ncx = etree.fromstring(utf8(ncx_file.content))
+    except etree.XMLSyntaxError as e:
+        report(ERROR, 'ncx-syntax', ncx_file.file_name, str(e))
+        ncx = None
+    if ncx is not None:
+        nav_ids = set()
+        for nav_point in ncx.iter('{%s}navPoint' % NCX_NS):
+            nav_id = nav_point.get('id')
+            if nav_id in nav_ids:
+                report(ERROR, 'duplicate-id', ncx_file.file_name, "Duplicate navPoint id '{0}'".format(nav_id),
+                       nav_point.sourceline)
+            nav_ids.add(nav_id)
+            content = nav_point.find('{%s}content' % NCX_NS)
+            if content is None:
+                report(ERROR, 'ncx-navpoint-content', ncx_file.file_name,
+                       "navPoint '{0}' has no content".format(nav_id), nav_point.sourceline)
+                continue
+            link = resolve_package_link(ncx_file.file_name, content.get('src', ''))
+            if link is not None:
+                links.append((ncx_file.file_name, content.sourceline) + link)
+
+    ## Links, checked now that we have all the ids
+    for file_name, line, target, fragment in links:
+        if target not in files:
+            report(ERROR, 'link-missing-file', file_name, "Link to missing file '{0}'".format(target), line)
+        elif fragment and target in ids and fragment not in ids[target]:
+            report(ERROR, 'link-missing-fragment', file_name,
+                   "Link to missing fragment '{0}#{1}'".format(target, fragment), line)
+
+    return messages
+
+
+def resolve_package_link(file_name, url):
+    """
+    For a link in a file of the package, returns (target file name,
+    fragment), or None for links outside the package.
+    """
+    p = urlparse.urlparse(url)
+    if p.scheme or p.netloc:
+        return None
+    if p.path:
+        target = os.path.normpath(os.path.join(os.path.dirname(file_name), urllib.unquote(p.path)))
+    else:
+        target = file_name
+    return target, urllib.unquote(p.fragment)
+
+
+def validation_report(messages):
+    """
+    Returns a JSON serializable report of validation messages.
+    """
+    return {
+        'valid': not any(m.severity == ERROR for m in messages),
+        'errors': len([m for m in messages if m.severity == ERROR]),
+        'warnings': len([m for m in messages if m.severity == WARNING]),
+        'messages': [m.as_dict() for m in messages],
+    }
+
+
+### OPDS catalog ###
+
+class OpdsCatalog(object):
+    """
+    An OPDS (Atom) catalog of converted books, with a compact JSON index of
+    the same entries. Entries are keyed on output path, relative to the
+    catalog directory, so re-converting a book replaces its entry. Each entry
+    is kept in its own file, so adding a book doesn't touch the others, and
+    the feed and index are written from them by save.
+    """
+    json_name = 'catalog.json'
+    atom_name = 'catalog.xml'
+    entries_name = 'catalog.d'
+
+    feed_tpl = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:dcterms="http://purl.org/dc/terms/"
+      xmlns:opds="http://opds-spec.org/2010/catalog">
+  <id>{id}</id>
+  <title>{title}</title>
+  <updated>{updated}</updated>
+  <link rel="self" href="{atom_name}" type="application/atom+xml;profile=opds-catalog;kind=acquisition"/>
+  <link rel="start" href="{atom_name}" type="application/atom+xml;profile=opds-catalog;kind=acquisition"/>
+{entries}
+</feed>
+'''
+
+    entry_tpl = '''  <entry>
+    <title>{title}</title>
+    <id>{id}</id>
+    <updated>{updated}</updated>
+{people}{identifiers}    <link rel="http://opds-spec.org/acquisition" href="{href}" type="application/epub+zip"/>
+  </entry>'''
+
+    def __init__(self, directory, title="Converted books"):
+        self.directory = directory
+        self.title = title
+
+    def entry_path(self, href):
+        return os.path.join(self.directory, self.entries_name, hashlib.sha1(utf8(href)).hexdigest() + '.json')
+
+    def load_entries(self):
+        """
+        Returns a dictionary of all the entries, keyed on href.
+        """
+        entries = {}
+        directory = os.path.join(self.directory, self.entries_name)
+        if os.path.isdir(directory):
+            for fn in os.listdir(directory):
+                if fn.endswith('.json'):
+                    with file(os.path.join(directory, fn)) as f:
+                        entry = json.load(f)
+                    entries[entry.pop('href')] = entry
+        return entries
+
+    def add(self, metadata, output_path):
+        """
+        Adds or replaces the entry for a book, using metadata as prepared by
+        make_opf_file (i.e. after create_epub has been called).
+        """
+        href = os.path.relpath(os.path.abspath(output_path), os.path.abspath(self.directory))
+        identifiers = [[value, attribs.get('scheme', '')]
+                       for value, attribs in metadata.get('dc:identifier', [])]
+        creators = [[value, attribs.get('opf:role', 'aut'), attribs.get('opf:file-as', value)]
+                    for value, attribs in metadata.get('dc:creator', [])]
+        entry = {
+            'href': href,
+            'title': metadata['dc:title'][0][0] if 'dc:title' in metadata else "Untitled",
+            'creators': creators,
+            'identifiers': identifiers,
+            'updated': atom_timestamp(),
+        }
+        path = self.entry_path(href)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        write_file_atomically(path, json.dumps(entry, sort_keys=True))
+
+    def save(self):
+        """
+        Writes the feed and the JSON index for all the entries.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        entries = self.load_entries()
+        write_file_atomically(os.path.join(self.directory, self.json_name),
+                              json.dumps({'entries': entries}, separators=(',', ':'), sort_keys=True))
+        write_file_atomically(os.path.join(self.directory, self.atom_name), self.make_feed(entries))
+
+    def make_feed(self, entries):
+        atom_entries = []
+        for href in sorted(entries, key=lambda href: (entries[href]['title'].lower(), href)):
+            entry = entries[href]
+            people = ''.join('    <{tag}><name>{name}</name></{tag}>\n'.format(
+                tag='author' if role == 'aut' else 'contributor', name=html_escape(name))
+                             for name, role, file_as in entry['creators'])
+            identifiers = ''.join('    <dcterms:identifier>{0}</dcterms:identifier>\n'.format(html_escape(value))
+                                  for value, scheme in entry['identifiers'])
+            if entry['identifiers']:
+                id = entry['identifiers'][0][0]
+            else:
+                id = uuid.uuid5(uuid.NAMESPACE_URL, utf8(href)).get_urn()
+            atom_entries.append(self.entry_tpl.format(
+                title=html_escape(entry['title']),
+                id=html_escape(id),
+                updated=entry['updated'],
+                people=people,
+                identifiers=identifiers,
+                href=html_escape(urllib.quote(utf8(href))),
+            ))
+        return self.feed_tpl.format(
+            id=uuid.uuid5(uuid.NAMESPACE_URL, utf8(os.path.abspath(self.directory))).get_urn(),
+            title=html_escape(self.title),
+            updated=atom_timestamp(),
+            atom_name=self.atom_name,
+            entries='\n'.join(atom_entries),
+        )
+
+
+def update_catalog(directory, metadata, output_path, write_feed=True):
+    """
+    Adds a single book to the catalog in directory. A lock file is used so that
+    several converter processes can update the same catalog. When adding a
+    batch of books, pass write_feed=False and call write_catalog_feed once
+    at the end.
+    """
+    with catalog_lock(directory):
+        catalog = OpdsCatalog(directory)
+        catalog.add(metadata, output_path)
+        if write_feed:
+            catalog.save()
+
+
+def write_catalog_feed(directory):
+    with catalog_lock(directory):
+        OpdsCatalog(directory).save()
+
+
+@contextlib.contextmanager
+def catalog_lock(directory):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with file(os.path.join(directory, '.catalog.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def atom_timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def write_file_atomically(path, content):
+    tmp_path = path + '.tmp'
+    with file(tmp_path, 'w') as f:
+        f.write(utf8(content))
+    os.rename(tmp_path, path)
+
+
+### Corpus survey ###
+
+# Number of places to show for each element or attribute
+SURVEY_EXAMPLES = 3
+
+class Survey(object):
+    """
+    Counts of the elements and attributes in a set of ThML files that the
+    handlers don't deal with. Elements are keyed by (tag, None), and
+    attributes that MAP would ignore by (tag, attribute).
+    """
+    def __init__(self):
+        self.files = 0
+        self.failed = []
+        self.counts = Counter()
+        self.file_counts = Counter()
+        self.examples = defaultdict(list)
+
+    def add(self, key, filename, line):
+        if key not in self.counts:
+            self.file_counts[key] += 1
+        self.counts[key] += 1
+        if len(self.examples[key]) < SURVEY_EXAMPLES:
+            self.examples[key].append((filename, line))
+
+    def merge(self, other):
+        self.files += other.files
+        self.failed.extend(other.failed)
+        self.counts.update(other.counts)
+        self.file_counts.update(other.file_counts)
+        for key, examples in other.examples.items():
+            self.examples[key].extend(examples[:SURVEY_EXAMPLES - len(self.examples[key])])
+        return self
+
+    def report(self, out):
+        out.write("Surveyed {0} files".format(self.files))
+        if self.failed:
+            out.write(", {0} could not be parsed".format(len(self.failed)))
+        out.write("\n")
+        for title, is_element in [("Unhandled elements", True), ("Ignored attributes", False)]:
+            keys = [k for k in self.counts if (k[1] is None) == is_element]
+            out.write("\n{0}:\n".format(title))
+            if not keys:
+                out.write("  none\n")
+            for key in sorted(keys, key=lambda k: (-self.counts[k], k)):
+                out.write("{0:>9} {1:>6} files  {2}  e.g. {3}\n".format(
+                    self.counts[key], self.file_counts[key],
+                    key[0] if is_element else '{0}@{1}'.format(*key),
+                    ', '.join('{0}:{1}'.format(fn, line) for fn, line in self.examples[key])))
+
+
+def survey_file(filename, handler_spec=None):
+    """
+    Finds the elements and attributes in a ThML file that the converter
+    would warn about, without converting it, and returns a Survey.
+    """
+    survey = Survey()
+    survey.files = 1
+    dispatch = HandlerDispatch([cls() for cls in load_handler_spec(handler_spec)])
+    skip_depth = 0
+    try:
+        for event, node in iterparse_thml(filename, events=('start', 'end')):
+            if event == 'end':
+                if skip_depth:
+                    skip_depth -= 1
+                # Matching only looks at the node and its parent, so the rest
+                # of the tree can go.
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+                continue
+            if skip_depth:
+                skip_depth += 1
+                continue
+            matched = [h for h in dispatch.get(node.tag) if h.match(node)]
+            if not matched:
+                survey.add((node.tag, None), filename, get_sourceline(node))
+                continue
+            for handler in matched:
+                attribs = getattr(handler, 'attribs', None)
+                if attribs is not None:
+                    for k in node.attrib.keys():
+                        if k not in attribs:
+                            survey.add((node.tag, k), filename, get_sourceline(node))
+            if not any(h.descends for h in matched):
+                skip_depth = 1
+    except etree.XMLSyntaxError as e:
+        sys.stderr.write("WARNING: can't survey {0}: {1}\n".format(filename, e))
+        survey.failed.append(filename)
+    return survey
+
+
+def survey_corpus(filenames, jobs=1, handler_spec=None):
+    survey = Survey()
+    tasks = ((fn, handler_spec) for fn in filenames)
+    if jobs <= 1:
+        return reduce(Survey.merge, itertools.imap(_survey_file_task, tasks), survey)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return reduce(Survey.merge, pool.imap_unordered(_survey_file_task, tasks), survey)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _survey_file_task(args):
+    return survey_file(*args)
+
+
+def find_thml_files(paths):
+    """
+    Expands directories in paths to the .xml files in them.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.lower().endswith('.xml'):
+                    yield os.path.join(directory, fn)
+
+
+### Library rebuild ###
+
+# Options which don't change the output of a conversion
+NON_OUTPUT_OPTIONS = set(['thml_file', 'rebuild_library', 'state_db', 'verbose', 'jobs',
+                          'http_sleep_time', 'rate_limit_file', 'metadata_only', 'watch', 'image_cache',
+                          'progress', 'catalog', 'validate', 'validation_report'])
+
+
+def settings_fingerprint(args):
+    settings = dict((k, v) for k, v in vars(args).items() if k not in NON_OUTPUT_OPTIONS)
+    settings['converter_version'] = CONVERTER_VERSION
+    if settings.get('handler_spec'):
+        settings['handler_spec'] = file_sha1(settings['handler_spec'])
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with file(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LibraryState(object):
+    """
+    Records, in an SQLite database, the inputs, settings and outputs of each
+    book converted by --rebuild-library.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT);
+            CREATE TABLE IF NOT EXISTS books (
+                book TEXT PRIMARY KEY, inputs TEXT, settings TEXT, status TEXT, error TEXT,
+                outputs TEXT, updated REAL);
+        """)
+        # Databases from before all the outputs were recorded
+        if 'outputs' not in [row[1] for row in self.db.execute("PRAGMA table_info(books)")]:
+            self.db.execute("ALTER TABLE books ADD COLUMN outputs TEXT")
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def file_hash(self, path):
+        """
+        Returns the SHA-1 of a file, only reading the file if its size or mtime
+        have changed since it was last hashed.
+        """
+        st = os.stat(path)
+        row = self.db.execute("SELECT size, mtime, sha1 FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        sha1 = file_sha1(path)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                        (path, st.st_size, st.st_mtime, sha1))
+        return sha1
+
+    def inputs_hash(self, input_files, image_directory=None):
+        """
+        Returns a hash of the input files of a book, and of the files in its
+        local image directory, if it has one.
+        """
+        paths = list(input_files)
+        if image_directory and os.path.isdir(image_directory):
+            paths += sorted(os.path.join(image_directory, fn) for fn in os.listdir(image_directory)
+                            if os.path.isfile(os.path.join(image_directory, fn)))
+        return hashlib.sha1(''.join(fn + '\0' + self.file_hash(fn) + '\0' for fn in paths)).hexdigest()
+
+    def needs_rebuild(self, book, inputs, settings):
+        row = self.db.execute("SELECT inputs, settings, status, outputs FROM books WHERE book = ?",
+                              (book,)).fetchone()
+        if row is None or tuple(row[:3]) != (inputs, settings, 'ok') or row[3] is None:
+            return True
+        return any(output_signature(path) != signature for path, signature in json.loads(row[3]))
+
+    def start(self, book, inputs, settings):
+        self.db.execute("INSERT OR REPLACE INTO books (book, inputs, settings, status, updated) "
+                        "VALUES (?, ?, ?, 'running', ?)", (book, inputs, settings, time.time()))
+        self.commit()
+
+    def finish(self, book, outputs):
+        """
+        Records a book as converted to outputs, a list of paths of files or
+        directories.
+        """
+        outputs = json.dumps([[path, output_signature(path)] for path in outputs])
+        self.db.execute("UPDATE books SET status = 'ok', outputs = ?, updated = ? WHERE book = ?",
+                        (outputs, time.time(), book))
+        self.commit()
+
+    def fail(self, book, error):
+        # Can fail before starting, e.g. with a missing input file
+        self.db.execute("INSERT OR IGNORE INTO books (book) VALUES (?)", (book,))
+        self.db.execute("UPDATE books SET status = 'failed', error = ?, updated = ? WHERE book = ?",
+                        (error, time.time(), book))
+        self.commit()
+
+    def status(self, book):
+        row = self.db.execute("SELECT status FROM books WHERE book = ?", (book,)).fetchone()
+        return None if row is None else row[0]
+
+
+def output_signature(path):
+    """
+    Returns [size, mtime] of an output file, summed and latest over the files
+    in an output directory, or None if there is no output at path.
+    """
+    if os.path.isdir(path):
+        size, mtime = 0, 0
+        for directory, dirnames, filenames in os.walk(path):
+            for fn in filenames:
+                st = os.stat(os.path.join(directory, fn))
+                size, mtime = size + st.st_size, max(mtime, st.st_mtime)
+        return [size, mtime]
+    if os.path.exists(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime]
+    return None
+
+
+def read_library_list(filename):
+    """
+    Reads a list of books, one per line, each line giving the input files of
+    a book separated by whitespace. Blank lines and lines starting with # are
+    ignored. Relative paths are relative to the directory of the list.
+    """
+    base = os.path.dirname(filename)
+    books = []
+    with file(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                books.append([os.path.join(base, fn) for fn in line.split()])
+    return books
+
+
+def rebuild_library(args):
+    """
+    Converts the books listed in args.rebuild_library whose input files,
+    settings, local images or outputs have changed since they were last
+    converted successfully.
+    Books which were being converted when a previous run stopped are converted
+    again. Returns counts of books converted, skipped and failed.
+    """
+    state = LibraryState(args.state_db)
+    settings = settings_fingerprint(args)
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    try:
+        for input_files in read_library_list(args.rebuild_library):
+            book = ' '.join(input_files)
+            try:
+                inputs = state.inputs_hash(input_files, None if args.ignore_downloaded_images else
+                                           book_image_directory(input_files, args))
+                if not state.needs_rebuild(book, inputs, settings):
+                    state.commit()
+                    counts['skipped'] += 1
+                    continue
+                state.start(book, inputs, settings)
+                if args.verbose:
+                    sys.stderr.write("Converting {0}\n".format(book))
+                outputs = convert_book(input_files, args, write_feed=False)
+            except CONVERSION_ERRORS + (EnvironmentError,) as e:
+                message = conversion_error_message(e)
+                sys.stderr.write("ERROR: converting {0} failed: {1}\n".format(book, message))
+                state.fail(book, message)
+                counts['failed'] += 1
+            except Exception as e:
+                # Anything else is a bug, but shouldn't stop the rest of the
+                # library being converted.
+                message = "{0}: {1}".format(e.__class__.__name__, e)
+                sys.stderr.write("ERROR: converting {0} failed: {1}\n".format(book, message))
+                if args.verbose:
+                    traceback.print_exc()
+                state.fail(book, message)
+                counts['failed'] += 1
+            else:
+                state.finish(book, [output for f, output in outputs if output != '-'])
+                counts['converted'] += 1
+    finally:
+        state.close()
+        if args.catalog and counts['converted']:
+            write_catalog_feed(args.catalog)
+    return counts
+
+
+### Watching ###
+
+# inotify(7) event flags
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 04000
+IN_WATCH_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Changes closer together than this (seconds) are handled together
+WATCH_DEBOUNCE_TIME = 0.3
+
+
+class InotifyWatcher(object):
+    """
+    Watches files, and all the files in some directories, using inotify.
+    wait() returns the set of changed paths. Directories that don't exist
+    yet are watched for from their parent directory.
+    """
+    def __init__(self, files, directories):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.files = set(files)
+        self.directories = set(os.path.normpath(d) for d in directories)
+        self.missing = set(d for d in self.directories if not os.path.isdir(d))
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        # Files are watched through their directories, so that files replaced
+        # by editors (by renaming a new file over them) are still seen.
+        try:
+            for directory in set(os.path.dirname(fn) for fn in self.files) | \
+                    (self.directories - self.missing) | set(os.path.dirname(d) for d in self.missing):
+                self.add_watch(directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, directory):
+        if not os.path.isdir(directory):
+            return
+        wd = self.libc.inotify_add_watch(self.fd, utf8(directory), IN_WATCH_EVENTS)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {0}".format(directory))
+        self.watches[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout=None):
+        changed = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if path in self.missing and os.path.isdir(path):
+                # Files may have been added before the watch was
+                self.missing.discard(path)
+                self.add_watch(path)
+                changed.update(os.path.join(path, fn) for fn in os.listdir(path))
+            if path in self.files or directory in self.directories:
+                changed.add(path)
+        return changed
+
+
+class PollingWatcher(object):
+    """
+    Watches files, and all the files in some directories, by polling their
+    size and modification time. wait() returns the set of changed paths.
+    """
+    def __init__(self, files, directories, interval=0.5):
+        self.files = set(files)
+        self.directories = set(directories)
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def close(self):
+        pass
+
+    def take_snapshot(self):
+        paths = set(self.files)
+        for directory in self.directories:
+            if os.path.isdir(directory):
+                paths.update(os.path.join(directory, name) for name in os.listdir(directory))
+        snapshot = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def wait(self, timeout=None):
+        start = time.time()
+        while True:
+            snapshot = self.take_snapshot()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed:
+                return changed
+            if timeout is not None and time.time() - start >= timeout:
+                return changed
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+
+def make_watcher(files, directories):
+    try:
+        return InotifyWatcher(files, directories)
+    except (OSError, AttributeError):
+        # Not Linux, or out of inotify instances/watches
+        return PollingWatcher(files, directories)
+
+
+def wait_for_changes(watcher, debounce=WATCH_DEBOUNCE_TIME):
+    """
+    Waits for changes, then until there have been no more changes for the
+    debounce time, and returns all the changed paths.
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+
+def watch(args):
+    """
+    Converts the book given by args (or all the books in the
+    --rebuild-library list), and then converts each book again whenever its
+    input files or local images change, until interrupted.
+    """
+    if args.rebuild_library:
+        books = read_library_list(args.rebuild_library)
+    else:
+        books = [args.thml_file]
+    books = [[os.path.abspath(fn) for fn in input_files] for input_files in books]
+    converters = [make_converter(input_files, args, cache_images=True) for input_files in books]
+
+    def rebuild(i):
+        input_files = books[i]
+        start = time.time()
+        try:
+            convert_book(input_files, args, converter=converters[i], write_feed=False)
+        except CONVERSION_ERRORS + (EnvironmentError,) as e:
+            message = conversion_error_message(e)
+        except Exception as e:
+            # As in rebuild_library, a bug shows up as a failed book, and
+            # watching carries on.
+            message = "{0}: {1}".format(e.__class__.__name__, e)
+            if args.verbose:
+                traceback.print_exc()
+        else:
+            sys.stderr.write("Converted {0} in {1:.2f}s\n".format(', '.join(input_files), time.time() - start))
+            return
+        sys.stderr.write("ERROR: converting {0} failed: {1}\n".format(', '.join(input_files), message))
+
+    def rebuild_all(indexes):
+        # The catalog feed is written once for all the books
+        for i in indexes:
+            rebuild(i)
+        if args.catalog and indexes:
+            write_catalog_feed(args.catalog)
+
+    rebuild_all(range(len(books)))
+
+    image_directories = [os.path.abspath(c.image_directory) if c.image_directory else None for c in converters]
+    watcher = make_watcher(set(fn for input_files in books for fn in input_files),
+                           set(d for d in image_directories if d is not None))
+    sys.stderr.write("Watching for changes ({0})\n".format(watcher.__class__.__name__))
+    try:
+        while True:
+            changed = wait_for_changes(watcher)
+            sys.stderr.write("Changed: {0}\n".format(', '.join(sorted(changed))))
+            rebuild_all([i for i, input_files in enumerate(books)
+                         if changed.intersection(input_files) or
+                         any(os.path.dirname(path) == image_directories[i] for path in changed)])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
 ### Main ###
 
 parser = argparse.ArgumentParser()
-parser.add_argument("thml_file", nargs='+')
+parser.add_argument("thml_file", nargs='*')
 parser.add_argument("--download-images", action='store_true',
                     help="Attempt to download images from CCEL. WORK IN PROGRESS")
 parser.add_argument("--save-downloaded-images-to", default="%d/%f_files/",
@@ -1063,15 +4359,97 @@ parser.add_argument("--save-downloaded-images-to", default="%d/%f_files/",
 This saves downloading same files over and over. Set to empty to disable.""")
 parser.add_argument("--ignore-downloaded-images", default=False, action='store_true',
                     help="""Don't use previously downloaded images - always attempt to re-download.""")
+parser.add_argument("--optimize-images", action='store_true',
+                    help="""Store identical images once, and downscale, recompress or convert images
+to make them smaller. Requires Pillow""")
+parser.add_argument("--image-max-size", type=int, default=1200,
+                    help="Maximum width and height of images in pixels for --optimize-images. Default: %(default)s")
+parser.add_argument("--image-quality", type=int, default=80,
+                    help="JPEG quality for --optimize-images. Default: %(default)s")
+parser.add_argument("--image-cache", default="",
+                    help="""Directory to cache optimized images in, with the same substitutions as
+--output. Default: no cache""")
 parser.add_argument("--http-sleep-time", action='store', default=1, type=int,
                     help="Amount to sleep in seconds between HTTP requests when downloading, to avoid slamming CCEL")
-parser.add_argument("--output", default="%d/%f.rough.epub",
+parser.add_argument("--rate-limit-file", metavar='FILE',
+                    help="""Share the --http-sleep-time rate limit with all converter processes on the
+machine that use the same FILE, instead of limiting each process separately""")
+parser.add_argument("--format", action='append', choices=sorted(WRITERS.keys()),
+                    help="""Output format. Can be given more than once to write several formats
+from one conversion. Default: epub""")
+parser.add_argument("--output", default=EpubWriter.default_output,
                     help="""Template for the output filename. Default: %(default)s. Substitutions are:
 %%d: directory of first input filename;
 %%f: basename of first input filename without extension;
 %%t: title extracted from metadata;
-%%a: author extracted from metadata;
+%%a: author extracted from metadata.
+Use - to write to stdout.
                      """)
+parser.add_argument("--deterministic", action='store_true',
+                    help="""Produce identical output for identical input, using an identifier
+derived from the content if the book has none, and fixed timestamps in the epub""")
+parser.add_argument("--jobs", action='store', default=1, type=int,
+                    help="Number of processes to use to convert the input files of a book")
+parser.add_argument("--max-elements", type=int, default=None,
+                    help="Fail if an input file has more than this many elements")
+parser.add_argument("--max-depth", type=int, default=None,
+                    help="Fail if elements in an input file are nested deeper than this")
+parser.add_argument("--max-input-bytes", type=int, default=None,
+                    help="Fail if an input file is bigger than this")
+parser.add_argument("--max-images", type=int, default=None,
+                    help="Fail if the book uses more than this many images")
+parser.add_argument("--max-downloads", type=int, default=None,
+                    help="Fail if fetching images needs more than this many HTTP requests")
+parser.add_argument("--timeout", type=float, default=None,
+                    help="Fail if converting an input file, or fetching the images, takes more than this many seconds")
+parser.add_argument("--max-memory", type=int, default=None,
+                    help="Fail if the process uses more than this many megabytes of memory")
+parser.add_argument("--notes", choices=['inline', 'file', 'book'], default='inline',
+                    help="""Where to put notes: at the end of each top level div (inline), on a page
+after each input file (file), or on one page at the end of the book (book). Default: %(default)s""")
+parser.add_argument("--inline-styles", action='store_true',
+                    help="""Keep CSS style blocks in each document, instead of collecting them into a
+shared stylesheet""")
+parser.add_argument("--preview", type=int, metavar='N',
+                    help="""Convert only the first N top level div1s of the book, for a sample.
+Parsing stops there, so this is fast for large books""")
+parser.add_argument("--preview-bytes", type=int, metavar='BYTES',
+                    help="""Like --preview, but stop after the top level element in which about BYTES of
+input have been read. Can be combined with --preview""")
+parser.add_argument("--no-index-page", action='store_true',
+                    help="Don't add an index page to the end of the book for indexes that have no insertIndex element")
+parser.add_argument("--catalog", default="",
+                    help="Directory of an OPDS catalog (catalog.xml and catalog.json) to add the converted book to")
+parser.add_argument("--validate", action='store_true',
+                    help="Check the structure of the epub that is created, printing problems found")
+parser.add_argument("--validation-report", default="",
+                    help="File to write a JSON report of validation to (implies --validate)")
+parser.add_argument("--metadata-only", action='store_true',
+                    help="Print the DC metadata of the input files as JSON, without converting them")
+parser.add_argument("--epub-dir-output", default=EpubDirectoryWriter.default_output,
+                    help="Template for the output directory for --format=epub-dir. Default: %(default)s")
+parser.add_argument("--xhtml-output", default=XhtmlWriter.default_output,
+                    help="Template for the output filename for --format=xhtml. Default: %(default)s")
+parser.add_argument("--text-output", default=TextWriter.default_output,
+                    help="Template for the output filename for --format=text. Default: %(default)s")
+parser.add_argument("--handler-spec", metavar='FILE',
+                    help="""JSON file of handler rules. The rules for a tag replace the built-in handling
+of that tag""")
+parser.add_argument("--survey", action='store_true',
+                    help="""Instead of converting, list the elements and attributes in the input files
+that the converter doesn't handle, most common first. Directories are searched
+for .xml files. Uses --jobs processes""")
+parser.add_argument("--rebuild-library", metavar="LISTFILE",
+                    help="""Convert the books listed in LISTFILE, one per line with the input files
+of a book separated by spaces, skipping books that are unchanged since they were last converted.
+Requires --state-db""")
+parser.add_argument("--state-db", metavar="DB",
+                    help="SQLite database recording what --rebuild-library has converted")
+parser.add_argument("--watch", action='store_true',
+                    help="""Keep running, and convert the book again whenever its input files or
+local images change. With --rebuild-library, watch all the books in the list""")
+parser.add_argument("--progress", action='store_true',
+                    help="Report progress on stderr")
 parser.add_argument("--verbose", action='store_true',
                     help="Print more debugging information")
 
@@ -1096,22 +4474,157 @@ def do_substitutions(template, directory, basename, metadata):
     return template
 
 
+CONVERSION_ERRORS = (LimitExceeded, etree.XMLSyntaxError, MemoryError)
+
+
+def conversion_error_message(e):
+    return str(e) or e.__class__.__name__
+
+
 def main():
     args = parser.parse_args()
     input_files = args.thml_file
-    input_thml_pairs = [(fn, file(fn).read()) for fn in input_files]
+    if args.optimize_images and Image is None:
+        parser.error("--optimize-images requires Pillow")
+    if args.preview is not None and args.preview < 1:
+        parser.error("--preview must be at least 1")
+    if args.preview_bytes is not None and args.preview_bytes < 1:
+        parser.error("--preview-bytes must be at least 1")
+    if args.handler_spec:
+        try:
+            load_handler_spec(args.handler_spec)
+        except (HandlerSpecError, EnvironmentError) as e:
+            parser.error("bad --handler-spec: {0}".format(e))
+    if args.watch:
+        if not input_files and not args.rebuild_library:
+            parser.error("no input files")
+        watch(args)
+        return
+    if args.rebuild_library:
+        if not args.state_db:
+            parser.error("--rebuild-library requires --state-db")
+        counts = rebuild_library(args)
+        sys.stderr.write("{converted} converted, {skipped} unchanged, {failed} failed\n".format(**counts))
+        if counts['failed']:
+            sys.exit(1)
+        return
+    if not input_files:
+        parser.error("no input files")
+    if args.survey:
+        survey_corpus(find_thml_files(input_files), jobs=args.jobs,
+                      handler_spec=args.handler_spec).report(sys.stdout)
+        return
+    if args.metadata_only:
+        metadata = {}
+        for fn in input_files:
+            merge_metadata(metadata, read_metadata(fn))
+        json.dump(metadata, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+    try:
+        convert_book(input_files, args)
+    except CONVERSION_ERRORS as e:
+        sys.stderr.write("ERROR: converting {0} failed: {1}\n".format(', '.join(input_files),
+                                                                     conversion_error_message(e)))
+        sys.exit(1)
+
+
+def book_image_directory(input_files, args):
+    directory = os.path.dirname(input_files[0])
+    basename = os.path.basename(input_files[0])
+    return do_substitutions(args.save_downloaded_images_to, directory, basename, None)
+
+
+def make_converter(input_files, args, cache_images=False):
+    image_directory = book_image_directory(input_files, args)
+    limits = Limits(max_elements=args.max_elements,
+                    max_depth=args.max_depth,
+                    max_input_bytes=args.max_input_bytes,
+                    max_images=args.max_images,
+                    max_downloads=args.max_downloads,
+                    timeout=args.timeout,
+                    max_memory=None if args.max_memory is None else args.max_memory * 1024 * 1024)
+    return ThmlToHtml(download_images=args.download_images,
+                      http_sleep_time=args.http_sleep_time,
+                      image_directory=image_directory,
+                      ignore_downloaded_images=args.ignore_downloaded_images,
+                      limits=limits,
+                      cache_images=cache_images,
+                      separate_notes=args.notes != 'inline',
+                      shared_stylesheet=not args.inline_styles,
+                      rate_limit_file=args.rate_limit_file,
+                      handler_spec=args.handler_spec,
+                      index_page=not args.no_index_page,
+                      progress=ProgressReporter(callback=report_progress if args.progress else None))
+
+
+def report_progress(event):
+    sys.stderr.write(str(event) + "\n")
+
+
+def convert_book(input_files, args, converter=None, write_feed=True):
+    """
+    Converts the input files of a book with the options in args (as parsed by
+    the command line parser), and returns a list of (format, output filename)
+    pairs. A converter from make_converter for the same book can be passed in
+    to be reused. With write_feed=False, the book is added to the --catalog,
+    but the catalog feed is left for the caller to write.
+    """
     directory = os.path.dirname(input_files[0])
     basename = os.path.basename(input_files[0])
-    image_directory = do_substitutions(args.save_downloaded_images_to, directory, basename, None)
-    converter = ThmlToHtml(download_images=args.download_images,
-                           http_sleep_time=args.http_sleep_time,
-                           image_directory=image_directory,
-                           ignore_downloaded_images=args.ignore_downloaded_images)
-    input_html_pairs = [(fn, converter.transform(t, full_xml=True)) for fn, t in input_thml_pairs]
-    outputfile = do_substitutions(args.output, directory, basename, converter.metadata)
-    if args.verbose:
-        sys.stderr.write("Writing to {0}\n".format(outputfile))
-    create_epub(input_html_pairs, converter.metadata, getattr(converter, 'img_files', []), outputfile)
+    if converter is None:
+        converter = make_converter(input_files, args)
+    else:
+        converter.reset()
+    if args.preview is not None or args.preview_bytes is not None:
+        input_html_pairs = converter.transform_preview(input_files, max_chapters=args.preview,
+                                                       max_bytes=args.preview_bytes, full_xml=True)
+    else:
+        input_html_pairs = converter.transform_files(input_files, full_xml=True, jobs=args.jobs)
+    converter.fetch_images()
+    if args.verbose and converter.rate_limiter is not None:
+        sys.stderr.write("Image downloads: {0}\n".format(converter.rate_limiter))
+    if args.optimize_images:
+        converter.img_files = optimize_images(converter.img_files, [d for fn, d in input_html_pairs],
+                                              max_dimension=args.image_max_size,
+                                              quality=args.image_quality,
+                                              cache_directory=do_substitutions(args.image_cache, directory,
+                                                                               basename, None),
+                                              jobs=args.jobs)
+    formats = args.format or ['epub']
+    output_templates = {
+        'epub': args.output,
+        'epub-dir': args.epub_dir_output,
+        'xhtml': args.xhtml_output,
+        'text': args.text_output,
+    }
+    # All the names are needed before writing, which changes the metadata
+    outputs = [(f, do_substitutions(output_templates[f], directory, basename, converter.metadata))
+               for f in formats]
+    book = Book(input_html_pairs, converter.metadata, converter.img_files, index_page=not args.no_index_page,
+                deterministic=args.deterministic, progress=converter.progress,
+                notes='file' if args.notes == 'inline' else args.notes)
+    for f, output in outputs:
+        if args.verbose:
+            sys.stderr.write("Writing to {0}\n".format(output))
+        WRITERS[f](sys.stdout if output == '-' else output).write(book)
+    outputfile = dict(outputs).get('epub')
+    if outputfile == '-':
+        outputfile = None
+
+    if args.validate or args.validation_report:
+        messages = validate_epub(book.package)
+        for m in messages:
+            sys.stderr.write(str(m) + "\n")
+        if args.validation_report:
+            with file(args.validation_report, 'w') as f:
+                json.dump(validation_report(messages), f, indent=2)
+    if args.catalog:
+        if outputfile is None:
+            sys.stderr.write("WARNING: no epub file written, not adding to catalog\n")
+        else:
+            update_catalog(args.catalog, converter.metadata, outputfile, write_feed=write_feed)
+    return outputs
 
 
 ### Tests ###
@@ -1257,5 +4770,1072 @@ def test_toc_extraction():
         TocItem("Chapter 2", "_gentocid_4", [])
         ]
 
+def test_scripref():
+    assert fix_passage_ref('Gen. 1:1') == 'Genesis 1:1'
+    assert fix_passage_ref('1 Cor. 13:4') == '1 Corinthians 13:4'
+    assert fix_passage_ref('II Kings 2:11') == '2 Kings 2:11'
+    assert fix_passage_ref('Isa. 53:5') == 'Isaiah 53:5'
+    assert fix_passage_ref('Song of Solomon 2:1') == 'Song of Solomon 2:1'
+    assert fix_passage_ref('Foo 1.2') == 'Foo 1 2'
+    assert fix_osis_ref('Bible:Gen.1.1') == 'Genesis 1:1'
+    assert fix_osis_ref('Bible:John.3.16-John.3.18') == 'John 3:16-18'
+    assert fix_osis_ref('Bible:Matt.5.3-Matt.6.2 Bible:Rom.8') == 'Matthew 5:3-6:2; Romans 8'
+
+    resolver = ScripRefResolver(maxsize=2)
+    results = resolver.resolve_many([('Jn 3:16', None), ('Jn 3:16', None), (None, 'Bible:John.3.16')])
+    assert results[0] == results[1] == results[2] == \
+        ('John 3:16', 'https://www.biblegateway.com/passage/?search=John%203%3A16&version=NIV')
+    assert resolver.misses == 2
+    resolver.resolve('Rom 1')
+    assert len(resolver.cache) == 2
+    assert ('Jn 3:16', None) not in resolver.cache
+
+    assert thml_to_html('<ThML><scripRef passage="Mt. 5:3">Matt. v. 3</scripRef></ThML>').strip() == \
+        '<html>\n  <a href="https://www.biblegateway.com/passage/?search=Matthew%205%3A3&amp;version=NIV" id="_genrid_1">Matt. v. 3</a>\n</html>'
+
+def test_index():
+    converter = ThmlToHtml()
+    source = """<ThML><ThML.body>
+<div1 title="Chapter 1">
+<p><scripRef passage="Rom. 8:28">a</scripRef> <scripRef passage="Gen. 1:1">b</scripRef>
+<scripRef passage="Romans 8:28" id="r">c</scripRef><index type="subject" subject1="Grace"/></p>
+</div1>
+<div1 title="Scripture Index"><insertIndex type="scripRef"/></div1>
+</ThML.body></ThML>"""
+    doc = converter.transform(source)
+    assert ('<div class="index" id="_genxid_1">'
+            '<p class="indexentry">Genesis 1:1: <a href="#_genrid_3">1</a></p>'
+            '<p class="indexentry">Romans 8:28: <a href="#_genrid_2">1</a>, <a href="#r">2</a></p>'
+            '</div>') in doc.html
+    assert '<a id="_genrid_1"/>' in doc.html
+    assert doc.index.placed == set(['scripRef'])
+    assert doc.index.unplaced_types() == ['subject']
+
+    index_file = make_index_file([('book.xml', doc)])
+    assert index_file[0] == "OEBPS/index.html"
+    assert '<p class="indexentry">Grace: <a href="1.html#_genrid_1">1</a></p>' in index_file[1]
+    assert index_file[3].items == [TocItem('Subject Index', 'index-subject', [])]
+
+    # In a book, the placeholder gets the entries of all the documents
+    docs = [('a.xml', converter.transform('<ThML><ThML.body><div1 title="One"><p>'
+                                          '<scripRef passage="Jn 3:16">a</scripRef></p></div1></ThML.body></ThML>',
+                                          full_xml=True)),
+            ('b.xml', converter.transform(source, full_xml=True, doc_num=2))]
+    package = build_epub(docs, converter.metadata, [])
+    html = etree.fromstring(package.content_files[1].content)
+    entries = html.xpath('//h:div[@id="_genxid_2_1"]/h:p', namespaces={'h': XHTML_NS})
+    assert [p.text for p in entries] == ['Genesis 1:1: ', 'John 3:16: ', 'Romans 8:28: ']
+    assert entries[1].xpath('h:a/@href', namespaces={'h': XHTML_NS}) == ['1.html#_genrid_1']
+    assert entries[2].xpath('h:a/@href', namespaces={'h': XHTML_NS}) == ['2.html#_genrid_2_2', '2.html#r']
+    assert [f.file_name for f in package.content_files] == ['OEBPS/1.html', 'OEBPS/2.html', 'OEBPS/index.html']
+    assert 'Scripture Index' not in package.content_files[2].content
+
+    # Without an index page, only documents with a scripture index give
+    # references ids
+    converter = ThmlToHtml(index_page=False)
+    doc = converter.transform('<ThML><ThML.body><div1 title="One"><p>'
+                              '<scripRef passage="Jn 3:16">a</scripRef></p></div1></ThML.body></ThML>')
+    assert 'genrid' not in doc.html and doc.index.entries == {}
+    assert 'id="_genrid_2"' in converter.transform(source).html
+
+    # ... which is decided for the whole book, so an index in the last file
+    # lists the references in all of them
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(directory, 'a.xml'), os.path.join(directory, 'b.xml')]
+        with file(filenames[0], 'w') as f:
+            f.write('<ThML><ThML.body><div1 title="One"><p><scripRef passage="Gen 1:1">a</scripRef>'
+                    '<scripRef passage="Jn 3:16">b</scripRef></p></div1></ThML.body></ThML>')
+        with file(filenames[1], 'w') as f:
+            f.write(source)
+        assert not has_scripture_index(filenames[0]) and has_scripture_index(filenames[1])
+        for jobs in [1, 2]:
+            converter = ThmlToHtml(index_page=False)
+            docs = converter.transform_files(filenames, full_xml=True, jobs=jobs)
+            package = build_epub(docs, converter.metadata, [], index_page=False)
+            html = etree.fromstring(package.content_files[1].content)
+            assert [p.text for p in html.xpath('//h:p[@class="indexentry"]', namespaces={'h': XHTML_NS})] == \
+                ['Genesis 1:1: ', 'John 3:16: ', 'Romans 8:28: ']
+            assert validate_epub(package) == []
+    finally:
+        shutil.rmtree(directory)
+
+def test_read_metadata():
+    import tempfile
+    f = tempfile.NamedTemporaryFile(suffix='.xml')
+    f.write("""<ThML>
+<ThML.head>
+<electronicEdInfo>
+ <DC>
+ <DC.Title>Interesting Things</DC.Title>
+ <DC.Creator sub="Author" scheme="file-as">Daffy Duck</DC.Creator>
+ <DC.Title>Interesting Things</DC.Title>
+ </DC>
+</electronicEdInfo>
+</ThML.head>
+<ThML.body>
+<DC><DC.Title>Not metadata</DC.Title></DC>
+<p>Broken & not well formed
+""")
+    f.flush()
+    metadata = read_metadata(f.name)
+    assert metadata == {'dc:title': [("Interesting Things", {})],
+                        'dc:creator': [("Daffy Duck", {'sub': 'Author', 'scheme': 'file-as'})]}
+    assert merge_metadata(metadata, {'dc:title': [("Interesting Things", {}), ("Other", {})]}) == \
+        {'dc:title': [("Interesting Things", {}), ("Other", {})],
+         'dc:creator': [("Daffy Duck", {'sub': 'Author', 'scheme': 'file-as'})]}
+
+def test_opds_catalog():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        metadata = {'dc:title': [("Things & Stuff", {})],
+                    'dc:creator': [("D. Duck", {'opf:role': 'aut', 'opf:file-as': "Duck, Daffy"}),
+                                   ("M. Mouse", {'opf:role': 'trl', 'opf:file-as': "Mouse, Mickey"})],
+                    'dc:identifier': [("urn:isbn:123", {'id': 'id0'})]}
+        update_catalog(directory, metadata, os.path.join(directory, 'books', 'things.epub'))
+        update_catalog(directory, dplus(metadata, {'dc:title': [("Aardvarks", {})], 'dc:identifier': []}),
+                       os.path.join(directory, 'aardvarks.epub'), write_feed=False)
+        # Only the new entry is written
+        assert len(etree.parse(os.path.join(directory, 'catalog.xml')).getroot()) == 6
+        update_catalog(directory, metadata, os.path.join(directory, 'books', 'things.epub'), write_feed=False)
+        write_catalog_feed(directory)
+
+        entries = OpdsCatalog(directory).load_entries()
+        assert sorted(entries) == ['aardvarks.epub', 'books/things.epub']
+        assert entries['books/things.epub']['creators'] == [["D. Duck", "aut", "Duck, Daffy"],
+                                                            ["M. Mouse", "trl", "Mouse, Mickey"]]
+        assert json.load(file(os.path.join(directory, 'catalog.json')))['entries'] == entries
+        feed = file(os.path.join(directory, 'catalog.xml')).read()
+        root = etree.fromstring(feed)
+        ns = {'a': 'http://www.w3.org/2005/Atom'}
+        assert root.xpath('a:entry/a:title/text()', namespaces=ns) == ["Aardvarks", "Things & Stuff"]
+        assert root.xpath('a:entry[2]/a:id/text()', namespaces=ns) == ["urn:isbn:123"]
+        assert root.xpath('a:entry[2]/a:author/a:name/text()', namespaces=ns) == ["D. Duck"]
+        assert root.xpath('a:entry[2]/a:contributor/a:name/text()', namespaces=ns) == ["M. Mouse"]
+        assert root.xpath('a:entry[2]/a:link/@href', namespaces=ns) == ["books/things.epub"]
+    finally:
+        shutil.rmtree(directory)
+
+def test_local_dtd():
+    import tempfile
+    f = tempfile.NamedTemporaryFile(suffix='.xml')
+    f.write("""<?xml version="1.0"?>
+<!DOCTYPE ThML PUBLIC "-//CCEL/DTD Theological Markup Language//EN" "http://www.example.com/dtd/ThML.dtd">
+<ThML><p>Caf&eacute; &mdash; &amp; &lt;&alpha;&gt;</p></ThML>
+""")
+    f.flush()
+    doc = ThmlToHtml().transform_file(f.name)
+    assert doc.html.strip() == \
+        u'<html>\n  <p>Caf\xe9 \u2014 &amp; &lt;\u03b1&gt;</p>\n</html>'.encode('utf-8')
+    assert find_local_dtd('dtd/ThML1.04.dtd', None) == os.path.join(DTD_DIRECTORY, 'ThML.dtd')
+    assert find_local_dtd('http://www.w3.org/TR/xhtml1/DTD/xhtml-lat1.ent', None) == \
+        os.path.join(DTD_DIRECTORY, 'xhtml-lat1.ent')
+    assert find_local_dtd('foo.dtd', None) is None
+    assert get_parser() is get_parser()
+
+    # External entities outside the catalog are never read
+    secret = tempfile.NamedTemporaryFile()
+    secret.write('secret')
+    secret.flush()
+    for doctype in ['<!DOCTYPE ThML [<!ENTITY x SYSTEM "file://{0}">]>',
+                    '<!DOCTYPE ThML [<!ENTITY % x SYSTEM "file://{0}"> %x;]>']:
+        f = tempfile.NamedTemporaryFile(suffix='.xml')
+        f.write('<?xml version="1.0"?>\n' + doctype.format(secret.name) + '\n<ThML><p>&x;</p></ThML>\n')
+        f.flush()
+        for limits in [None, Limits(max_elements=100)]:
+            try:
+                html = ThmlToHtml(limits=limits).transform_file(f.name).html
+            except etree.XMLSyntaxError:
+                continue
+            assert 'secret' not in html
+
+def test_validate_epub():
+    converter = ThmlToHtml()
+    doc = converter.transform("""<ThML><ThML.head><title>T</title></ThML.head><ThML.body>
+<div1 title="Chapter 1"><p id="a" lang="en">Hello <a href="#a">here</a> <a href="#missing">there</a></p>
+<p id="a"><img src="pic.png" alt="pic"/></p><table><row><td>x</td></row></table></div1>
+</ThML.body></ThML>""", full_xml=True)
+    package = build_epub([('book.xml', doc)], {}, [{'file_name': 'pic.png',
+                                                    'media_type': 'image/gif',
+                                                    'content': ''}])
+    messages = validate_epub(package)
+    codes = sorted(set(m.code for m in messages))
+    assert codes == ['duplicate-id', 'link-missing-fragment', 'manifest-media-type',
+                     'xhtml-attribute', 'xhtml-element']
+    assert [str(m) for m in messages if m.code == 'link-missing-fragment'] == \
+        ["ERROR: OEBPS/1.html:9: Link to missing fragment 'OEBPS/1.html#missing'"]
+    report = validation_report(messages)
+    assert report['valid'] is False
+    assert report['errors'] == len([m for m in messages if m.severity == ERROR])
+    json.dumps(report)
+
+def test_cross_file_links():
+    converter = ThmlToHtml()
+    doc1 = converter.transform("""<ThML><ThML.body>
+<div1 title="One" id="one"><p>See <a href="two.xml#two">two</a> and <a href="#one">one</a>
+and <a href="#nowhere">nowhere</a><note>A note</note></p></div1></ThML.body></ThML>""")
+    doc2 = converter.transform("""<ThML><ThML.body>
+<div1 title="Two" id="two"><p>Back to <a href="#one">one</a><note>Another</note></p></div1>
+<div1 title="Three"/></ThML.body></ThML>""", doc_num=2)
+    assert doc1.ids == set(['one', '_genid_1', '_genaid_1'])
+    assert doc1.links == set(['two', 'one', 'nowhere'])
+    assert doc2.ids == set(['two', '_gentocid_2_2', '_genid_2_1', '_genaid_2_1'])
+    html1, html2 = resolve_cross_file_links([('1.html', doc1), ('2.html', doc2)])
+    assert '<a href="2.html#two">two</a>' in html1
+    assert '<a href="#one">one</a>' in html1
+    assert '<a href="#nowhere">nowhere</a>' in html1
+    assert '<a href="1.html#one">one</a>' in html2
+    assert '<a href="#_genid_2_1" id="_genaid_2_1">' in html2
+
+def test_transform_files_parallel():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = []
+        for i, body in enumerate([
+                '<DC><DC.Title>Volume 1</DC.Title><DC.Identifier>abc</DC.Identifier></DC>',
+                '<DC><DC.Title>Volume 2</DC.Title><DC.Title>Volume 1</DC.Title></DC>',
+                '']):
+            fn = os.path.join(directory, '{0}.xml'.format(i))
+            with file(fn, 'w') as f:
+                f.write("""<ThML><ThML.head>{0}</ThML.head><ThML.body>
+<div1 title="Chapter"><p>Text<note>A note</note> <img src="/pics/{1}.png"/></p></div1>
+</ThML.body></ThML>""".format(body, i))
+            filenames.append(fn)
+
+        serial = ThmlToHtml()
+        serial_docs = serial.transform_files(filenames, full_xml=True)
+        parallel = ThmlToHtml()
+        parallel_docs = parallel.transform_files(filenames, full_xml=True, jobs=3)
+
+        assert [d.html for fn, d in serial_docs] == [d.html for fn, d in parallel_docs]
+        assert [d.toc.items for fn, d in serial_docs] == [d.toc.items for fn, d in parallel_docs]
+        assert serial.metadata == parallel.metadata == {
+            'dc:title': [("Volume 1", {}), ("Volume 2", {})],
+            'dc:identifier': [("abc", {})]}
+        assert serial.get_handler(ImgHandler).img_srcs == parallel.get_handler(ImgHandler).img_srcs
+        assert '<title>Volume 1</title>' in parallel_docs[2][1].html
+        assert 'id="_genid_2_1"' in parallel_docs[1][1].html
+
+        # Cancelling doesn't wait for the workers (each file takes seconds)
+        big_filenames = []
+        for i in range(3):
+            fn = os.path.join(directory, 'big{0}.xml'.format(i))
+            with file(fn, 'w') as f:
+                f.write('<ThML><ThML.body>{0}</ThML.body></ThML>'.format(
+                    ('<div1 title="C">' + '<p>Text <b>x</b></p>' * 2000 + '</div1>') * 50))
+            big_filenames.append(fn)
+        token = CancellationToken()
+        converter = ThmlToHtml(progress=ProgressReporter(cancellation=token))
+        threading.Timer(0.3, token.cancel).start()
+        start = time.time()
+        try:
+            converter.transform_files(big_filenames, full_xml=True, jobs=2)
+        except Cancelled:
+            pass
+        else:
+            assert False, "Expected Cancelled"
+        assert time.time() - start < 2
+        package1 = build_epub(serial_docs, serial.metadata, [])
+        package2 = build_epub(parallel_docs, parallel.metadata, [])
+        assert [f.content for f in package1.files] == [f.content for f in package2.files]
+    finally:
+        shutil.rmtree(directory)
+
+def test_limits():
+    def convert(thml, **kwargs):
+        try:
+            ThmlToHtml(limits=Limits(**kwargs)).transform(thml)
+        except LimitExceeded as e:
+            return str(e)
+
+    assert convert('<ThML><p>x</p><p>y</p></ThML>', max_elements=3) is None
+    assert convert('<ThML><p>x</p><p>y</p><p>z</p></ThML>', max_elements=3) == \
+        "More than 3 elements, on line 1"
+    assert convert('<ThML><div><div><p>x</p></div></div></ThML>', max_depth=3) is None
+    assert convert('<ThML><div><div><div><p>x</p></div></div></div></ThML>', max_depth=3) == \
+        "Elements nested more than 3 deep, on line 1"
+    assert convert('<ThML>Hello</ThML>', max_input_bytes=10) == \
+        "Input is 18 bytes, more than the limit of 10"
+    assert convert(u'<ThML>\u2014\u2014</ThML>', max_input_bytes=16) == \
+        "Input is 19 bytes, more than the limit of 16"
+
+    assert current_memory() > 0
+
+    # Memory is checked as it is now, so it can go back under the limit
+    used = [200 * 1024 * 1024]
+    real_current_memory = current_memory
+    globals()['current_memory'] = lambda: used[0]
+    try:
+        limits = Limits(max_memory=100 * 1024 * 1024)
+        try:
+            limits.check_memory()
+        except LimitExceeded as e:
+            assert str(e) == "Memory use of 209715200 bytes is over the limit of 104857600"
+        else:
+            assert False, "Expected LimitExceeded"
+        used[0] = 50 * 1024 * 1024
+        limits.check_memory()
+        Limits().check_memory()
+    finally:
+        globals()['current_memory'] = real_current_memory
+
+    limits = Limits(timeout=100)
+    limits.start_timer()
+    assert limits.request_timeout(HTTP_TIMEOUT) == HTTP_TIMEOUT
+    limits.deadline = time.time() + 10
+    assert 5 < limits.request_timeout(HTTP_TIMEOUT) <= 10
+    limits.deadline = time.time()
+    try:
+        limits.request_timeout(HTTP_TIMEOUT)
+    except LimitExceeded:
+        pass
+    else:
+        assert False, "Expected timeout"
+    assert convert('<ThML><img src="a.png"/><img src="b.png"/></ThML>', max_images=1) == \
+        "More than 1 images"
+    limits = Limits(timeout=0)
+    limits.check_interval = 1
+    try:
+        ThmlToHtml(limits=limits).transform('<ThML><p>x</p></ThML>')
+    except LimitExceeded as e:
+        assert str(e) == "Timed out after 0 seconds"
+    else:
+        assert False, "Expected timeout"
+
+    # Entity expansion is limited when limits are used
+    bomb = '<!DOCTYPE ThML [<!ENTITY a "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa">' + ''.join(
+        '<!ENTITY {0} "{1}">'.format(chr(ord('b') + i), ('&' + chr(ord('a') + i) + ';') * 10) for i in range(8)) + \
+        ']><ThML>&j;</ThML>'
+    try:
+        ThmlToHtml(limits=Limits(max_elements=1000)).transform(bomb)
+    except etree.XMLSyntaxError:
+        pass
+    else:
+        assert False, "Expected entity expansion to be stopped"
+
+def test_write_epub_to_stream():
+    class Pipe(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, data):
+            self.chunks.append(data)
+
+        def flush(self):
+            pass
+
+    import StringIO
+    converter = ThmlToHtml()
+    docs = [('a.xml', converter.transform("<ThML><ThML.body><p>Hello</p></ThML.body></ThML>", full_xml=True))]
+    pipe = Pipe()
+    package = create_epub(docs, converter.metadata, [], pipe)
+    data = ''.join(pipe.chunks)
+    assert data[30:38] == 'mimetype'
+    assert data[38:58] == 'application/epub+zip'
+    epub = zipfile.ZipFile(StringIO.StringIO(data))
+    assert epub.testzip() is None
+    info = epub.infolist()[0]
+    assert info.filename == 'mimetype'
+    assert info.compress_type == zipfile.ZIP_STORED
+    assert not info.flag_bits & 0x08
+    assert epub.namelist() == [f.file_name for f in package.files]
+    assert validate_epub(package) == []
+
+
+def test_deterministic():
+    import StringIO
+    def build(thml):
+        converter = ThmlToHtml()
+        docs = [('a.xml', converter.transform(thml, full_xml=True))]
+        out = StringIO.StringIO()
+        create_epub(docs, converter.metadata, [], out, deterministic=True)
+        return out.getvalue()
+
+    thml = """<ThML><ThML.head><DC><DC.Title>T</DC.Title><DC.Creator sub="Author" scheme="short-form">A</DC.Creator>
+<DC.Creator sub="Editor" scheme="short-form">E</DC.Creator><DC.Language>en</DC.Language></DC></ThML.head>
+<ThML.body><div1 title="One"><p>Hello</p></div1></ThML.body></ThML>"""
+    first = build(thml)
+    # Build again a day later, as far as anything reading the clock can tell
+    real_clock = time.time, time.localtime, time.gmtime
+    later = lambda: real_clock[0]() + 24 * 60 * 60
+    time.time = later
+    time.localtime = lambda secs=None: real_clock[1](later() if secs is None else secs)
+    time.gmtime = lambda secs=None: real_clock[2](later() if secs is None else secs)
+    try:
+        assert build(thml) == first
+    finally:
+        time.time, time.localtime, time.gmtime = real_clock
+    assert build(thml.replace('Hello', 'Goodbye')) != first
+
+    epub = zipfile.ZipFile(StringIO.StringIO(first))
+    assert set(i.date_time for i in epub.infolist()) == set([ZIP_DATE_TIME])
+    opf = epub.read('OEBPS/content.opf')
+    identifier = re.search(r'<dc:identifier id="bookuuid">(urn:uuid:[0-9a-f-]+)</dc:identifier>', opf).group(1)
+    assert identifier in epub.read('OEBPS/toc.ncx')
+    assert opf.index('opf:role="aut"') < opf.index('opf:role="edt"')
+
+
+def test_rebuild_library():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        def write(name, content):
+            with file(os.path.join(directory, name), 'w') as f:
+                f.write(content)
+        write('a.xml', '<ThML><ThML.body><p>A</p></ThML.body></ThML>')
+        write('b1.xml', '<ThML><ThML.body><p>B1</p></ThML.body></ThML>')
+        write('b2.xml', '<ThML><ThML.body><p>B2</p></ThML.body></ThML>')
+        write('books.txt', '# Library\na.xml\n\nb1.xml b2.xml\n')
+        db = os.path.join(directory, 'state.db')
+        args = parser.parse_args(['--rebuild-library', os.path.join(directory, 'books.txt'),
+                                  '--state-db', db, '--deterministic'])
+        def rebuild(args=args):
+            counts = rebuild_library(args)
+            return counts['converted'], counts['skipped'], counts['failed']
+
+        assert rebuild() == (2, 0, 0)
+        assert os.path.exists(os.path.join(directory, 'b1.rough.epub'))
+        assert rebuild() == (0, 2, 0)
+
+        # Touched but unchanged
+        os.utime(os.path.join(directory, 'a.xml'), (0, 0))
+        assert rebuild() == (0, 2, 0)
+
+        write('b2.xml', '<ThML><ThML.body><p>B2, changed</p></ThML.body></ThML>')
+        assert rebuild() == (1, 1, 0)
+
+        os.remove(os.path.join(directory, 'a.rough.epub'))
+        assert rebuild() == (1, 1, 0)
+
+        # Changed settings
+        assert rebuild(parser.parse_args(['--rebuild-library', args.rebuild_library, '--state-db', db,
+                                          '--deterministic', '--no-index-page'])) == (2, 0, 0)
+        assert rebuild() == (2, 0, 0)
+
+        # Interrupted
+        state = LibraryState(db)
+        state.db.execute("UPDATE books SET status = 'running' WHERE book = ?", (os.path.join(directory, 'a.xml'),))
+        state.commit()
+        state.close()
+        assert rebuild() == (1, 1, 0)
+
+        # Options that don't change the output
+        assert rebuild(parser.parse_args(['--rebuild-library', args.rebuild_library, '--state-db', db,
+                                          '--deterministic', '--validate'])) == (0, 2, 0)
+
+        # All the outputs are checked
+        args = parser.parse_args(['--rebuild-library', args.rebuild_library, '--state-db', db,
+                                  '--deterministic', '--format', 'epub', '--format', 'text'])
+        assert rebuild(args) == (2, 0, 0)
+        write('a.txt', 'Edited\n')
+        assert rebuild(args) == (1, 1, 0)
+        os.remove(os.path.join(directory, 'a.txt'))
+        assert rebuild(args) == (1, 1, 0)
+        assert rebuild(args) == (0, 2, 0)
+
+        # Local images are inputs
+        os.mkdir(os.path.join(directory, 'a_files'))
+        write('a_files/x.png', 'PNG')
+        assert rebuild(args) == (1, 1, 0)
+        assert rebuild(args) == (0, 2, 0)
+
+        # An unexpected error fails the book, not the whole rebuild
+        def broken_convert_book(input_files, args, write_feed=True):
+            if 'a.xml' in input_files[0]:
+                raise ValueError("bug")
+            return real_convert_book(input_files, args, write_feed=write_feed)
+        real_convert_book = globals()['convert_book']
+        globals()['convert_book'] = broken_convert_book
+        try:
+            write('a.xml', '<ThML><ThML.body><p>A, changed</p></ThML.body></ThML>')
+            write('b2.xml', '<ThML><ThML.body><p>B2, changed again</p></ThML.body></ThML>')
+            assert rebuild(args) == (1, 0, 1)
+        finally:
+            globals()['convert_book'] = real_convert_book
+        assert rebuild(args) == (1, 1, 0)
+
+        write('b1.xml', '<ThML><ThML.body><p>B1</p>')
+        assert rebuild(args) == (0, 1, 1)
+        assert LibraryState(db).status(os.path.join(directory, 'b1.xml') + ' ' +
+                                       os.path.join(directory, 'b2.xml')) == 'failed'
+        assert rebuild(args) == (0, 1, 1)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_watch():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        book = os.path.join(directory, 'book.xml')
+        other = os.path.join(directory, 'other.xml')
+        images = os.path.join(directory, 'images')
+        os.mkdir(images)
+        for fn in [book, other]:
+            with file(fn, 'w') as f:
+                f.write('<ThML/>')
+        for make in [lambda: PollingWatcher([book], [images], interval=0.05),
+                     lambda: InotifyWatcher([book], [images])]:
+            try:
+                watcher = make()
+            except (OSError, AttributeError):
+                continue  # no inotify
+            try:
+                assert watcher.wait(0.1) == set()
+                with file(other, 'w') as f:
+                    f.write('<ThML/>\n')
+                assert watcher.wait(0.1) == set()
+                time.sleep(0.01)  # let mtime change for the polling watcher
+                with file(book, 'w') as f:
+                    f.write('<ThML></ThML>')
+                with file(os.path.join(images, 'a.png'), 'w') as f:
+                    f.write('PNG')
+                assert wait_for_changes(watcher, debounce=0.2) == set([book, os.path.join(images, 'a.png')])
+            finally:
+                watcher.close()
+
+        # Directories created after watching starts
+        for make in [lambda later: PollingWatcher([book], [later], interval=0.05),
+                     lambda later: InotifyWatcher([book], [later])]:
+            later = os.path.join(directory, 'later{0}'.format(id(make)))
+            try:
+                watcher = make(later)
+            except (OSError, AttributeError):
+                continue  # no inotify
+            try:
+                os.mkdir(later)
+                with file(os.path.join(later, 'b.png'), 'w') as f:
+                    f.write('PNG')
+                assert wait_for_changes(watcher, debounce=0.2) == set([os.path.join(later, 'b.png')])
+                with file(os.path.join(later, 'c.png'), 'w') as f:
+                    f.write('PNG')
+                assert wait_for_changes(watcher, debounce=0.2) == set([os.path.join(later, 'c.png')])
+            finally:
+                watcher.close()
+
+        # A bug converting a book doesn't stop watching
+        def broken_convert_book(input_files, args, converter=None, write_feed=True):
+            raise ValueError("bug")
+        def interrupt(watcher, debounce=None):
+            raise KeyboardInterrupt()
+        real = convert_book, wait_for_changes
+        globals()['convert_book'], globals()['wait_for_changes'] = broken_convert_book, interrupt
+        try:
+            watch(parser.parse_args(['--watch', book]))
+        finally:
+            globals()['convert_book'], globals()['wait_for_changes'] = real
+
+        # Reusing a converter
+        converter = ThmlToHtml(image_directory=images, cache_images=True)
+        converter.transform('<ThML><ThML.head><DC><DC.Title>T</DC.Title></DC></ThML.head>'
+                            '<ThML.body><img src="a.png"/></ThML.body></ThML>')
+        assert converter.metadata['dc:title'] == [('T', {})]
+        assert [f['content'] for f in converter.img_files] == ['PNG']
+        converter.reset()
+        converter.transform('<ThML><ThML.body><p>Hi</p></ThML.body></ThML>')
+        assert converter.metadata == {}
+        assert converter.img_files == []
+        assert converter.image_cache.keys() == [os.path.join(images, 'a.png')]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_text_coalescing():
+    # Unwrapped tail text goes before the unwrapped node's children
+    assert thml_to_html('<ThML>a <added>b<i>c</i>d</added> e</ThML>').strip() == \
+        '<html>a b e<i>c</i>d</html>'
+    assert thml_to_html('<ThML><p>' + '<added>x</added>-<deleted>y</deleted>+' * 1000 + '</p></ThML>').strip() == \
+        '<html>\n  <p>' + 'x-+' * 1000 + '</p>\n</html>'
+    assert thml_to_html('<ThML><p>a<b>b</b><unclear>c<i>d</i></unclear>e<added>f</added></p></ThML>').strip() == \
+        '<html>\n  <p>a<b>b</b>ce<i>d</i>f</p>\n</html>'
+
+
+def test_release_after_transform():
+    import tempfile
+    converter = ThmlToHtml()
+    html_doc = converter.transform('<ThML><ThML.body><div1 title="A"><p><l>Line</l><note>N</note></p></div1>'
+                                   '</ThML.body></ThML>', full_xml=True)
+    assert not hasattr(html_doc, '__dict__')
+    assert html_doc.toc.node_map == {}
+    assert converter.get_handler(LineHandler).collected_nodes == []
+    assert converter.get_handler(NoteHandler).notes == []
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write('GIF89a')
+        f.flush()
+        package = build_epub([('a.xml', html_doc)], converter.metadata,
+                             [{'file_name': 'a.gif', 'media_type': 'image/gif', 'path': f.name}])
+        image = package.content_files.files[-1]
+        assert image._content is None
+        assert image.content == 'GIF89a'
+        assert image._content is None
+
+
+def test_optimize_images():
+    if Image is None:
+        return  # Pillow is optional
+    import random
+    import shutil
+    import tempfile
+
+    def png(size, mode='RGB'):
+        image = Image.new(mode, size)
+        rnd = random.Random(1)
+        image.putdata([tuple(rnd.randrange(256) for c in mode) for i in range(size[0] * size[1])])
+        return encode_image(image, 'PNG')
+
+    photo = png((400, 300))
+    icon = png((16, 16), 'RGBA')
+    converter = ThmlToHtml()
+    doc = converter.transform('<ThML><ThML.body><p><img src="a.png" alt=""/><img src="b.png" alt=""/><img src="icon.png" alt=""/>'
+                              '</p></ThML.body></ThML>', full_xml=True)
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(2):
+            html_doc = copy.copy(doc)
+            img_files = [{'file_name': 'a.png', 'media_type': 'image/png', 'content': photo},
+                         {'file_name': 'b.png', 'media_type': 'image/png', 'content': photo},
+                         {'file_name': 'icon.png', 'media_type': 'image/png', 'content': icon}]
+            new_img_files = optimize_images(img_files, [html_doc], max_dimension=200,
+                                            cache_directory=directory, jobs=2)
+            assert [(f['file_name'], f['media_type']) for f in new_img_files] == \
+                [('a.jpg', 'image/jpeg'), ('icon.png', 'image/png')]
+            assert Image.open(StringIO.StringIO(image_content(new_img_files[0]))).size == (200, 150)
+            assert image_content(new_img_files[1]) == icon
+            assert re.findall(r'src="([^"]*)"', html_doc.html) == ['a.jpg', 'a.jpg', 'icon.png']
+        assert len(os.listdir(directory)) == 2
+
+        package = build_epub([('a.xml', html_doc)], {}, new_img_files)
+        opf = package.opf_file.content
+        assert 'href="a.jpg" media-type="image/jpeg"' in opf
+        assert opf.count('<itemref ') == 1
+        assert validate_epub(package) == []
+
+        # Images in notes moved to a notes page
+        converter = ThmlToHtml(separate_notes=True)
+        html_doc = converter.transform('<ThML><ThML.body><div1 title="One"><p><img src="a.png" alt=""/>'
+                                       '<note><img src="b.png" alt=""/></note></p></div1></ThML.body></ThML>',
+                                       full_xml=True)
+        img_files = [{'file_name': 'a.png', 'media_type': 'image/png', 'content': photo},
+                     {'file_name': 'b.png', 'media_type': 'image/png', 'content': photo}]
+        new_img_files = optimize_images(img_files, [html_doc], max_dimension=200)
+        assert re.findall(r'src="([^"]*)"', html_doc.notes.html) == ['a.jpg']
+        package = build_epub([('a.xml', html_doc)], {}, new_img_files, notes='file')
+        assert [f.file_name for f in package.content_files][:2] == ['OEBPS/1.html', 'OEBPS/1-notes.html']
+        assert validate_epub(package) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_progress():
+    thml = '<ThML><ThML.body>{0}</ThML.body></ThML>'.format(
+        ''.join('<div1 title="Chapter {0}">{1}</div1>'.format(i, '<p>Text</p>' * 100) for i in range(5)))
+    events = []
+    progress = ProgressReporter(callback=events.append, interval=0)
+    converter = ThmlToHtml(progress=progress)
+    html_doc = converter.transform(thml, full_xml=True)
+    phases = [e.phase for e in events]
+    assert phases[0] == 'parse'
+    assert phases.index('descend') < phases.index('post_process') < phases.index('serialize')
+    descend_events = [e for e in events if e.phase == 'descend' and e.count]
+    assert descend_events[-1].count == 500
+    assert descend_events[-1].total == 507
+    assert descend_events[-1].title == 'Chapter 4'
+    assert descend_events[-1].rate > 0 and descend_events[-1].eta >= 0
+    assert 'IndexHandler' not in [e.detail for e in events if e.phase == 'post_process']
+    assert 'InsertIndexHandler' in [e.detail for e in events if e.phase == 'post_process']
+    str(descend_events[-1])
+
+    del events[:]
+    create_epub([('a.xml', html_doc)], converter.metadata, [], StringIO.StringIO(), progress=progress)
+    assert [e.count for e in events if e.phase == 'write'] == [0, 0, 1, 2, 3, 4]
+
+    # Cancelling
+    token = CancellationToken()
+    def cancel(event):
+        if event.phase == 'descend' and event.title == 'Chapter 2':
+            token.cancel()
+    converter = ThmlToHtml(progress=ProgressReporter(callback=cancel, cancellation=token, interval=0))
+    try:
+        converter.transform(thml)
+    except Cancelled:
+        pass
+    else:
+        assert False, "Expected Cancelled"
+    start = time.time()
+    try:
+        ProgressReporter(cancellation=token).sleep(10)
+    except Cancelled:
+        pass
+    assert time.time() - start < 1
+
+
+def test_background_converter():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        books = []
+        for b in range(3):
+            filenames = []
+            for i in range(2):
+                fn = os.path.join(directory, 'book{0}_{1}.xml'.format(b, i))
+                with file(fn, 'w') as f:
+                    f.write('<ThML><ThML.head><DC><DC.Title>Book {0}</DC.Title></DC></ThML.head><ThML.body>'
+                            '<div1 title="Part {1}"><p>Text<note>Note</note></p></div1>'
+                            '</ThML.body></ThML>'.format(b, i))
+                filenames.append(fn)
+            books.append(filenames)
+
+        def serial(filenames):
+            converter = ThmlToHtml()
+            out = StringIO.StringIO()
+            create_epub(converter.transform_files(filenames, full_xml=True), converter.metadata, [], out,
+                        deterministic=True)
+            return out.getvalue()
+
+        done = []
+        with BackgroundConverter(threads=2, processes=2) as background:
+            outputs = [StringIO.StringIO() for b in books]
+            handles = [background.submit(filenames, out, callback=done.append, deterministic=True)
+                       for filenames, out in zip(books, outputs)]
+            for handle in handles:
+                assert isinstance(handle.get(timeout=30), EpubPackage)
+                assert handle.ready()
+            assert [out.getvalue() for out in outputs] == [serial(filenames) for filenames in books]
+            assert len(done) == 3
+
+            started = threading.Event()
+            proceed = threading.Event()
+            def wait_for_cancel(event):
+                started.set()
+                proceed.wait()
+            handle = background.submit(books[0], StringIO.StringIO(), progress_callback=wait_for_cancel)
+            started.wait()
+            handle.cancel()
+            proceed.set()
+            try:
+                handle.get(timeout=30)
+            except Cancelled:
+                pass
+            else:
+                assert False, "Expected Cancelled"
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_writers():
+    import shutil
+    import tempfile
+    converter = ThmlToHtml()
+    docs = [('a.xml', converter.transform("""<ThML><ThML.head><DC><DC.Title>Book</DC.Title></DC></ThML.head>
+<ThML.body><div1 title="One"><p>Some   <b>bold</b>
+text<note>A note</note></p><p>See <a href="b.xml#two">two</a></p></div1></ThML.body></ThML>""", full_xml=True)),
+            ('b.xml', converter.transform("""<ThML><ThML.body><div1 title="Two" id="two"><h1>Two</h1>
+<p>Line<br/>break</p></div1></ThML.body></ThML>""", full_xml=True, doc_num=2))]
+    book = Book(docs, converter.metadata, [])
+    directory = tempfile.mkdtemp()
+    try:
+        paths = dict((f, os.path.join(directory, 'out.' + f)) for f in WRITERS)
+        for f, path in paths.items():
+            WRITERS[f](path).write(book)
+
+        assert file(paths['text']).read() == \
+            "Book\nSome bold text[1]\nSee two\n[^1] A note\nBook\nTwo\nLine\nbreak\n"
+
+        xhtml = etree.parse(paths['xhtml']).getroot()
+        ns = {'h': XHTML_NS}
+        assert xhtml.xpath('h:head/h:title/text()', namespaces=ns) == ['Book']
+        assert xhtml.xpath('//h:a[text()="two"]/@href', namespaces=ns) == ['#two']
+        assert [d.get('id') for d in xhtml.xpath('h:body/h:div', namespaces=ns)] == ['_gentocid_1', 'two']
+
+        assert sorted(zipfile.ZipFile(paths['epub']).namelist()) == \
+            sorted(f.file_name for f in book.package.files)
+        assert file(os.path.join(paths['epub-dir'], 'OEBPS', '1.html')).read() == \
+            book.package.content_files[0].content
+    finally:
+        shutil.rmtree(directory)
+
+def test_endnotes():
+    source = """<ThML><ThML.body>
+<div1 title="One"><p>A<note id="n1">First</note> b<note>Second</note></p></div1>
+<div1 title="Two"><p>C<note>Third</note></p></div1></ThML.body></ThML>"""
+    inline = ThmlToHtml().transform(source)
+    converter = ThmlToHtml(separate_notes=True)
+    docs = [('a.xml', converter.transform(source)), ('b.xml', converter.transform(source, doc_num=2))]
+    doc = docs[0][1]
+    assert 'class="notes"' not in doc.html
+    assert doc.notes.ids == set(['n1', '_genid_1', '_genid_2'])
+    assert not doc.ids & doc.notes.ids
+    # Same ids and numbering as inline notes
+    for n, note_id in [(1, 'n1'), (2, '_genid_1'), (3, '_genid_2')]:
+        anchor = '<a href="#{0}" id="_genaid_{1}"><sup>[{1}]</sup></a>'.format(note_id, n)
+        assert anchor in inline.html and anchor in doc.html
+        assert '<a href="#_genaid_{0}">[^{0}]</a>'.format(n) in inline.html
+    assert '<h2>Two</h2><div class="note" id="_genid_2">' in doc.notes.html
+
+    package = build_epub(docs, converter.metadata, [], index_page=False, notes='file')
+    files = dict((f.file_name, f.content) for f in package.content_files)
+    assert [f.file_name for f in package.content_files] == \
+        ['OEBPS/1.html', 'OEBPS/1-notes.html', 'OEBPS/2.html', 'OEBPS/2-notes.html']
+    assert '<a href="1-notes.html#n1" id="_genaid_1">' in files['OEBPS/1.html']
+    assert '<a href="1.html#_genaid_1">[^1]</a>' in files['OEBPS/1-notes.html']
+    # n1 is in both notes pages, each document links to its own
+    assert '<a href="2-notes.html#n1" id="_genaid_2_1">' in files['OEBPS/2.html']
+    assert '<a href="2-notes.html#_genid_2_1" id="_genaid_2_2">' in files['OEBPS/2.html']
+
+    package = build_epub(docs, converter.metadata, [], index_page=False, notes='book')
+    files = dict((f.file_name, f.content) for f in package.content_files)
+    assert [f.file_name for f in package.content_files] == ['OEBPS/1.html', 'OEBPS/2.html', 'OEBPS/notes.html']
+    assert '<a href="notes.html#_genid_2_1" id="_genaid_2_2">' in files['OEBPS/2.html']
+    assert '<a href="2.html#_genaid_2_2">[^2]</a>' in files['OEBPS/notes.html']
+    assert package.opf_file.content.count('<itemref ') == 3
+    assert 'notes.html#_notes' in package.ncx_file.content
+
+    # Index entries in notes link to the notes page the entries went to
+    source = source.replace('Second', '<index subject1="Grace"/>Second')
+    docs = [('a.xml', converter.transform(source)), ('b.xml', converter.transform(source, doc_num=2))]
+    for notes, hrefs in [('file', ['1-notes.html#_genrid_1', '2-notes.html#_genrid_2_1']),
+                         ('book', ['notes.html#_genrid_1', 'notes.html#_genrid_2_1'])]:
+        package = build_epub(docs, converter.metadata, [], notes=notes)
+        index = etree.fromstring(package.content_files[-1].content)
+        assert index.xpath('//h:a/@href', namespaces={'h': XHTML_NS}) == hrefs
+
+def test_shared_stylesheet():
+    converter = ThmlToHtml(shared_stylesheet=True)
+    css = '<style type="text/css">.a { color: red }</style>'
+    docs = [('a.xml', converter.transform("""<ThML><ThML.head>{0}</ThML.head><ThML.body>
+<div1 title="One"><p>Text<note>A note</note></p></div1></ThML.body></ThML>""".format(css), full_xml=True)),
+            ('b.xml', converter.transform("""<ThML><ThML.body>{0}<style type="text/css">.b {{}}</style>
+<div1 title="Two"><p>More</p></div1></ThML.body></ThML>""".format(css), full_xml=True, doc_num=2))]
+    for src_name, html_doc in docs:
+        assert '<style' not in html_doc.html
+        assert etree.fromstring(html_doc.html).xpath('h:head/h:link/@href', namespaces={'h': XHTML_NS}) == \
+            ['style.css']
+    assert docs[1][1].css == ['.a { color: red }', '.b {}']
+    # b.xml has no ThML.head, so its head is made, with a title
+    assert etree.fromstring(docs[1][1].html).xpath('h:head/h:title/text()', namespaces={'h': XHTML_NS}) == \
+        ['Two']
+    assert ThmlToHtml(shared_stylesheet=True).transform('<ThML><ThML.body>{0}</ThML.body></ThML>'.format(
+        css)).html.startswith('<html>\n  <head>\n    <title>Untitled</title>\n    <link ')
+
+    package = build_epub(docs, converter.metadata, [], notes='book')
+    files = dict((f.file_name, f) for f in package.content_files)
+    stylesheet = files['OEBPS/style.css']
+    assert stylesheet.media_type == 'text/css'
+    assert stylesheet.content == BASE_CSS + '\n.a { color: red }\n\n.b {}\n'
+    assert 'href="style.css"' not in package.opf_file.content.split('<spine')[1]
+    assert validate_epub(package) == []
+
+    # Content documents need a head and a title
+    files['OEBPS/1.html'].content = re.sub(r'<title>.*</title>', '', files['OEBPS/1.html'].content)
+    files['OEBPS/2.html'].content = re.sub(r'(?s)<head>.*</head>', '', files['OEBPS/2.html'].content)
+    assert [(m.code, m.file_name) for m in validate_epub(package)] == \
+        [('xhtml-title', 'OEBPS/1.html'), ('xhtml-head', 'OEBPS/2.html')]
+
+    # The default is to keep style blocks in place
+    assert ThmlToHtml().transform(css).css is None
+
+def test_rate_limiter():
+    import BaseHTTPServer
+    import shutil
+    import tempfile
+    requests_seen = []
+    class ImageServer(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append((time.time(), self.path))
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/gif')
+            self.end_headers()
+            self.wfile.write('GIF89a')
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ImageServer)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    directory = tempfile.mkdtemp()
+    try:
+        state_file = os.path.join(directory, 'rate')
+        thml = """<ThML><ThML.head><DC><DC.Identifier scheme="URL">/b/book.html</DC.Identifier></DC></ThML.head>
+<ThML.body><p><img src="a.gif"/><img src="b.gif"/><img src="c.gif"/></p></ThML.body></ThML>"""
+        base_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+        # Two converters, as if in separate processes, sharing one limit
+        converters = [ThmlToHtml(download_images=True, http_sleep_time=0.1, rate_limit_file=state_file,
+                                 image_base_url=base_url) for i in range(2)]
+        for converter in converters:
+            converter.transform(thml, images=False)
+        threads = [threading.Thread(target=converter.fetch_images) for converter in converters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(path for t, path in requests_seen) == sorted(['/b/book/files/a.gif', '/b/book/files/b.gif',
+                                                                    '/b/book/files/c.gif'] * 2)
+        times = sorted(t for t, path in requests_seen)
+        assert all(later - earlier > 0.08 for earlier, later in zip(times, times[1:]))
+        for converter in converters:
+            assert len(converter.img_files) == 3
+            assert converter.img_files[0]['content'] == 'GIF89a'
+        limiters = [converter.rate_limiter for converter in converters]
+        assert sum(l.requests for l in limiters) == 6
+        assert sum(l.waits for l in limiters) >= 5
+        assert 0.4 < sum(l.wait_time for l in limiters)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+def test_preview():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(directory, name) for name in ['a.xml', 'b.xml']]
+        with file(filenames[0], 'w') as f:
+            f.write("""<ThML><ThML.head><DC><DC.Title>Book</DC.Title></DC></ThML.head><ThML.body>
+<div1 title="One" id="one"><p>See <a href="#three">three</a> and <a href="#two">two</a><img src="1.gif"/></p></div1>
+<div1 title="Two" id="two"><p>Two<note>A note</note></p></div1>
+<div1 title="Three" id="three"><p>Three<img src="3.gif"/></p></div1>
+</ThML.body></ThML>""")
+        with file(filenames[1], 'w') as f:
+            f.write("""<ThML><ThML.head><DC><DC.Creator>Someone</DC.Creator></DC></ThML.head><ThML.body>
+<div1 title="Four"><p>Four</p></div1></ThML.body></ThML>""")
+
+        converter = ThmlToHtml()
+        docs = converter.transform_preview(filenames, max_chapters=2, full_xml=True)
+        assert len(docs) == 1
+        html_doc = docs[0][1]
+        assert [item.title for item in html_doc.toc.items] == ['One', 'Two']
+        assert '<a>three</a>' in html_doc.html
+        assert '<a href="#two">two</a>' in html_doc.html
+        assert html_doc.links == set(['two'])
+        assert converter.get_handler(ImgHandler).img_srcs == set([('1.gif', '1.gif')])
+        assert converter.metadata['dc:title'] == [('Book', {})]
+        assert converter.metadata['dc:creator'] == [('Someone', {})]
+
+        # Going over the byte budget finishes the chapter being read
+        root, chapters, bytes_read, complete = parse_thml_preview(filenames[0], max_bytes=1)
+        assert chapters == 1 and not complete
+        assert [div.get('title') for div in root.iter('div1')] == ['One']
+        converter = ThmlToHtml()
+        docs = converter.transform_preview(filenames, max_chapters=5, full_xml=True)
+        assert [len(html_doc.toc.items) for fn, html_doc in docs] == [3, 1]
+        assert '<a href="#three">three</a>' in docs[0][1].html
+
+        # There is always something to show
+        for kwargs in [dict(max_chapters=0), dict(max_chapters=-1), dict(max_bytes=0)]:
+            converter = ThmlToHtml()
+            docs = converter.transform_preview(filenames, full_xml=True, **kwargs)
+            assert [[item.title for item in html_doc.toc.items] for fn, html_doc in docs] == [['One']]
+            build_epub(docs, converter.metadata, [])
+    finally:
+        shutil.rmtree(directory)
+
+def test_survey():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(directory, 'sub'))
+        sources = {
+            'a.xml': """<ThML><ThML.head><DC><DC.Title>A</DC.Title></DC></ThML.head><ThML.body>
+<div1 title="One"><p foo="1">A <term>word</term></p>
+<p foo="2" bar="3">B</p></div1></ThML.body></ThML>""",
+            'sub/b.xml': """<ThML><ThML.body><p><term>x</term><term>y</term><deleted><term>z</term></deleted></p>
+<p><glossary/></p></ThML.body></ThML>""",
+            'sub/c.xml': "<ThML><p>broken</ThML>",
+        }
+        for name, source in sources.items():
+            with file(os.path.join(directory, name), 'w') as f:
+                f.write(source)
+        filenames = list(find_thml_files([directory]))
+        assert filenames == [os.path.join(directory, name) for name in ['a.xml', 'sub/b.xml', 'sub/c.xml']]
+
+        survey = survey_corpus(filenames, jobs=2)
+        assert survey.files == 3
+        assert survey.failed == [filenames[2]]
+        # Nothing is reported for the DC metadata or for deleted content
+        assert survey.counts == Counter({('term', None): 3, ('glossary', None): 1,
+                                         ('p', 'foo'): 2, ('p', 'bar'): 1})
+        assert survey.file_counts[('term', None)] == 2
+        assert sorted(survey.examples[('term', None)]) == [(filenames[0], 2), (filenames[1], 1), (filenames[1], 1)]
+
+        out = StringIO.StringIO()
+        survey.report(out)
+        lines = out.getvalue().splitlines()
+        assert lines[0] == "Surveyed 3 files, 1 could not be parsed"
+        assert lines[3].split()[:4] == ['3', '2', 'files', 'term']
+        assert lines[-2].split()[:4] == ['2', '1', 'files', 'p@foo']
+    finally:
+        shutil.rmtree(directory)
+
+def test_handler_spec():
+    import shutil
+    import tempfile
+    # Dispatch keeps the order of the handlers, with generic ones for every tag
+    dispatch = HandlerDispatch([cls() for cls in HANDLERS])
+    assert [type(h) for h in dispatch.get('style')] == \
+        [StyleHandler, HANDLERS[HANDLERS.index(StyleHandler) + 1], DCMetaDataCollector]
+    assert [type(h) for h in dispatch.get('unknown')] == [DCMetaDataCollector]
+
+    directory = tempfile.mkdtemp()
+    try:
+        spec_path = os.path.join(directory, 'spec.json')
+        with file(spec_path, 'w') as f:
+            json.dump([
+                {"tag": "term", "action": "map", "to": "dfn", "attributes": "none", "copy": ["title"]},
+                {"tag": "p", "action": "map", "add": {"class": "para"}, "match": {"type": "x"}, "remove": ["type"]},
+                {"tag": "p", "action": "unwrap", "match": {"type": None}},
+                {"tag": "added", "action": "delete"},
+            ], f)
+        handlers = load_handler_spec(spec_path)
+        assert load_handler_spec(spec_path) is handlers
+        names = [cls.__name__ for cls in handlers]
+        # The rules for p take the place of the built-in one, new tags go at the end
+        assert names.index('MAP(p, p)') == [cls.__name__ for cls in HANDLERS].index('MAP(p, p)')
+        assert names[names.index('MAP(p, p)') + 1] == 'UNWRAP(p)'
+        assert names[-1] == 'MAP(term, dfn)'
+        assert names.count('MAP(p, p)') == 1 and 'UNWRAP(added)' not in names
+
+        converter = ThmlToHtml(handler_spec=spec_path)
+        html = converter.transform("""<ThML><ThML.body><p type="x" id="a">One <added>gone</added>
+<term title="t">word</term></p><p>Two</p></ThML.body></ThML>""").html
+        assert '<p id="a" class="para">One ' in html
+        assert '<dfn title="t">word</dfn>' in html
+        assert 'gone' not in html
+        assert 'Two' in html and '<p>Two' not in html
+
+        for spec, message in [({"tag": "p"}, "a handler spec must be a list"),
+                              ([{"tag": "p", "action": "frob"}], "unknown action"),
+                              ([{"action": "map"}], "has no tag"),
+                              ([{"tag": "p", "action": "map", "add": ["class"]}],
+                               """'add' in rule {"action": "map", "add": ["class"], "tag": "p"} should be """
+                               "an object with string values"),
+                              ([{"tag": "p", "action": "map", "match": ["type"]}], "'match' in rule"),
+                              ([{"tag": "p", "action": "map", "copy": "title"}], "should be a list of strings"),
+                              ([{"tag": "p", "action": "map", "coppy": ["title"]}], "unknown field 'coppy'"),
+                              ([{"tag": "p", "action": "unwrap", "to": "span"}], "'to' can't be used"),
+                              ([{"tag": "p", "action": "map", "attributes": "ALL"}], "unknown attributes 'ALL'"),
+                              ([{"tag": "note", "action": "unwrap"}], "handled by NoteHandler")]:
+            with file(spec_path, 'w') as f:
+                json.dump(spec, f)
+            try:
+                load_handler_spec(spec_path)
+            except HandlerSpecError as e:
+                assert message in str(e)
+            else:
+                assert False, spec
+    finally:
+        shutil.rmtree(directory)
+
 if __name__ == '__main__':
     main()